@@ -10,9 +10,29 @@ import re
 import socket
 import uuid
 import signal
+import queue
+import struct
+import ssl
+import http.client
+from urllib.parse import urlsplit
+import contextlib
+import ctypes
+import errno
+import socketserver
+import sys
+import gzip
+import hashlib
+import collections
+import functools
+import inspect
+import math
+import mmap
+import select
+import tempfile
 
 from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify
-from flask import send_from_directory
+from flask import get_flashed_messages, g, has_request_context, session, copy_current_request_context
+from flask import send_from_directory, make_response, Response
 
 # Configure logging as early as possible
 logging.basicConfig(
@@ -66,11 +86,20 @@ def load_admin_config():
         'hidden_interfaces': _env_list('IGNORE_INTERFACES', 'docker0'),
         'disable_tools_column': os.environ.get('DISABLE_TOOLS_COLUMN', 'false').lower() == 'true',
         'default_theme': os.environ.get('DEFAULT_THEME', ''),
+        'default_shaping_mode': os.environ.get('DEFAULT_SHAPING_MODE', 'htb'),
+        'fast_shaping_mode': os.environ.get('FAST_SHAPING_MODE', 'cake'),
+        'fast_shaping_threshold': os.environ.get('FAST_SHAPING_THRESHOLD', '10gbit'),
         'disable_routes': False,
         'disable_interface_ips': False,
         'disable_mtu': False,
+        'multiqueue_impairments': os.environ.get('MULTIQUEUE_IMPAIRMENTS', 'false').lower() == 'true',
+        'netem_limit': int(os.environ.get('NETEM_LIMIT', '0')),        # packets, 0 = sized from the BDP
+        'shaper_burst': int(os.environ.get('SHAPER_BURST', '0')),      # bytes, 0 = sized from the rate
+        'shaper_queue_ms': int(os.environ.get('SHAPER_QUEUE_MS', '100')),
         'hide_admin_link': False,
         'interface_overrides': {},  # keyed by interface name
+        'fleet_agents': parse_fleet_agents(os.environ.get('FLEET_AGENTS', '')),
+        'fleet_profiles': {},  # name -> {'items': [{agent, interface, direction, latency, ...}]}
     }
     if os.path.exists(ADMIN_CONFIG_PATH):
         try:
@@ -178,6 +207,644 @@ def log_command(command, output):
     logging.info(f"Command: {' '.join(command)}")
     logging.info(f"Output: {output}")
 
+
+# ---------------------------------------------------------------------------
+# Command runner — every external command (ip, tc, iptables, ipset, which, ...)
+# goes through run_cmd() so it gets a timeout and per-command statistics.
+#   COMMAND_TIMEOUT       seconds before a command is killed (default 30)
+#   STREAM_TIMEOUT        seconds before a streamed dump (stream_cmd) is killed (default 300)
+#   COMMAND_BACKEND       subprocess (default) | record | replay
+#   COMMAND_RECORD_FILE   JSONL file written by 'record' and read by 'replay'
+# 'record' runs commands normally and appends {cmd, input, returncode, stdout,
+# stderr, seconds} per call; 'replay' answers from that file without executing
+# anything, so request handling can be profiled offline (statistics then carry
+# the recorded durations).
+# ---------------------------------------------------------------------------
+COMMAND_TIMEOUT     = float(os.environ.get('COMMAND_TIMEOUT', '30'))
+STREAM_TIMEOUT      = float(os.environ.get('STREAM_TIMEOUT', '300'))
+COMMAND_BACKEND     = os.environ.get('COMMAND_BACKEND', 'subprocess').strip().lower()
+COMMAND_RECORD_FILE = os.environ.get('COMMAND_RECORD_FILE', 'commands.jsonl')
+# Histogram upper bounds in seconds (last bucket is +Inf)
+COMMAND_BUCKETS     = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_cmd_stats = {}
+_cmd_stats_lock = threading.Lock()
+_cmd_record_lock = threading.Lock()
+_cmd_replay = None  # {(cmd tuple, input): [entries]} loaded on first use
+
+
+def command_signature(cmd):
+    """
+    Stats key for a command: the program plus up to three leading arguments,
+    cut at 'dev' so interfaces don't multiply the keys. sudo/nsenter wrappers
+    are kept as a prefix so their overhead shows up separately, e.g.
+    'sudo tc qdisc show', 'ip -j addr', 'sudo tc -force -batch -'.
+    """
+    prefix = []
+    rest = list(cmd)
+    if rest and rest[0] == 'sudo':
+        prefix, rest = ['sudo'], rest[1:]
+    elif rest and rest[0] == 'nsenter':
+        prefix, rest = ['nsenter'], rest[4:]
+    head = rest[:1]
+    for arg in rest[1:4]:
+        if arg == 'dev':
+            break
+        head.append(arg)
+    return ' '.join(prefix + head)
+
+
+def _record_command_stats(signature, seconds, failed, timed_out):
+    with _cmd_stats_lock:
+        stats = _cmd_stats.get(signature)
+        if stats is None:
+            stats = _cmd_stats[signature] = {'count': 0, 'failures': 0, 'timeouts': 0,
+                                              'total_seconds': 0.0, 'max_seconds': 0.0,
+                                              'buckets': [0] * (len(COMMAND_BUCKETS) + 1)}
+        stats['count'] += 1
+        stats['failures'] += int(failed)
+        stats['timeouts'] += int(timed_out)
+        stats['total_seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        for i, bound in enumerate(COMMAND_BUCKETS):
+            if seconds <= bound:
+                stats['buckets'][i] += 1
+                break
+        else:
+            stats['buckets'][-1] += 1
+    if has_request_context():
+        g.cmd_count = g.get('cmd_count', 0) + 1
+        g.cmd_seconds = g.get('cmd_seconds', 0.0) + seconds
+
+
+def _replay_command(cmd, input):
+    global _cmd_replay
+    with _cmd_record_lock:
+        if _cmd_replay is None:
+            _cmd_replay = {}
+            try:
+                with open(COMMAND_RECORD_FILE) as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        _cmd_replay.setdefault((tuple(entry['cmd']), entry.get('input')), []).append(entry)
+            except Exception as e:
+                logging.error(f"Could not load command recording {COMMAND_RECORD_FILE}: {e}")
+        entries = _cmd_replay.get((tuple(cmd), input))
+        if not entries:
+            return None
+        # Replay recordings in order; keep answering with the last one once exhausted
+        return entries.pop(0) if len(entries) > 1 else entries[0]
+
+
+def run_cmd(cmd, input=None, timeout=None):
+    """
+    Run an external command and return a subprocess.CompletedProcess with text
+    stdout/stderr. Never raises for command failures: a timeout or a missing
+    binary comes back as returncode 124 / 127 with the reason in stderr.
+    """
+    signature = command_signature(cmd)
+    cmd = netns_command(cmd)
+    timeout = timeout or COMMAND_TIMEOUT
+
+    if COMMAND_BACKEND == 'replay':
+        entry = _replay_command(cmd, input)
+        if entry is None:
+            result = subprocess.CompletedProcess(cmd, 127, '', f"replay: no recording for {' '.join(cmd)}")
+            _record_command_stats(signature, 0.0, True, False)
+        else:
+            result = subprocess.CompletedProcess(cmd, entry['returncode'], entry['stdout'], entry['stderr'])
+            _record_command_stats(signature, entry['seconds'], entry['returncode'] != 0, False)
+        return result
+
+    helper_argv = privileged_argv(cmd) if HELPER_SOCKET else None
+    if helper_argv is not None:
+        signature = 'helper ' + signature.split(' ', 1)[-1]  # in place of the sudo/nsenter prefix
+    timed_out = False
+    start = time.perf_counter()
+    try:
+        if helper_argv is not None:
+            result = helper_run(helper_argv, input, timeout)
+            timed_out = result.returncode == 124
+        else:
+            result = subprocess.run(cmd, input=input, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired as e:
+        timed_out = True
+        result = subprocess.CompletedProcess(cmd, 124, e.stdout or '', f"timed out after {timeout:g}s")
+        logging.error(f"Command timed out after {timeout:g}s: {' '.join(cmd)}")
+    except OSError as e:
+        result = subprocess.CompletedProcess(cmd, 127, '', str(e))
+    seconds = time.perf_counter() - start
+    _record_command_stats(signature, seconds, result.returncode != 0, timed_out)
+
+    if COMMAND_BACKEND == 'record':
+        entry = {'cmd': list(cmd), 'input': input, 'returncode': result.returncode,
+                 'stdout': result.stdout, 'stderr': result.stderr, 'seconds': seconds}
+        with _cmd_record_lock:
+            with open(COMMAND_RECORD_FILE, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+    return result
+
+
+def stream_cmd(cmd, chunk_size=1 << 16):
+    """
+    Run a command and yield its stdout as text chunks instead of buffering it all
+    (for dumps that can run to hundreds of MB, e.g. full BGP tables). Statistics
+    are recorded when the stream ends; closing the generator early kills the
+    command, and so does STREAM_TIMEOUT (the stream then ends early). stderr
+    goes to a temporary file so a chatty command cannot fill its pipe and block.
+    """
+    signature = command_signature(cmd)
+    cmd = netns_command(cmd)
+    if COMMAND_BACKEND == 'replay':
+        entry = _replay_command(cmd, None)
+        _record_command_stats(signature, entry['seconds'] if entry else 0.0,
+                              entry is None or entry['returncode'] != 0, False)
+        if entry:
+            yield entry['stdout']
+        return
+
+    recorded = [] if COMMAND_BACKEND == 'record' else None
+    start = time.perf_counter()
+    stderr_file = tempfile.TemporaryFile(mode='w+')
+    try:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+    except OSError as e:
+        stderr_file.close()
+        logging.error(f"Could not run {' '.join(cmd)}: {e}")
+        _record_command_stats(signature, time.perf_counter() - start, True, False)
+        return
+    expired = threading.Event()
+
+    def expire():
+        expired.set()
+        process.kill()
+
+    watchdog = threading.Timer(STREAM_TIMEOUT, expire)
+    watchdog.daemon = True
+    watchdog.start()
+    finished = False
+    try:
+        while True:
+            chunk = process.stdout.read(chunk_size)
+            if not chunk:
+                finished = True
+                break
+            if recorded is not None:
+                recorded.append(chunk)
+            yield chunk
+    finally:
+        watchdog.cancel()
+        if not finished:
+            process.kill()  # consumer stopped early
+        process.stdout.close()
+        returncode = process.wait()
+        stderr_file.seek(0)
+        stderr = stderr_file.read()
+        stderr_file.close()
+        seconds = time.perf_counter() - start
+        if expired.is_set():
+            logging.error(f"Stream timed out after {STREAM_TIMEOUT:g}s: {' '.join(cmd)}")
+        _record_command_stats(signature, seconds, returncode != 0 or expired.is_set(), expired.is_set())
+        if recorded is not None:
+            entry = {'cmd': list(cmd), 'input': None, 'returncode': returncode,
+                     'stdout': ''.join(recorded), 'stderr': stderr, 'seconds': seconds}
+            with _cmd_record_lock:
+                with open(COMMAND_RECORD_FILE, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+
+
+def spawn_cmd(cmd, **kwargs):
+    """Start a long-running command (e.g. tcpdump) with Popen; only the spawn itself is timed."""
+    signature = command_signature(cmd)
+    start = time.perf_counter()
+    try:
+        process = subprocess.Popen(netns_command(cmd), **kwargs)
+    except OSError:
+        _record_command_stats(signature, time.perf_counter() - start, True, False)
+        raise
+    _record_command_stats(signature, time.perf_counter() - start, False, False)
+    return process
+
+
+def get_command_stats():
+    """Snapshot of the per-command statistics with cumulative histogram buckets."""
+    with _cmd_stats_lock:
+        snapshot = {sig: dict(stats, buckets=list(stats['buckets'])) for sig, stats in _cmd_stats.items()}
+    commands = {}
+    for sig, stats in sorted(snapshot.items()):
+        cumulative, running = {}, 0
+        for bound, count in zip(list(COMMAND_BUCKETS) + ['+Inf'], stats['buckets']):
+            running += count
+            cumulative[str(bound)] = running
+        commands[sig] = {
+            'count': stats['count'],
+            'failures': stats['failures'],
+            'timeouts': stats['timeouts'],
+            'total_ms': round(stats['total_seconds'] * 1000, 3),
+            'mean_ms': round(stats['total_seconds'] * 1000 / stats['count'], 3),
+            'max_ms': round(stats['max_seconds'] * 1000, 3),
+            'histogram_seconds': cumulative,
+        }
+    return commands
+
+
+def reset_command_stats():
+    with _cmd_stats_lock:
+        _cmd_stats.clear()
+
+
+@app.after_request
+def add_command_timing_header(response):
+    """Report how much of the request went to external commands (Server-Timing)."""
+    count = g.get('cmd_count', 0)
+    if count:
+        response.headers.add('Server-Timing',
+                             f'cmd;dur={g.cmd_seconds * 1000:.1f};desc="{count} commands"')
+    return response
+
+# ---------------------------------------------------------------------------
+# Privileged helper — 'python3 app.py --privileged-helper' runs a small root
+# daemon on the Unix socket HELPER_SOCKET. When the web process has
+# HELPER_SOCKET set, run_cmd sends every privileged command (sudo ... or the
+# container's nsenter prefix) to it as one JSON line over a persistent
+# per-thread connection instead of exec'ing sudo. The web process can then run
+# unprivileged, and sudo's fork/exec, PAM and logging drop out of every apply.
+# The helper also answers namespace link lookups from its cached rtnetlink
+# sockets (setns needs root). Requests and replies are one JSON object per line:
+#   {"op": "run", "argv": [...], "input": str|null, "timeout": s}
+#       -> {"returncode", "stdout", "stderr"}
+#   {"op": "links", "netns": name, "interface": name|null} -> {"links": {...}}
+#   {"op": "ping"} -> {"pid": ...}
+# Only ip, tc, ip(6)tables(-restore) and ipset may run, optionally behind the
+# nsenter host prefix or 'ip netns exec <name>'. Anything that could run an
+# arbitrary program is refused in every spelling the tools accept, in argv and
+# in stdin alike: any prefix of ip/tc 'exec', -batch/--batch prefixes not
+# reading stdin, iptables -M (also inside short option clusters) and --modprobe
+# prefixes, and iptables-restore rule files.
+#   HELPER_SOCKET         socket path ('' = exec sudo per command, the default)
+#   HELPER_SOCKET_GROUP   group allowed to connect (socket mode 0660)
+# Packet captures still start tcpdump through sudo (unless CAPTURE_ENGINE=afpacket).
+# ---------------------------------------------------------------------------
+
+HELPER_SOCKET = os.environ.get('HELPER_SOCKET', '')
+HELPER_SOCKET_GROUP = os.environ.get('HELPER_SOCKET_GROUP', '')
+HELPER_DEFAULT_SOCKET = '/run/hyyperwan/helper.sock'
+HELPER_COMMANDS = ('ip', 'tc', 'iptables', 'iptables-restore', 'ip6tables', 'ip6tables-restore', 'ipset')
+
+_helper_local = threading.local()
+
+
+def privileged_argv(cmd):
+    """The argv the helper should run for cmd, or None if cmd needs no privileges."""
+    if cmd[:1] == ['sudo']:
+        return list(cmd[1:])
+    if cmd[:4] == HOST_NETNS_PREFIX:
+        return list(cmd)
+    return None
+
+
+def _is_prefix_of(word, keyword):
+    """iproute2 and getopt_long accept any non-empty prefix of a keyword or long option."""
+    return bool(word) and keyword.startswith(word)
+
+
+def _iproute_refusal(words):
+    """Why ip/tc words (argv or batch lines) may not run, or None."""
+    for i, word in enumerate(words):
+        if _is_prefix_of(word, 'exec'):
+            return f"'{word}' (exec) is not allowed"
+        # -batch, --batch, -b, -bat ...: only '-' (stdin) may follow
+        if word.startswith('-') and _is_prefix_of(word.lstrip('-'), 'batch'):
+            if i + 1 >= len(words) or words[i + 1] != '-':
+                return 'batch input must come from stdin'
+    return None
+
+
+def _iptables_refusal(words):
+    """Why iptables(-restore) words may not run, or None: no -M / --modprobe in any spelling."""
+    for word in words:
+        if word.startswith('--'):
+            if _is_prefix_of(word[2:].split('=', 1)[0], 'modprobe'):
+                return f"'{word}' (--modprobe) is not allowed"
+        elif word.startswith('-') and 'M' in word:  # -M or a short option cluster ending in it
+            return f"'{word}' (-M) is not allowed"
+    return None
+
+
+def validate_helper_argv(argv, input=None):
+    """Return why argv may not run through the helper, or None if it may."""
+    if not isinstance(argv, list) or not argv or not all(isinstance(a, str) for a in argv):
+        return 'argv must be a non-empty list of strings'
+    if input is not None and not isinstance(input, str):
+        return 'input must be a string'
+    if argv[:4] == HOST_NETNS_PREFIX:
+        argv = argv[4:]
+    if argv[:3] == ['ip', 'netns', 'exec'] and len(argv) > 4 and NETNS_NAME_RE.match(argv[3]):
+        argv = argv[4:]
+    if not argv or argv[0] not in HELPER_COMMANDS:
+        return f"command not allowed: {argv[0] if argv else '(none)'}"
+    input_words = input.split() if input else []
+    if argv[0] in ('ip', 'tc'):
+        return _iproute_refusal(argv[1:]) or _iproute_refusal(input_words)
+    if argv[0] in ('iptables', 'ip6tables', 'iptables-restore', 'ip6tables-restore'):
+        if argv[0].endswith('-restore') and not all(arg.startswith('-') for arg in argv[1:]):
+            return 'rules must come from stdin'
+        return _iptables_refusal(argv[1:]) or _iptables_refusal(input_words)
+    return None
+
+
+def handle_helper_request(req):
+    """Run one helper request (see the section comment) and return the reply dict."""
+    op = req.get('op')
+    if op == 'ping':
+        return {'pid': os.getpid()}
+    if op == 'run':
+        argv, input = req.get('argv'), req.get('input')
+        error = validate_helper_argv(argv, input)
+        if error:
+            logging.warning(f"Privileged helper refused {argv!r}: {error}")
+            return {'returncode': 126, 'stdout': '', 'stderr': f"privileged helper: {error}"}
+        timeout = float(req.get('timeout') or COMMAND_TIMEOUT)
+        try:
+            result = subprocess.run(argv, input=input, capture_output=True, text=True, timeout=timeout)
+        except subprocess.TimeoutExpired as e:
+            return {'returncode': 124, 'stdout': e.stdout or '', 'stderr': f"timed out after {timeout:g}s"}
+        except OSError as e:
+            return {'returncode': 127, 'stdout': '', 'stderr': str(e)}
+        return {'returncode': result.returncode, 'stdout': result.stdout, 'stderr': result.stderr}
+    if op == 'links':
+        netns = req.get('netns') or ''
+        if not is_valid_netns(netns):
+            return {'error': f"unknown network namespace: {netns}"}
+        try:
+            return {'links': netns_links(netns, req.get('interface') or None)}
+        except OSError as e:
+            _drop_netns_socket(netns)
+            return {'error': str(e)}
+    return {'error': f"unknown op: {op!r}"}
+
+
+class HelperRequestHandler(socketserver.StreamRequestHandler):
+    """One connection: JSON request lines in, JSON reply lines out, until the client hangs up."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = handle_helper_request(json.loads(line))
+            except Exception as e:
+                reply = {'error': str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+            self.wfile.flush()
+
+
+def run_privileged_helper(path=None):
+    """Serve helper requests on a Unix socket until killed (run as root)."""
+    path = path or HELPER_SOCKET or HELPER_DEFAULT_SOCKET
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(path)
+    previous_umask = os.umask(0o117)  # the socket is never world-accessible, not even briefly
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, HelperRequestHandler)
+    finally:
+        os.umask(previous_umask)
+    server.daemon_threads = True
+    if HELPER_SOCKET_GROUP:
+        shutil.chown(path, group=HELPER_SOCKET_GROUP)
+    logging.info(f"Privileged helper (pid {os.getpid()}) listening on {path}")
+    print(f"HyyperWAN privileged helper listening on {path}", flush=True)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # run the finally below on a plain kill
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def helper_request(request, timeout):
+    """
+    Send one request over this thread's helper connection and return the reply.
+    A connection that was reused and turns out dead is reopened once. Raises
+    OSError or ValueError when the helper cannot be reached or replies garbage.
+    """
+    for attempt in (0, 1):
+        conn = getattr(_helper_local, 'conn', None)
+        fresh = conn is None
+        if fresh:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(HELPER_SOCKET)
+            except OSError:
+                sock.close()
+                raise
+            conn = _helper_local.conn = (sock, sock.makefile('rb'))
+        sock, reader = conn
+        try:
+            sock.settimeout(timeout)
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            line = reader.readline()
+            if not line:
+                raise ConnectionError('privileged helper closed the connection')
+            return json.loads(line)
+        except (OSError, ValueError):
+            _helper_local.conn = None
+            reader.close()
+            sock.close()
+            if fresh or attempt:
+                raise
+
+
+def helper_run(argv, input=None, timeout=None):
+    """Run argv through the privileged helper; a CompletedProcess like run_cmd's, never raises."""
+    timeout = timeout or COMMAND_TIMEOUT
+    try:
+        reply = helper_request({'op': 'run', 'argv': argv, 'input': input, 'timeout': timeout}, timeout + 5)
+    except (OSError, ValueError) as e:
+        logging.error(f"Privileged helper unavailable for {' '.join(argv)}: {e}")
+        return subprocess.CompletedProcess(argv, 127, '', f"privileged helper unavailable: {e}")
+    if 'error' in reply:
+        return subprocess.CompletedProcess(argv, 127, '', f"privileged helper: {reply['error']}")
+    return subprocess.CompletedProcess(argv, reply['returncode'], reply['stdout'], reply['stderr'])
+
+
+def wait_for_helper(seconds=10.0):
+    """Block until the helper answers a ping (web and helper are usually started together)."""
+    deadline = time.monotonic() + seconds
+    while True:
+        try:
+            helper_request({'op': 'ping'}, 1.0)
+            return True
+        except (OSError, ValueError):
+            if time.monotonic() >= deadline:
+                logging.error(f"Privileged helper on {HELPER_SOCKET} did not answer within {seconds:g}s")
+                return False
+            time.sleep(0.1)
+
+
+# ---------------------------------------------------------------------------
+# Per-interface mutation queue — tc, NAT and link changes to one interface run
+# one at a time and in arrival order, so two requests can never interleave one
+# apply's 'tc qdisc del root' with another's rebuild. A change that arrives
+# while a change of the same kind is still waiting in the queue is merged into
+# that one instead of queueing a rebuild of its own: a burst of applies from a
+# dragged control costs one tc rebuild per change in flight, not one per event.
+# Every caller merged into a change gets that change's result and flashes.
+# Counters (executed / serialized = had to wait / coalesced = merged) are in
+# GET /stats/commands and /metrics.
+# ---------------------------------------------------------------------------
+
+_mutation_queues = {}                    # (netns, interface) -> {'cond', 'entries'}
+_mutation_queues_lock = threading.Lock()
+_mutation_local = threading.local()      # queue keys whose head this thread is running
+_mutation_stats = {}                     # kind -> {'executed', 'serialized', 'coalesced'}
+_mutation_stats_lock = threading.Lock()
+
+
+def merge_settings(pending, newer):
+    """Coalesce two partial updates (None = keep current): the newer call's explicit arguments win."""
+    return {k: (v if v is not None else pending.get(k)) for k, v in newer.items()}
+
+
+def merge_replace(pending, newer):
+    """Coalesce two complete updates: the newer one replaces the pending one."""
+    return newer
+
+
+def merge_identical(pending, newer):
+    """Coalesce only repeats of the same call (e.g. two removes of the same direction)."""
+    return newer if newer == pending else None
+
+
+def _count_mutation(kind, outcome):
+    with _mutation_stats_lock:
+        stats = _mutation_stats.setdefault(kind, {'executed': 0, 'serialized': 0, 'coalesced': 0})
+        stats[outcome] += 1
+
+
+def get_mutation_stats():
+    """Snapshot of the mutation counters per kind."""
+    with _mutation_stats_lock:
+        return {kind: dict(stats) for kind, stats in sorted(_mutation_stats.items())}
+
+
+def reset_mutation_stats():
+    with _mutation_stats_lock:
+        _mutation_stats.clear()
+
+
+def _mutation_queue(interface):
+    key = (current_netns(), interface)
+    with _mutation_queues_lock:
+        q = _mutation_queues.get(key)
+        if q is None:
+            q = _mutation_queues[key] = {'cond': threading.Condition(), 'entries': collections.deque()}
+    return key, q
+
+
+def _enter_mutation(q, kind, arguments, merge):
+    """Queue a change (or merge it into the pending tail); returns (entry, coalesced) once it may run."""
+    with q['cond']:
+        tail = q['entries'][-1] if q['entries'] else None
+        if merge and tail is not None and tail['kind'] == kind and not tail['started']:
+            merged = merge(tail['arguments'], arguments)
+            if merged is not None:
+                tail['arguments'] = merged
+                _count_mutation(kind, 'coalesced')
+                q['cond'].wait_for(lambda: tail['done'])
+                return tail, True
+        entry = {'kind': kind, 'arguments': arguments, 'started': False, 'done': False,
+                 'result': None, 'flashes': []}
+        q['entries'].append(entry)
+        if q['entries'][0] is not entry:
+            _count_mutation(kind, 'serialized')
+            q['cond'].wait_for(lambda: q['entries'][0] is entry)
+        entry['started'] = True
+        return entry, False
+
+
+def _leave_mutation(q, entry):
+    with q['cond']:
+        entry['done'] = True
+        q['entries'].popleft()
+        q['cond'].notify_all()
+
+
+def run_interface_mutation(interface, kind, call, arguments=None, merge=None):
+    """
+    Run call(arguments) once every change queued before it on interface has
+    finished. With merge(pending, newer) -> merged arguments (or None when the
+    two cannot be combined), the call may instead be folded into a pending
+    change of the same kind; it then returns that change's result and replays
+    its flashes. A mutation started from inside one already running on the same
+    interface (e.g. remove_degradations -> remove_ingress_degradations) runs directly.
+    """
+    key, q = _mutation_queue(interface)
+    held = _mutation_local.__dict__.setdefault('keys', set())
+    if key in held:
+        return call(arguments)
+    entry, coalesced = _enter_mutation(q, kind, arguments, merge)
+    if coalesced:
+        for category, message in entry['flashes']:
+            flash(message, category)
+        return entry['result']
+    held.add(key)
+    before = len(session.get('_flashes', [])) if has_request_context() else 0
+    try:
+        entry['result'] = call(entry['arguments'])
+        return entry['result']
+    finally:
+        held.discard(key)
+        if has_request_context():
+            entry['flashes'] = list(session.get('_flashes', []))[before:]
+        _count_mutation(kind, 'executed')
+        _leave_mutation(q, entry)
+
+
+@contextlib.contextmanager
+def serialized_mutation(kind, *interfaces):
+    """
+    Hold the mutation queues of interfaces for the enclosed block (no
+    coalescing), e.g. around an iptables toggle. Several interfaces are
+    queued for in sorted order, so two such blocks cannot deadlock.
+    """
+    with contextlib.ExitStack() as stack:
+        held = _mutation_local.__dict__.setdefault('keys', set())
+        for interface in sorted(set(interfaces)):
+            key, q = _mutation_queue(interface)
+            if key in held:
+                continue
+            entry, _ = _enter_mutation(q, kind, None, None)
+            held.add(key)
+
+            def leave(key=key, q=q, entry=entry):
+                held.discard(key)
+                _count_mutation(kind, 'executed')
+                _leave_mutation(q, entry)
+            stack.callback(leave)
+        yield
+
+
+def interface_mutation(merge=None):
+    """
+    Decorator routing a function whose first parameter is the interface name
+    through run_interface_mutation; merge as there (see merge_settings,
+    merge_replace, merge_identical).
+    """
+    def decorate(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            interface = next(iter(arguments.values()))
+            return run_interface_mutation(interface, fn.__name__, lambda a: fn(**a), arguments, merge)
+        return wrapper
+    return decorate
+
+
 # Validation functions
 def validate_latency_jitter(value, field_name):
     """
@@ -261,151 +928,718 @@ def validate_bandwidth(value):
     return True, f"{num_str}{unit}", None
 
 
+def validate_slot(value):
+    """
+    Validate a netem slot input: one or two time values, e.g. "800us" or "800us 2ms".
+    Plain numbers are treated as ms.
+    Returns (is_valid, normalized_value, error_message)
+    """
+    if not value or value.strip() == '':
+        return True, None, None
+
+    parts = value.strip().lower().split()
+    if len(parts) > 2:
+        return False, None, "Slot must be a minimum time and an optional maximum time (e.g. 800us 2ms)"
+
+    cleaned = []
+    for part in parts:
+        match = re.match(r'^(\d{1,6})(ms|us)?$', part)
+        if not match:
+            return False, None, f"Slot time '{part}' must be a whole number of ms or us (e.g. 800us)"
+        cleaned.append(f"{match.group(1)}{match.group(2) or 'ms'}")
+
+    return True, ' '.join(cleaned), None
+
+
 def validate_cidr(value, field_name='CIDR'):
-    """Validate an optional IPv4 CIDR or host (e.g. 10.0.0.0/24 or 192.168.1.1/32).
+    """Validate an optional IPv4/IPv6 CIDR or host (e.g. 10.0.0.0/24, 192.168.1.1 or 2001:db8::/32).
     Returns (valid, normalised, error). Empty/None is valid and returns (True, None, None)."""
     import ipaddress
     if not value or not value.strip():
         return True, None, None
     value = value.strip()
     try:
-        net = ipaddress.IPv4Network(value, strict=False)
+        net = ipaddress.ip_network(value, strict=False)
         return True, str(net), None
     except ValueError:
-        return False, None, f"{field_name} '{value}' is not a valid IPv4 address or CIDR"
+        return False, None, f"{field_name} '{value}' is not a valid IPv4/IPv6 address or CIDR"
+
+
+def validate_port_range(value, field_name='Port'):
+    """Validate an optional port or port range ('443', '1000-2000').
+    Returns (valid, normalised, error). Empty/None is valid and returns (True, None, None)."""
+    if not value or not str(value).strip():
+        return True, None, None
+    value = str(value).strip()
+    m = re.match(r'^(\d{1,5})(?:-(\d{1,5}))?$', value)
+    if not m:
+        return False, None, f"{field_name} '{value}' must be a port or range like 1000-2000"
+    low, high = int(m.group(1)), int(m.group(2) or m.group(1))
+    if not (1 <= low <= high <= 65535):
+        return False, None, f"{field_name} '{value}' must be within 1-65535 with min <= max"
+    return True, (str(low) if low == high else f"{low}-{high}"), None
+
+
+# ---------------------------------------------------------------------------
+# Filtered impairments — per-rule src/dst CIDR (IPv4 or IPv6), IP protocol and
+# port matches
+#
+# Tree: HTB root (default class 1:fffe for unmatched traffic) with an aggregate
+# class 1:1; every rule gets its own class 1:<100+N> (optional rate) and a netem
+# leaf <1000+N>:. Rules are classified with flower, one filter priority per
+# distinct match shape (family, prefix lengths, which L4 fields), most specific
+# first: flower hashes the masked key, so each packet costs one lookup per
+# distinct shape regardless of how many rules share it.
+# ---------------------------------------------------------------------------
+
+FILTER_CLASS_BASE     = 0x100       # rule N -> classid 1:<0x100+N>
+FILTER_NETEM_BASE     = 0x1000      # rule N -> netem handle <0x1000+N>:
+FILTER_DEFAULT_CLASS  = 'fffe'      # unmatched traffic
+FILTER_UNLIMITED_RATE = '100gbit'   # HTB needs a rate; used when no aggregate cap is set
+MAX_FILTER_RULES      = 1024
+FILTER_RULE_KEYS      = {'src': 'src', 'dst': 'dst', 'delay': 'latency', 'latency': 'latency',
+                         'jitter': 'jitter', 'loss': 'loss', 'rate': 'rate', 'bandwidth': 'rate',
+                         'proto': 'proto', 'protocol': 'proto', 'sport': 'sport', 'src_port': 'sport',
+                         'dport': 'dport', 'dst_port': 'dport'}
+FILTER_PROTOCOLS      = ('tcp', 'udp', 'sctp', 'icmp', 'icmpv6')
+FILTER_PORT_PROTOCOLS = ('tcp', 'udp', 'sctp')
 
 
-def cidr_to_u32_mask(cidr):
-    """Convert a CIDR like '10.0.0.0/24' to (hex_ip, hex_mask) for tc u32 filter."""
+def filter_rule_classid(index):
+    """HTB classid for the rule at position index (0-based)."""
+    return f"1:{FILTER_CLASS_BASE + index:x}"
+
+
+def normalise_filter_rule(rule):
+    """
+    Validate one rule dict (src, dst, proto, sport, dport, latency, jitter, loss,
+    rate; all optional strings) and return (rule, errors) with values in tc form
+    ('50ms', '1%', '10mbit', '1000-2000'). A rule needs at least one match
+    (src/dst CIDR or proto) and at least one impairment.
+    """
     import ipaddress
-    net = ipaddress.IPv4Network(cidr, strict=False)
-    ip_int = int(net.network_address)
-    mask_int = int(net.netmask)
-    return f'0x{ip_int:08x}', f'0x{mask_int:08x}'
+    errors = []
+    clean = {'src': None, 'dst': None, 'proto': None, 'sport': None, 'dport': None,
+             'latency': '0ms', 'jitter': '0ms', 'loss': '0%', 'rate': None}
 
+    for key, label in (('src', 'Source'), ('dst', 'Destination')):
+        valid, value, error = validate_cidr(rule.get(key), label)
+        if valid:
+            clean[key] = value
+        else:
+            errors.append(error)
 
-def get_qdisc_filter(interface):
-    """Return (src_cidr, dst_cidr) active u32 filters on the interface, or (None, None)."""
+    proto = str(rule.get('proto') or '').strip().lower() or None
+    if proto and proto not in FILTER_PROTOCOLS:
+        errors.append(f"Protocol '{proto}' must be one of {', '.join(FILTER_PROTOCOLS)}")
+    else:
+        clean['proto'] = proto
+
+    for key, label in (('sport', 'Source port'), ('dport', 'Destination port')):
+        valid, value, error = validate_port_range(rule.get(key), label)
+        if valid:
+            clean[key] = value
+        else:
+            errors.append(error)
+
+    for key, label in (('latency', 'Latency'), ('jitter', 'Jitter')):
+        valid, value, error = validate_latency_jitter(str(rule.get(key) or ''), label)
+        if not valid:
+            errors.append(error)
+        elif value and int(value):
+            clean[key] = f"{int(value)}ms"
+
+    valid, value, error = validate_loss(str(rule.get('loss') or ''))
+    if not valid:
+        errors.append(error)
+    elif value:
+        clean['loss'] = f"{int(value)}%"
+
+    valid, value, error = validate_bandwidth(str(rule.get('rate') or ''))
+    if valid:
+        clean['rate'] = value
+    else:
+        errors.append(error)
+
+    if clean['jitter'] != '0ms' and clean['latency'] == '0ms':
+        clean['latency'] = '1ms'
+    if errors:
+        return clean, errors
+
+    versions = {ipaddress.ip_network(clean[k]).version for k in ('src', 'dst') if clean[k]}
+    if (clean['sport'] or clean['dport']) and clean['proto'] not in FILTER_PORT_PROTOCOLS:
+        errors.append("Port matches need proto=tcp, udp or sctp")
+    elif not (clean['src'] or clean['dst'] or clean['proto']):
+        errors.append("Rule needs a src/dst CIDR or a proto")
+    elif len(versions) > 1:
+        errors.append("Source and destination must be the same address family")
+    elif (clean['proto'] == 'icmp' and versions == {6}) or (clean['proto'] == 'icmpv6' and versions == {4}):
+        errors.append(f"proto={clean['proto']} does not match the rule's address family")
+    elif (clean['latency'], clean['loss'], clean['rate']) == ('0ms', '0%', None):
+        errors.append("Rule needs at least one of delay, loss or rate")
+    return clean, errors
+
+
+def filter_rule_protocols(rule):
+    """tc filter protocols ('ip', 'ipv6') a rule must be installed for."""
+    import ipaddress
+    for key in ('src', 'dst'):
+        if rule.get(key):
+            return ['ipv6' if ipaddress.ip_network(rule[key]).version == 6 else 'ip']
+    if rule.get('proto') == 'icmp':
+        return ['ip']
+    if rule.get('proto') == 'icmpv6':
+        return ['ipv6']
+    return ['ip', 'ipv6']
+
+
+def parse_filter_rules(text):
+    """
+    Parse the rules textarea: one rule per line as key=value pairs, e.g.
+        dst=10.1.0.0/16 delay=50ms jitter=5ms loss=1 rate=10mbit
+        src=192.168.10.0/24 dst=10.2.0.0/16 delay=120ms
+        dst=2001:db8::/32 proto=udp dport=4789 loss=2
+        proto=tcp dport=443 delay=80ms
+    Blank lines and '#' comments are ignored. Returns (rules, errors).
+    """
+    rules, errors = [], []
+    for lineno, line in enumerate((text or '').splitlines(), start=1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        raw = {}
+        for token in line.replace(',', ' ').split():
+            key, sep, value = token.partition('=')
+            if not sep or key.lower() not in FILTER_RULE_KEYS:
+                errors.append(f"Line {lineno}: unrecognised token '{token}'")
+                continue
+            raw[FILTER_RULE_KEYS[key.lower()]] = value
+        rule, rule_errors = normalise_filter_rule(raw)
+        errors.extend(f"Line {lineno}: {e}" for e in rule_errors)
+        if not rule_errors:
+            rules.append(rule)
+    return rules, errors
+
+
+def format_filter_rule(rule):
+    """Inverse of parse_filter_rules for one rule (used to prefill the textarea)."""
+    parts = []
+    if rule.get('src'):
+        parts.append(f"src={rule['src']}")
+    if rule.get('dst'):
+        parts.append(f"dst={rule['dst']}")
+    for key in ('proto', 'sport', 'dport'):
+        if rule.get(key):
+            parts.append(f"{key}={rule[key]}")
+    if rule.get('latency') and rule['latency'] != '0ms':
+        parts.append(f"delay={rule['latency']}")
+    if rule.get('jitter') and rule['jitter'] != '0ms':
+        parts.append(f"jitter={rule['jitter']}")
+    if rule.get('loss') and rule['loss'] != '0%':
+        parts.append(f"loss={rule['loss']}")
+    if rule.get('rate'):
+        parts.append(f"rate={rule['rate']}")
+    return ' '.join(parts)
+
+
+def describe_filter_match(rule):
+    """Short human description of a rule's match, e.g. 'src 10.0.0.0/8 / dst 2001:db8::/32 udp/4789'."""
+    parts = [f"{k} {rule[k]}" for k in ('src', 'dst') if rule.get(k)]
+    desc = ' / '.join(parts)
+    if rule.get('proto'):
+        l4 = rule['proto']
+        if rule.get('sport'):
+            l4 += f" sport {rule['sport']}" + (f" dport {rule['dport']}" if rule.get('dport') else '')
+        elif rule.get('dport'):
+            l4 += f"/{rule['dport']}"
+        desc = f"{desc} {l4}".strip()
+    return desc
+
+
+def _prefix_len(cidr):
+    return int(cidr.split('/')[1]) if cidr else 0
+
+
+def build_filtered_commands(interface, rules, bandwidth=None, with_filters=True, sizing=None):
+    """
+    Return the tc commands (without the leading 'tc') for the filtered HTB tree.
+    rules must already be normalised (see normalise_filter_rule). bandwidth is an
+    optional aggregate cap shared by all traffic, matched or not. with_filters=False
+    builds the classes only, for classifiers that set skb->priority (ipset matrix).
+    Bursts and netem limits are sized by queue_sizing(interface) unless sizing is given.
+    """
+    sizing = sizing or queue_sizing(interface)
+    dev = ['dev', interface]
+    cap = bandwidth or FILTER_UNLIMITED_RATE
+
+    def htb_class(parent, classid, rate):
+        burst = shaper_burst(rate_to_bits(rate), sizing)
+        return ['class', 'add'] + dev + ['parent', parent, 'classid', classid, 'htb',
+                                         'rate', rate, 'ceil', rate, 'burst', burst, 'cburst', burst]
+
+    commands = [
+        ['qdisc', 'add'] + dev + ['root', 'handle', '1:', 'htb', 'default', FILTER_DEFAULT_CLASS],
+        htb_class('1:', '1:1', cap),
+        htb_class('1:1', f'1:{FILTER_DEFAULT_CLASS}', cap),
+    ]
+    for index, rule in enumerate(rules):
+        classid = filter_rule_classid(index)
+        rate = rule.get('rate') or cap
+        commands.append(htb_class('1:1', classid, rate))
+        netem_args = build_netem_args(rule.get('latency'), rule.get('jitter'), rule.get('loss'))
+        if netem_args:
+            # An uncapped class runs at line rate, not at FILTER_UNLIMITED_RATE
+            shaped = rule.get('rate') or bandwidth
+            limit = netem_limit(rate_to_bits(shaped) if shaped else sizing['line_rate'],
+                                netem_hold_seconds(rule.get('latency'), rule.get('jitter'), bool(shaped), sizing),
+                                sizing)
+            commands.append(['qdisc', 'add'] + dev + ['parent', classid,
+                             'handle', f'{FILTER_NETEM_BASE + index:x}:', 'netem', 'limit', str(limit)]
+                            + netem_args)
+
+    if not with_filters:
+        return commands
+
+    # One flower instance per (protocol, match shape); more specific shapes get lower (earlier) prio
+    def shape(rule, protocol):
+        ports = tuple(0 if not rule.get(k) else (1 if '-' in rule[k] else 2) for k in ('sport', 'dport'))
+        return (protocol, _prefix_len(rule.get('src')), _prefix_len(rule.get('dst')),
+                bool(rule.get('proto'))) + ports
+
+    filters = [(index, rule, protocol) for index, rule in enumerate(rules)
+               for protocol in filter_rule_protocols(rule)]
+    shapes = sorted({shape(rule, protocol) for _, rule, protocol in filters},
+                    key=lambda k: (-(k[1] + k[2]), -(k[3] + k[4] + k[5]), -k[2], k[0]))
+    prio_for = {key: str(prio) for prio, key in enumerate(shapes, start=1)}
+    for index, rule, protocol in filters:
+        match = []
+        if rule.get('src'):
+            match.extend(['src_ip', rule['src']])
+        if rule.get('dst'):
+            match.extend(['dst_ip', rule['dst']])
+        if rule.get('proto'):
+            match.extend(['ip_proto', rule['proto']])
+        if rule.get('sport'):
+            match.extend(['src_port', rule['sport']])
+        if rule.get('dport'):
+            match.extend(['dst_port', rule['dport']])
+        commands.append(['filter', 'add'] + dev + ['parent', '1:', 'protocol', protocol,
+                         'prio', prio_for[shape(rule, protocol)],
+                         'flower'] + match + ['classid', filter_rule_classid(index)])
+    return commands
+
+
+def _cidr_from_tc(value):
+    """flower prints hosts without a prefix ('10.0.0.1') and networks as '10.1.0.0/16'."""
+    import ipaddress
     try:
-        result = subprocess.run(
-            ['sudo', 'tc', 'filter', 'show', 'dev', interface],
-            capture_output=True, text=True
-        )
-        output = result.stdout
-        src, dst = None, None
-        import ipaddress
-        for line in output.splitlines():
-            line = line.strip()
-            # tc filter show outputs: match <hex>/<hex> at <offset>
-            # hex values have no 0x prefix, offset 12 = src, offset 16 = dst
-            m_src = re.search(r'match\s+([0-9a-f]+)/([0-9a-f]+)\s+at\s+12\b', line)
-            m_dst = re.search(r'match\s+([0-9a-f]+)/([0-9a-f]+)\s+at\s+16\b', line)
-            if m_src:
-                ip_int   = int(m_src.group(1), 16)
-                mask_int = int(m_src.group(2), 16)
-                prefix = bin(mask_int).count('1')
-                src = f"{ipaddress.IPv4Address(ip_int)}/{prefix}"
-            if m_dst:
-                ip_int   = int(m_dst.group(1), 16)
-                mask_int = int(m_dst.group(2), 16)
-                prefix = bin(mask_int).count('1')
-                dst = f"{ipaddress.IPv4Address(ip_int)}/{prefix}"
-        return src, dst
+        return str(ipaddress.ip_network(value, strict=False))
+    except ValueError:
+        return None
+
+
+def parse_filter_matches(output):
+    """
+    Parse 'tc filter show' output into a list of {'classid', 'src', 'dst', 'proto',
+    'sport', 'dport'} dicts, in rule order. Rules installed for both IPv4 and IPv6
+    (one flower filter per protocol, same classid) are returned once. Understands
+    flower filters (current) and the single u32 src/dst filter of older releases.
+    """
+    import ipaddress
+    by_classid = {}
+    current = None
+    for raw in output.splitlines():
+        line = raw.strip()
+        if line.startswith('filter '):
+            # Per-prio chain headers carry no classid; each filter line does
+            head = re.search(r'\b(?:classid|flowid)\s+(\S+)', line)
+            current = None
+            if head:
+                current = by_classid.setdefault(head.group(1), {
+                    'classid': head.group(1), 'src': None, 'dst': None,
+                    'proto': None, 'sport': None, 'dport': None})
+            continue
+        if current is None:
+            continue
+        m = re.match(r'(src|dst)_ip\s+(\S+)', line)
+        if m:
+            current[m.group(1)] = _cidr_from_tc(m.group(2))
+        m = re.match(r'ip_proto\s+(\S+)', line)
+        if m:
+            current['proto'] = m.group(1)
+        # "dst_port 4789" / "dst_port 1000-2000"
+        m = re.match(r'(src|dst)_port\s+(\d+(?:-\d+)?)', line)
+        if m:
+            current['sport' if m.group(1) == 'src' else 'dport'] = m.group(2)
+        # u32: "match <hex>/<hex> at 12" (src) / "at 16" (dst)
+        m = re.match(r'match\s+([0-9a-f]+)/([0-9a-f]+)\s+at\s+(12|16)\b', line)
+        if m:
+            prefix = bin(int(m.group(2), 16)).count('1')
+            cidr = f"{ipaddress.IPv4Address(int(m.group(1), 16))}/{prefix}"
+            current['src' if m.group(3) == '12' else 'dst'] = cidr
+    # tc lists filters by prio; classids follow the original rule order
+    matches = [m for m in by_classid.values() if m['src'] or m['dst'] or m['proto']]
+    return sorted(matches, key=lambda m: int(m['classid'].partition(':')[2] or '0', 16))
+
+
+def read_filter_matches(interface):
+    """Run 'tc filter show' on the interface root and parse it (see parse_filter_matches)."""
+    try:
+        cmd = ['sudo', 'tc', 'filter', 'show', 'dev', interface]
+        result = run_cmd(cmd)
+        log_command(cmd, result.stdout)
+        return parse_filter_matches(result.stdout)
     except Exception as e:
         logging.error(f"Error reading tc filters for {interface}: {e}")
+        return []
+
+
+def get_qdisc_filter(interface):
+    """Return (src_cidr, dst_cidr) of the first active filter rule on the interface, or (None, None)."""
+    matches = read_filter_matches(interface)
+    if not matches:
         return None, None
+    return matches[0]['src'], matches[0]['dst']
 
 
-def apply_qdisc_filtered(interface, latency, loss, jitter, src_cidr, dst_cidr):
+def get_qdisc_filter_rules(interface):
     """
-    Apply netem impairments to traffic matching src_cidr and/or dst_cidr only.
-    Uses a PRIO qdisc at root with a u32 filter directing matched traffic to a
-    netem band. Unmatched traffic passes through unimpaired.
-    Bandwidth limiting is not combined with filtered mode.
+    Read back the full filtered rule set: a list of rule dicts (src, dst, latency,
+    jitter, loss, rate) in classification order, plus the aggregate bandwidth cap
+    (None when uncapped). Returns ([], None) when no filtered tree is installed.
+    """
+    matches = read_filter_matches(interface) or read_matrix_ipset(interface)
+    if not matches:
+        return [], None
+    try:
+        qdisc_cmd = ['sudo', 'tc', 'qdisc', 'show', 'dev', interface]
+        class_cmd = ['sudo', 'tc', 'class', 'show', 'dev', interface]
+        qdisc_output = run_cmd(qdisc_cmd).stdout
+        class_output = run_cmd(class_cmd).stdout
+        log_command(qdisc_cmd, qdisc_output)
+        log_command(class_cmd, class_output)
+    except Exception as e:
+        logging.error(f"Error reading filtered tree for {interface}: {e}")
+        return [], None
+
+    # "class htb 1:100 parent 1:1 leaf 1000: prio 0 rate 10Mbit ceil 10Mbit ..."
+    class_rates = dict(re.findall(r'class htb (\S+) [^\n]*?\brate (\S+)', class_output))
+    # "qdisc netem 1000: parent 1:100 limit 1000 delay 50ms 5ms loss 1%"
+    netem_by_parent = {m.group(1): m.group(0)
+                       for m in re.finditer(r'qdisc netem \S+ parent (\S+)[^\n]*', qdisc_output)}
+    aggregate = class_rates.get('1:1')
+    if aggregate and rate_to_bits(aggregate) == rate_to_bits(FILTER_UNLIMITED_RATE):
+        aggregate = None
+
+    rules = []
+    for match in matches:
+        classid = match['classid']
+        if 'htb' not in qdisc_output and 'prio' in qdisc_output:
+            # Legacy PRIO tree: a single netem on band 2 carries the impairment
+            netem = parse_qdisc_state(qdisc_output)
+            rate = None
+        else:
+            netem = parse_qdisc_state(netem_by_parent.get(classid, ''))
+            rate = class_rates.get(classid)
+            if rate and aggregate is None and rate_to_bits(rate) == rate_to_bits(FILTER_UNLIMITED_RATE):
+                rate = None
+            elif rate and aggregate and rate_to_bits(rate) == rate_to_bits(aggregate):
+                rate = None
+        rules.append({'src': match['src'], 'dst': match['dst'], 'proto': match.get('proto'),
+                      'sport': match.get('sport'), 'dport': match.get('dport'),
+                      'latency': netem['latency'], 'jitter': netem['jitter'],
+                      'loss': netem['loss'], 'rate': rate})
+    return rules, aggregate
+
+
+@interface_mutation(merge_replace)
+def apply_qdisc_filtered_rules(interface, rules, bandwidth=None, classifier='flower'):
+    """
+    Replace the interface's egress tree with the filtered HTB tree for rules
+    (normalised rule dicts) and an optional aggregate bandwidth cap, programmed
+    in a single tc batch. Unmatched traffic passes through unimpaired.
+    classifier is 'flower' (tc filters) or 'ipset' (destination-only rules
+    classified by an ipset skbinfo map, see build_matrix_ipset_restore).
     """
     try:
         alias = get_interface_alias(interface)
         display_name = f"{interface} ({alias})" if alias and alias != interface else interface
 
-        has_netem = (latency and latency != '0ms') or (loss and loss != '0%') or (jitter and jitter != '0ms')
-        if not has_netem:
-            flash(f"No impairments specified for {display_name}", "error")
+        if not rules:
+            flash(f"No filter rules specified for {display_name}", "error")
             return
 
-        # Normalise units
-        if latency and not latency.endswith(('ms', 'us')):
-            latency += 'ms'
-        if jitter and not jitter.endswith(('ms', 'us')):
-            jitter += 'ms'
-        if jitter and jitter != '0ms' and (not latency or latency == '0ms'):
-            latency = '1ms'
-
-        # Tear down existing root
-        subprocess.run(['sudo', 'tc', 'qdisc', 'del', 'dev', interface, 'root'],
-                       capture_output=True, text=True)
-
-        errors = []
-        def run_tc(cmd):
-            r = subprocess.run(cmd, capture_output=True, text=True)
-            log_command(cmd, r.stdout)
-            if r.returncode != 0:
-                errors.append(r.stderr.strip())
-            return r.returncode == 0
-
-        # prio: 2 bands — band 1 (1:1) default passthrough, band 2 (1:2) netem
-        run_tc(['sudo', 'tc', 'qdisc', 'add', 'dev', interface,
-                'root', 'handle', '1:', 'prio', 'bands', '2',
-                'priomap', '0', '0', '0', '0', '0', '0', '0', '0',
-                           '0', '0', '0', '0', '0', '0', '0', '0'])
-
-        # netem on band 2
-        netem_cmd = ['sudo', 'tc', 'qdisc', 'add', 'dev', interface,
-                     'parent', '1:2', 'handle', '20:', 'netem']
-        if latency and latency != '0ms':
-            if jitter and jitter != '0ms':
-                netem_cmd.extend(['delay', latency, jitter])
-            else:
-                netem_cmd.extend(['delay', latency])
-        if loss and loss != '0%':
-            netem_cmd.extend(['loss', loss.replace('%', '')])
-        run_tc(netem_cmd)
-
-        # u32 filter(s) — one filter handles both src+dst match if both given
-        if src_cidr and dst_cidr:
-            src_hex, src_mask = cidr_to_u32_mask(src_cidr)
-            dst_hex, dst_mask = cidr_to_u32_mask(dst_cidr)
-            run_tc(['sudo', 'tc', 'filter', 'add', 'dev', interface,
-                    'parent', '1:', 'protocol', 'ip', 'prio', '1', 'u32',
-                    'match', 'ip', 'src', src_cidr,
-                    'match', 'ip', 'dst', dst_cidr,
-                    'flowid', '1:2'])
-        elif src_cidr:
-            run_tc(['sudo', 'tc', 'filter', 'add', 'dev', interface,
-                    'parent', '1:', 'protocol', 'ip', 'prio', '1', 'u32',
-                    'match', 'ip', 'src', src_cidr,
-                    'flowid', '1:2'])
-        elif dst_cidr:
-            run_tc(['sudo', 'tc', 'filter', 'add', 'dev', interface,
-                    'parent', '1:', 'protocol', 'ip', 'prio', '1', 'u32',
-                    'match', 'ip', 'dst', dst_cidr,
-                    'flowid', '1:2'])
-
-        filter_desc = []
-        if src_cidr:
-            filter_desc.append(f"src {src_cidr}")
-        if dst_cidr:
-            filter_desc.append(f"dst {dst_cidr}")
-        filter_str = ', '.join(filter_desc)
-
-        if errors:
+        # Tear down existing root (and any matrix ipset classifier feeding it)
+        run_cmd(['sudo', 'tc', 'qdisc', 'del', 'dev', interface, 'root'])
+        remove_matrix_classifier(interface)
+        invalidate_matrix_index(interface)
+
+        ok, errors = run_tc_batch(build_filtered_commands(interface, rules, bandwidth,
+                                                          with_filters=(classifier != 'ipset')))
+        if ok and classifier == 'ipset':
+            ok, errors = install_matrix_classifier(interface, rules)
+        if not ok:
+            # Don't leave a half-built tree classifying traffic into missing classes
+            run_cmd(['sudo', 'tc', 'qdisc', 'del', 'dev', interface, 'root'])
+            remove_matrix_classifier(interface)
             flash(f"Error applying filtered conditions to {display_name}: {'; '.join(errors)}", "error")
             logging.error(f"tc filter errors on {interface}: {errors}")
+            return
+
+        record_desired_state(interface, 'egress', {'kind': 'filtered', 'rules': rules,
+                                                   'bandwidth': bandwidth, 'classifier': classifier})
+        if len(rules) == 1:
+            summary = f"filter: {describe_filter_match(rules[0])}"
         else:
-            flash(f"Network conditions applied to {display_name} (filter: {filter_str})", "success")
+            summary = f"{len(rules)} filter rules"
+        if bandwidth:
+            summary += f", aggregate {bandwidth}"
+        if classifier == 'ipset':
+            summary += ", ipset classifier"
+        flash(f"Network conditions applied to {display_name} ({summary})", "success")
 
     except Exception as e:
         flash(f"Error applying filtered conditions to {interface}: {str(e)}", "error")
-        logging.error(f"Error in apply_qdisc_filtered for {interface}: {str(e)}")
+        logging.error(f"Error in apply_qdisc_filtered_rules for {interface}: {str(e)}")
+
+
+def apply_qdisc_filtered(interface, latency, loss, jitter, src_cidr, dst_cidr, bandwidth=None,
+                         proto=None, dport=None):
+    """
+    Apply netem impairments (and an optional bandwidth cap on the matched traffic)
+    to traffic matching src_cidr / dst_cidr / proto / dport only — a one-rule
+    filtered tree.
+    """
+    rule, errors = normalise_filter_rule({'src': src_cidr, 'dst': dst_cidr,
+                                          'proto': proto, 'dport': dport,
+                                          'latency': (latency or '').replace('ms', ''),
+                                          'jitter': (jitter or '').replace('ms', ''),
+                                          'loss': (loss or '').replace('%', ''),
+                                          'rate': bandwidth})
+    if errors:
+        alias = get_interface_alias(interface)
+        display_name = f"{interface} ({alias})" if alias and alias != interface else interface
+        flash(f"Error applying filtered conditions to {display_name}: {'; '.join(errors)}", "error")
+        return
+    apply_qdisc_filtered_rules(interface, [rule])
+
+
+# ---------------------------------------------------------------------------
+# Impairment matrix — a destination prefix → (delay, jitter, loss, rate) table
+# compiled into the filtered HTB tree. Classification is either flower (hashed
+# per prefix length) or, when ipset/iptables are present, an ipset hash:net with
+# skbinfo that stamps skb->priority with the rule's classid — HTB picks the
+# class straight from skb->priority without running any tc filter.
+# ---------------------------------------------------------------------------
+
+MATRIX_BACKENDS     = ('auto', 'flower', 'ipset')
+MATRIX_IPSET_PREFIX = 'hwm-'
+MATRIX_CSV_COLUMNS  = ('prefix', 'delay', 'jitter', 'loss', 'rate')
+
+_matrix_indexes = {}            # interface -> PrefixIndex built from the read-back rule set
+_matrix_lock = threading.Lock()
+
+
+class PrefixIndex:
+    """
+    In-process longest-prefix-match table. Prefixes are stored in one dict per
+    (family, prefix length) keyed by the masked network address; a lookup probes
+    only the populated lengths, longest first, so its cost is bounded by the
+    number of distinct prefix lengths rather than the number of prefixes.
+    """
+
+    def __init__(self, entries=()):
+        self._tables = {4: {}, 6: {}}
+        self._lengths = {4: [], 6: []}
+        for prefix, value in entries:
+            self.add(prefix, value)
+
+    def __len__(self):
+        return sum(len(t) for tables in self._tables.values() for t in tables.values())
+
+    def add(self, prefix, value):
+        """Add a prefix; the first value added for a given prefix wins (rule order)."""
+        import ipaddress
+        net = ipaddress.ip_network(prefix, strict=False)
+        tables = self._tables[net.version]
+        if net.prefixlen not in tables:
+            tables[net.prefixlen] = {}
+            self._lengths[net.version] = sorted(tables, reverse=True)
+        tables[net.prefixlen].setdefault(int(net.network_address), (str(net), value))
+
+    def lookup(self, address):
+        """Return (prefix, value) of the longest matching prefix, or None."""
+        import ipaddress
+        addr = ipaddress.ip_address(address)
+        bits, value = addr.max_prefixlen, int(addr)
+        tables = self._tables[addr.version]
+        for length in self._lengths[addr.version]:
+            mask = ((1 << length) - 1) << (bits - length)
+            hit = tables[length].get(value & mask)
+            if hit is not None:
+                return hit
+        return None
+
+
+def parse_matrix_csv(text):
+    """
+    Parse an impairment matrix CSV: prefix,delay,jitter,loss,rate (header row
+    optional, columns may then be in any order; missing cells mean 'none').
+        prefix,delay,jitter,loss,rate
+        10.1.0.0/16,50ms,5ms,1,10mbit
+        10.2.0.0/16,120ms,,,
+    Returns (rules, errors) with rules normalised as filter rules (dst = prefix).
+    """
+    import csv
+    rules, errors = [], []
+    columns = MATRIX_CSV_COLUMNS
+    seen = set()
+    for lineno, row in enumerate(csv.reader((text or '').splitlines()), start=1):
+        cells = [c.strip() for c in row]
+        if not any(cells) or cells[0].startswith('#'):
+            continue
+        if lineno == 1 and cells[0].lower() in ('prefix', 'dst', 'destination', 'cidr'):
+            columns = tuple('prefix' if c.lower() in ('dst', 'destination', 'cidr') else c.lower()
+                            for c in cells)
+            unknown = [c for c in columns if c not in MATRIX_CSV_COLUMNS]
+            if unknown:
+                errors.append(f"Line 1: unknown column(s) {', '.join(unknown)}")
+                return [], errors
+            continue
+        raw = dict(zip(columns, cells))
+        rule, rule_errors = normalise_filter_rule({
+            'dst': raw.get('prefix'),
+            'latency': (raw.get('delay') or '').lower().replace('ms', ''),
+            'jitter': (raw.get('jitter') or '').lower().replace('ms', ''),
+            'loss': raw.get('loss'),
+            'rate': raw.get('rate'),
+        })
+        if not rule_errors and rule['dst'] in seen:
+            rule_errors = [f"duplicate prefix {rule['dst']}"]
+        errors.extend(f"Line {lineno}: {e}" for e in rule_errors)
+        if not rule_errors:
+            seen.add(rule['dst'])
+            rules.append(rule)
+    return rules, errors
+
+
+def matrix_ipset_name(interface):
+    """ipset used by the matrix classifier of an interface (ipset names are <= 31 chars)."""
+    return f"{MATRIX_IPSET_PREFIX}{interface}"
+
+
+def netfilter_cmd_prefix():
+    """Command prefix for iptables/ipset: nsenter into the host netns from a container, else sudo."""
+    if is_running_in_container():
+        return ['nsenter', '--target', '1', '--net']
+    return ['sudo']
+
+
+def is_ipset_available():
+    """ipset matrix classification needs both ipset and iptables (SET target)."""
+    return bool(shutil.which('ipset')) and is_iptables_available()
+
+
+def resolve_matrix_backend(backend, rules=()):
+    """Map 'auto' to 'ipset' when available and every prefix fits an inet hash:net (IPv4 /1../32), else 'flower'."""
+    if backend == 'auto':
+        fits = all(_prefix_len(rule.get('dst')) > 0 and ':' not in rule['dst'] for rule in rules)
+        return 'ipset' if fits and is_ipset_available() else 'flower'
+    return backend
+
+
+def build_matrix_ipset_restore(interface, rules):
+    """'ipset restore' input mapping every rule's dst prefix to its HTB classid."""
+    name = matrix_ipset_name(interface)
+    lines = [f"create {name} hash:net family inet skbinfo -exist", f"flush {name}"]
+    for index, rule in enumerate(rules):
+        lines.append(f"add {name} {rule['dst']} skbprio {filter_rule_classid(index)} -exist")
+    return '\n'.join(lines) + '\n'
+
+
+def matrix_iptables_rule(interface):
+    """mangle/POSTROUTING rule that copies the matched ipset entry's skbprio onto the packet."""
+    return ['POSTROUTING', '-o', interface, '-j', 'SET',
+            '--map-set', matrix_ipset_name(interface), 'dst', '--map-prio']
+
+
+def install_matrix_classifier(interface, rules):
+    """Load the ipset in one 'ipset restore' and hook it into mangle/POSTROUTING. Returns (ok, errors)."""
+    if any(rule.get('src') for rule in rules):
+        return False, ["ipset classifier supports destination-only rules"]
+    if any(_prefix_len(rule.get('dst')) == 0 for rule in rules):
+        return False, ["ipset hash:net cannot hold a /0 prefix — use the flower classifier"]
+    if any(':' in rule['dst'] for rule in rules):
+        return False, ["ipset classifier supports IPv4 prefixes only — use the flower classifier"]
+    prefix = netfilter_cmd_prefix()
+    cmd = prefix + ['ipset', 'restore']
+    batch = build_matrix_ipset_restore(interface, rules)
+    result = run_cmd(cmd, input=batch)
+    log_command(cmd, f"{len(rules)} entries\n{result.stdout}{result.stderr}")
+    if result.returncode != 0:
+        return False, [result.stderr.strip()]
+
+    check = prefix + ['iptables', '-t', 'mangle', '-C'] + matrix_iptables_rule(interface)
+    if run_cmd(check).returncode != 0:
+        cmd = prefix + ['iptables', '-t', 'mangle', '-A'] + matrix_iptables_rule(interface)
+        result = run_cmd(cmd)
+        log_command(cmd, result.stdout + result.stderr)
+        if result.returncode != 0:
+            return False, [result.stderr.strip()]
+    return True, []
+
+
+def remove_matrix_classifier(interface):
+    """Drop the interface's matrix iptables hook and ipset, if present. Silent no-op otherwise."""
+    if not shutil.which('ipset'):
+        return
+    prefix = netfilter_cmd_prefix()
+    name = matrix_ipset_name(interface)
+    if run_cmd(prefix + ['ipset', 'list', '-n', name]).returncode != 0:
+        return
+    for cmd in (prefix + ['iptables', '-t', 'mangle', '-D'] + matrix_iptables_rule(interface),
+                prefix + ['ipset', 'destroy', name]):
+        result = run_cmd(cmd)
+        log_command(cmd, result.stdout + result.stderr)
+
+
+def read_matrix_ipset(interface):
+    """Read the matrix ipset back as filter matches ({'classid', 'src', 'dst'}), [] if absent."""
+    if not shutil.which('ipset'):
+        return []
+    cmd = netfilter_cmd_prefix() + ['ipset', 'save', matrix_ipset_name(interface)]
+    result = run_cmd(cmd)
+    if result.returncode != 0:
+        return []
+    log_command(cmd, result.stdout)
+    # "add hwm-eth0 10.1.0.0/16 skbprio 1:100"
+    matches = [{'classid': classid, 'src': None, 'dst': _cidr_from_tc(prefix),
+                'proto': None, 'sport': None, 'dport': None}
+               for prefix, classid in re.findall(r'^add \S+ (\S+) .*?\bskbprio (\S+)', result.stdout, re.M)]
+    return sorted(matches, key=lambda m: int(m['classid'].partition(':')[2] or '0', 16))
+
+
+def invalidate_matrix_index(interface):
+    with _matrix_lock:
+        _matrix_indexes.pop(interface, None)
+
+
+def get_matrix_index(interface):
+    """
+    Return (rules, PrefixIndex) for the interface's installed destination rules,
+    cached until the tree is changed through HyyperWAN. Rules with a src, protocol
+    or port match are not indexed — a destination alone cannot decide them.
+    """
+    with _matrix_lock:
+        cached = _matrix_indexes.get(interface)
+    if cached:
+        return cached
+    rules, _ = get_qdisc_filter_rules(interface)
+    index = PrefixIndex((rule['dst'], position) for position, rule in enumerate(rules)
+                        if rule['dst'] and not (rule['src'] or rule['proto']))
+    with _matrix_lock:
+        _matrix_indexes[interface] = (rules, index)
+    return rules, index
 
 
 def split_bandwidth(bandwidth_str):
@@ -418,108 +1652,814 @@ def split_bandwidth(bandwidth_str):
     return bandwidth_str, 'mbit'
 
 
-def compute_tbf_burst(bandwidth_str):
-    """Calculate an appropriate TBF burst size for a given bandwidth string like '10mbit'."""
-    match = re.match(r'^(\d+(?:\.\d+)?)(kbit|mbit|gbit)$', bandwidth_str.lower())
-    if not match:
-        return '32kbit'
+RATE_MULTIPLIERS = {'bit': 1, 'kbit': 1_000, 'mbit': 1_000_000, 'gbit': 1_000_000_000, 'tbit': 1_000_000_000_000}
 
-    val = float(match.group(1))
-    unit = match.group(2)
-    multipliers = {'kbit': 1_000, 'mbit': 1_000_000, 'gbit': 1_000_000_000}
-    bits = val * multipliers[unit]
 
-    # burst >= rate/HZ; HZ is typically 250-1000; use rate/250 with 4KB minimum
-    burst_bytes = max(int(bits / 250 / 8), 4096)
+def rate_to_bits(rate_str):
+    """Convert a tc rate string ('10mbit', '625Kbit', '1Gbit') to bits/sec. Returns None if unparseable."""
+    if not rate_str:
+        return None
+    m = re.match(r'^(\d+(?:\.\d+)?)\s*(bit|kbit|mbit|gbit|tbit)?$', rate_str.strip(), re.IGNORECASE)
+    if not m:
+        return None
+    return float(m.group(1)) * RATE_MULTIPLIERS[(m.group(2) or 'bit').lower()]
 
-    if burst_bytes >= 1_048_576:
-        return f"{int(burst_bytes / 1_048_576)}mb"
-    elif burst_bytes >= 1024:
-        return f"{int(burst_bytes / 1024)}kb"
-    return f"{burst_bytes}b"
 
+def format_rate_bits(bits):
+    """Format bits/sec as the largest whole tc unit, e.g. 10_000_000 -> '10mbit', 62_500 -> '62kbit'."""
+    bits = int(bits)
+    for unit in ('gbit', 'mbit', 'kbit'):
+        mult = RATE_MULTIPLIERS[unit]
+        if bits >= mult and bits % mult == 0:
+            return f"{bits // mult}{unit}"
+    if bits >= 1_000:
+        return f"{bits // 1_000}kbit"
+    return f"{max(bits, 1)}bit"
 
 
-def list_interfaces():
-    interfaces = []
+# ---------------------------------------------------------------------------
+# Queue sizing — netem's packet limit, the HTB burst/cburst and the TBF burst
+# and queue are derived from the bandwidth-delay product and the MTU rather
+# than left at fixed values (netem's default of 1000 packets overflows at
+# 1 Gbit with 300 ms of delay, and drops packets nobody asked to lose):
+#   netem limit  1.5 x rate x time in netem / MTU, at least 1000 packets; the
+#                time is delay + jitter, plus the queue time when a shaper
+#                (netem rate, HTB class, TBF parent) backs packets up into it
+#   burst        rate x 4 ms (the old rate/250), at least 2 MTU and 4 KB
+#   TBF queue    the queue time, at least 16 MTU at the shaped rate
+# rate is the shaped rate, or for unshaped netem the link speed (falling back
+# to SIZING_LINE_RATE when the driver reports none, e.g. veth). The admin
+# settings netem_limit (packets) and shaper_burst (bytes) override the
+# computed values (0 = automatic); shaper_queue_ms is the queue time.
+#   SIZING_LINE_RATE  rate assumed for unshaped netem when the link speed is unknown (default 10gbit)
+# ---------------------------------------------------------------------------
+
+SIZING_LINE_RATE = os.environ.get('SIZING_LINE_RATE', '10gbit')
+SIZING_BURST_SECONDS = 0.004
+SIZING_HEADROOM = 1.5
+NETEM_DEFAULT_LIMIT = 1000
+DEFAULT_MTU = 1500
+
+
+def read_link_attr(interface, attr):
+    """Integer from /sys/class/net/<iface>/<attr>, or None — quietly, unlike get_mtu (veths have no speed)."""
     try:
-        result = subprocess.run(['ip', '-j', 'addr'], capture_output=True, text=True)
-        output = result.stdout
-        log_command(['ip', '-j', 'addr'], output)
-        
-        # Load interface aliases; build ignored set (always include 'lo')
-        aliases = load_interface_aliases()
-        cfg = load_admin_config()
-        ignored_interfaces_set = set(cfg.get('hidden_interfaces', IGNORED_INTERFACES) + ['lo'])
-        
-        try:
-            data = json.loads(output)
-            
-            for interface in data:
-                interface_name = interface['ifname']
-                # Skip ignored interfaces
-                if interface_name in ignored_interfaces_set:
-                    logging.info(f"Skipping ignored interface: {interface_name}")
-                    continue
-                
-                ip_address = None
-                for addr_info in interface.get('addr_info', []):
-                    if addr_info['family'] == 'inet':
-                        ip_address = addr_info['local']
-                        break
-                try:
-                    # Get current network condition settings
-                    latency, loss, jitter, bandwidth = get_qdisc_settings(interface_name)
-                    src_filter, dst_filter = get_qdisc_filter(interface_name)
-                    nat_status = get_nat_status(interface_name)
-                    bw_value, bw_unit = split_bandwidth(bandwidth)
-                    link_state = get_link_state(interface_name)
-                    interfaces.append({
-                        'name': interface_name,
-                        'alias': aliases.get(interface_name, ''),
-                        'ip': ip_address or '',
-                        'latency': latency,
-                        'loss': loss,
-                        'jitter': jitter,
-                        'bandwidth': bandwidth,
-                        'bw_value': bw_value,
-                        'bw_unit': bw_unit,
-                        'nat_status': nat_status,
-                        'src_filter': src_filter,
-                        'dst_filter': dst_filter,
-                        'link_state': link_state,
-                    })
-                except Exception as e:
-                    logging.error(f"Error getting settings for interface {interface_name}: {str(e)}")
-                    interfaces.append({
-                        'name': interface_name,
-                        'alias': aliases.get(interface_name, ''),
-                        'ip': ip_address or '',
-                        'latency': '0ms',
-                        'loss': '0%',
-                        'jitter': '0ms',
-                        'bandwidth': None,
-                        'bw_value': '',
-                        'bw_unit': 'mbit',
-                        'nat_status': False,
-                        'src_filter': None,
-                        'dst_filter': None,
-                        'link_state': get_link_state(interface_name),
-                    })
-        
-        except json.JSONDecodeError as e:
-            logging.error(f"Error parsing JSON output from ip command: {str(e)}")
-            flash("Error retrieving network interfaces", "error")
-    
-    except Exception as e:
+        with open(f'/sys/class/net/{interface}/{attr}') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def queue_sizing(interface=None, cfg=None):
+    """
+    Inputs of the queue sizing for trees on interface: {'mtu', 'line_rate'
+    (bits/s), 'limit' (netem packets), 'burst' (bytes), 'queue' (seconds)};
+    limit and burst are 0 when computed. interface None gives the defaults.
+    """
+    cfg = cfg if cfg is not None else load_admin_config()
+    mtu = speed = None
+    if interface and current_netns():
+        link = netns_link(interface)
+        mtu = link['mtu'] if link else None
+    elif interface:
+        mtu = read_link_attr(interface, 'mtu')
+        speed = read_link_attr(interface, 'speed')  # Mbit/s, -1 when unknown
+    return {
+        'mtu': mtu or DEFAULT_MTU,
+        'line_rate': speed * 1_000_000 if speed and speed > 0 else rate_to_bits(SIZING_LINE_RATE) or 10_000_000_000,
+        'limit': max(0, int(cfg.get('netem_limit') or 0)),
+        'burst': max(0, int(cfg.get('shaper_burst') or 0)),
+        'queue': max(1, int(cfg.get('shaper_queue_ms') or 100)) / 1000,
+    }
+
+
+def shaper_burst(rate_bits, sizing):
+    """HTB burst/cburst and TBF burst for a rate, as a tc size ('12500000b')."""
+    burst = sizing['burst'] or max(int(rate_bits * SIZING_BURST_SECONDS / 8), 2 * sizing['mtu'], 4096)
+    return f"{burst}b"
+
+
+def tbf_latency(rate_bits, sizing):
+    """TBF queue as a latency ('100ms'): the queue time, but room for at least 16 MTU."""
+    floor = 16 * sizing['mtu'] * 8 / rate_bits
+    return f"{math.ceil(round(max(sizing['queue'], floor) * 1000, 6))}ms"
+
+
+def netem_limit(rate_bits, seconds, sizing):
+    """netem limit in packets for traffic at rate_bits held for seconds (see the section comment)."""
+    if sizing['limit']:
+        return sizing['limit']
+    packets = SIZING_HEADROOM * rate_bits * seconds / 8 / sizing['mtu']
+    return max(NETEM_DEFAULT_LIMIT, math.ceil(packets))
+
+
+def netem_hold_seconds(latency, jitter, shaped, sizing):
+    """Time a packet spends in netem: delay + jitter, plus the queue time behind a shaper."""
+    seconds = time_to_seconds(latency or '') + time_to_seconds(jitter or '')
+    return seconds + sizing['queue'] if shaped else seconds
+
+
+# Shaping modes used when bandwidth and netem impairments are combined:
+#   htb   — HTB root class carrying the rate, netem leaf (two qdiscs per packet);
+#           TBF when there is bandwidth only
+#   netem — netem's own rate/slot parameters in a single root qdisc; avoids
+#           the HTB global lock and the second enqueue at multi-Gbit rates
+#   cake  — cake's shaper (bandwidth, besteffort), behind a netem root for
+#           latency/jitter/loss
+# cake dequeues without a global token-bucket lock and holds 10+ Gbit caps
+# where TBF and HTB run out of CPU. fq is not offered: its maxrate caps each
+# flow, not the interface, and the bandwidth setting is an aggregate cap. With
+# no mode chosen (None / 'auto'), caps at or above the admin
+# fast_shaping_threshold use fast_shaping_mode.
+#   FAST_SHAPING_MODE       mode picked automatically for high caps: cake or '' for none (default cake)
+#   FAST_SHAPING_THRESHOLD  cap from which it is picked (default 10gbit)
+SHAPING_MODES = ('htb', 'netem', 'cake')
+FAST_SHAPING_MODES = ('cake',)
+DEFAULT_SHAPING_MODE = 'htb'
+
+
+def fast_shaping_mode_for(bandwidth, cfg):
+    """The admin fast shaping mode if bandwidth reaches the admin threshold, else None."""
+    mode = cfg.get('fast_shaping_mode') or ''
+    threshold = rate_to_bits(cfg.get('fast_shaping_threshold') or '')
+    if mode in FAST_SHAPING_MODES and threshold and bandwidth and (rate_to_bits(bandwidth) or 0) >= threshold:
+        return mode
+    return None
+
+
+def is_impairment_root(kind, handle):
+    """
+    True for a root qdisc that is an impairment tree (HyyperWAN's or another
+    tool's) rather than a kernel default: fq, cake and mq are only counted
+    with a handle of their own, as default_qdisc installs them at handle 0:.
+    """
+    if kind in ('netem', 'htb', 'tbf', 'prio'):
+        return True
+    return kind in ('mq', 'fq', 'cake') and handle != '0:'
+
+
+def get_tx_queue_count(interface):
+    """Return the number of TX queues of an interface from /sys/class/net/<iface>/queues (1 on error)."""
+    if current_netns():
+        link = netns_link(interface)
+        return link['tx_queues'] if link else 1
+    try:
+        queues = os.listdir(f'/sys/class/net/{interface}/queues')
+        return max(1, sum(1 for q in queues if q.startswith('tx-')))
+    except Exception as e:
+        logging.error(f"Error reading TX queue count for {interface}: {e}")
+        return 1
+
+
+def mq_child_handle(queue):
+    """Handle major for the per-queue child qdisc under an mq root (queue is 1-based)."""
+    return f"{0x100 + queue:x}:"
+
+
+def mq_queue_rates(bandwidth, queues):
+    """
+    Split a bandwidth cap over queues mq children, as tc rate strings. The split
+    is in whole kbit (the kernel keeps rates in bytes/s and tc prints them in
+    kbit) with the remainder spread over the first queues, so the children add
+    up to exactly the cap: 1gbit on 3 queues is 333334kbit + 2 x 333333kbit.
+    """
+    total = rate_to_bits(bandwidth)
+    unit = 1_000 if total % 1_000 == 0 else 8
+    share, rest = divmod(total // unit, queues)
+    rates = []
+    for index in range(queues):
+        bits = max((share + (index < rest)) * unit, 1_000)
+        rates.append(format_rate_bits(bits) if bits % 1_000 == 0 else f"{bits}bit")
+    return rates
+
+
+def has_custom_qdisc(qdisc_output):
+    """
+    True if 'tc qdisc show' output has a tree installed by HyyperWAN (or any
+    impairment qdisc) at root. Only root lines count: a kernel default such as
+    'pfifo_fast ... priomap' is not a tree.
+    """
+    return any(is_impairment_root(kind, handle) for kind, handle
+               in re.findall(r'^qdisc (\S+) (\S+) (?:dev \S+ )?root', qdisc_output, re.MULTILINE))
+
+
+def run_tc_batch(commands):
+    """
+    Run many tc commands in a single 'tc -force -batch -' exec.
+    commands is a list of argument lists (without the leading 'tc').
+    Returns (success, errors) where errors is a list of stderr lines.
+    """
+    if not commands:
+        return True, []
+    batch = '\n'.join(' '.join(cmd) for cmd in commands) + '\n'
+    cmd = ['sudo', 'tc', '-force', '-batch', '-']
+    result = run_cmd(cmd, input=batch)
+    log_command(cmd, f"{len(commands)} commands\n{batch}{result.stdout}{result.stderr}")
+    # Kernel extack warnings (e.g. "Warning: sch_htb: quantum of class ... is big") are not failures
+    errors = [line.strip() for line in result.stderr.splitlines()
+              if line.strip() and not line.strip().startswith('Warning:')]
+    return result.returncode == 0 and not errors, errors
+
+
+def build_netem_args(latency, jitter, loss, rate=None, slot=None, limit=None):
+    """Return the netem parameter list (after the 'netem' keyword) for the given settings."""
+    args = ['limit', str(limit)] if limit else []
+    if latency and latency != '0ms':
+        if jitter and jitter != '0ms':
+            args.extend(['delay', latency, jitter])
+        else:
+            args.extend(['delay', latency])
+    if loss and loss != '0%':
+        args.extend(['loss', loss.replace('%', '')])
+    if rate:
+        args.extend(['rate', rate])
+    if slot:
+        args.extend(['slot'] + slot.split())
+    return args
+
+
+def build_interface_row(entry, aliases, with_state=True):
+    """
+    Index table row for one 'ip -j addr' entry. Without with_state only the
+    cheap part (name, alias, IPv4 address, link state) is filled in and the
+    row is marked pending; its tc/NAT state is loaded separately.
+    """
+    interface_name = entry['ifname']
+    ip_address = None
+    for addr_info in entry.get('addr_info', []):
+        if addr_info['family'] == 'inet':
+            ip_address = addr_info['local']
+            break
+    row = {'name': interface_name, 'alias': aliases.get(interface_name, ''), 'ip': ip_address or ''}
+    if not with_state:
+        return dict(row, link_state=get_link_state(interface_name), pending=True)
+    try:
+        # Current network condition settings (cached while the netlink monitor runs)
+        return dict(get_interface_state(interface_name), **row, link_state=get_link_state(interface_name))
+    except Exception as e:
+        logging.error(f"Error getting settings for interface {interface_name}: {str(e)}")
+        return dict(row, **{
+            'latency': '0ms',
+            'loss': '0%',
+            'jitter': '0ms',
+            'bandwidth': None,
+            'bw_value': '',
+            'bw_unit': 'mbit',
+            'nat_status': False,
+            'src_filter': None,
+            'dst_filter': None,
+            'link_state': get_link_state(interface_name),
+            'ingress': None,
+        })
+
+
+def list_interfaces(with_state=True):
+    """Rows for every visible interface; with_state=False skips the tc/NAT part (see build_interface_row)."""
+    interfaces = []
+    try:
+        result = run_cmd(['ip', '-j', 'addr'])
+        output = result.stdout
+        log_command(['ip', '-j', 'addr'], output)
+        
+        # Load interface aliases; build ignored set (always include 'lo')
+        aliases = load_interface_aliases()
+        cfg = load_admin_config()
+        ignored_interfaces_set = set(cfg.get('hidden_interfaces', IGNORED_INTERFACES) + ['lo'])
+        
+        try:
+            data = json.loads(output)
+            
+            for interface in data:
+                interface_name = interface['ifname']
+                # Skip ignored interfaces and HyyperWAN-managed IFB devices
+                if interface_name in ignored_interfaces_set or is_managed_ifb(interface_name):
+                    logging.info(f"Skipping ignored interface: {interface_name}")
+                    continue
+                interfaces.append(build_interface_row(interface, aliases, with_state))
+        
+        except json.JSONDecodeError as e:
+            logging.error(f"Error parsing JSON output from ip command: {str(e)}")
+            flash("Error retrieving network interfaces", "error")
+    
+    except Exception as e:
         logging.error(f"Error listing interfaces: {str(e)}")
         flash("Error retrieving network interfaces", "error")
     
     return interfaces
 
+# ---------------------------------------------------------------------------
+# Interface state cache + rtnetlink monitor
+#   The tc/NAT part of each interface row is cached per interface. A monitor
+#   thread subscribed to the rtnetlink link, address, route and tc multicast
+#   groups drops exactly the affected interface's entry (an event on an IFB
+#   device counts for the interface it carries ingress traffic for) and pushes
+#   the change to browsers over /events. Without the monitor nothing is cached.
+#   NETLINK_MONITOR=false disables it; STATE_CACHE_TTL bounds the age of an
+#   entry for changes that raise no rtnetlink event (iptables NAT rules).
+# ---------------------------------------------------------------------------
+NETLINK_MONITOR = os.environ.get('NETLINK_MONITOR', 'true').lower() == 'true'
+STATE_CACHE_TTL = float(os.environ.get('STATE_CACHE_TTL', '60'))
+
+RTMGRP_LINK, RTMGRP_TC = 0x1, 0x8
+RTMGRP_IPV4_IFADDR, RTMGRP_IPV4_ROUTE = 0x10, 0x40
+RTMGRP_IPV6_IFADDR, RTMGRP_IPV6_ROUTE = 0x100, 0x400
+# nlmsg type -> event kind (RTM_NEW/DEL LINK, ADDR, ROUTE, QDISC, TCLASS, TFILTER)
+RTM_EVENT_KINDS = {16: 'link', 17: 'link', 20: 'addr', 21: 'addr', 24: 'route', 25: 'route',
+                   36: 'tc', 37: 'tc', 40: 'tc', 41: 'tc', 44: 'tc', 45: 'tc'}
+RTM_DELLINK = 17
+IFLA_IFNAME, RTA_OIF = 3, 4
+
+_state_cache = {}
+_state_cache_lock = threading.Lock()
+_state_generation = 0  # bumped on every invalidation; part of the index page ETag
+_monitor_active = threading.Event()
+_event_subscribers = []
+_event_lock = threading.Lock()
+
+
+def collect_interface_state(interface):
+    """The tc/NAT part of an interface row (impairments, filters, ingress, NAT)."""
+    latency, loss, jitter, bandwidth = get_qdisc_settings(interface)
+    filter_matches = read_filter_matches(interface)
+    bw_value, bw_unit = split_bandwidth(bandwidth)
+    return {
+        'latency': latency,
+        'loss': loss,
+        'jitter': jitter,
+        'bandwidth': bandwidth,
+        'bw_value': bw_value,
+        'bw_unit': bw_unit,
+        'nat_status': get_nat_status(interface),
+        'src_filter': filter_matches[0]['src'] if filter_matches else None,
+        'dst_filter': filter_matches[0]['dst'] if filter_matches else None,
+        'filter_rules': len(filter_matches),
+        'filter_desc': describe_filter_match(filter_matches[0]) if filter_matches else '',
+        'ingress': get_ingress_state(interface),
+    }
+
+
+def get_interface_state(interface):
+    """collect_interface_state(), served from the cache while the netlink monitor keeps it fresh."""
+    if not _monitor_active.is_set() or current_netns():  # the monitor only watches the host namespace
+        return collect_interface_state(interface)
+    now = time.monotonic()
+    with _state_cache_lock:
+        cached = _state_cache.get(interface)
+    if cached and now - cached[0] < STATE_CACHE_TTL:
+        return dict(cached[1])
+    state = collect_interface_state(interface)
+    with _state_cache_lock:
+        _state_cache[interface] = (now, state)
+    return dict(state)
+
+
+def bump_state_generation():
+    """Mark the host state as changed without dropping a cached row (a route with no interface)."""
+    global _state_generation
+    with _state_cache_lock:
+        _state_generation += 1
+
+
+def invalidate_interface_state(interface=None):
+    """Drop the cached state of one interface (or of all when interface is None)."""
+    global _state_generation
+    with _state_cache_lock:
+        _state_generation += 1
+        if interface is None:
+            _state_cache.clear()
+        else:
+            _state_cache.pop(interface, None)
+
+
+def subscribe_events():
+    q = queue.Queue(maxsize=100)
+    with _event_lock:
+        _event_subscribers.append(q)
+    return q
+
+
+def unsubscribe_events(q):
+    with _event_lock:
+        if q in _event_subscribers:
+            _event_subscribers.remove(q)
+
+
+def publish_event(event):
+    """Push an event dict to every /events subscriber (slow clients just miss events)."""
+    with _event_lock:
+        subscribers = list(_event_subscribers)
+    for q in subscribers:
+        try:
+            q.put_nowait(event)
+        except queue.Full:
+            pass
+
+
+def _rtattrs(data, offset, end):
+    """Yield (type, payload) of the rtattrs in data[offset:end]."""
+    while offset + 4 <= end:
+        length, rta_type = struct.unpack_from('=HH', data, offset)
+        if length < 4:
+            break
+        yield rta_type & 0x3fff, data[offset + 4:offset + length]
+        offset += (length + 3) & ~3
+
+
+def parse_rtnetlink_events(data):
+    """
+    Parse one rtnetlink datagram into (kind, ifindex, ifname or None, deleted)
+    tuples; ifname is only known for link messages.
+    """
+    events = []
+    offset = 0
+    while offset + 16 <= len(data):
+        length, msg_type = struct.unpack_from('=IH', data, offset)
+        if length < 16 or offset + length > len(data):
+            break
+        body, end = offset + 16, offset + length
+        kind = RTM_EVENT_KINDS.get(msg_type)
+        ifindex, ifname = None, None
+        if kind == 'link' and end - body >= 16:
+            ifindex = struct.unpack_from('=i', data, body + 4)[0]
+            for rta_type, payload in _rtattrs(data, body + 16, end):
+                if rta_type == IFLA_IFNAME:
+                    ifname = payload.split(b'\0', 1)[0].decode(errors='replace')
+        elif kind == 'addr' and end - body >= 8:
+            ifindex = struct.unpack_from('=I', data, body + 4)[0]
+        elif kind == 'route' and end - body >= 12:
+            for rta_type, payload in _rtattrs(data, body + 12, end):
+                if rta_type == RTA_OIF and len(payload) >= 4:
+                    ifindex = struct.unpack_from('=i', payload)[0]
+        elif kind == 'tc' and end - body >= 8:
+            ifindex = struct.unpack_from('=i', data, body + 4)[0]
+        if kind and ifindex:
+            events.append((kind, ifindex, ifname, msg_type == RTM_DELLINK))
+        offset += (length + 3) & ~3
+    return events
+
+
+def _ifindex_name(ifindex, names):
+    """Interface name for an ifindex: from link messages seen so far, else the kernel."""
+    if ifindex not in names:
+        try:
+            names[ifindex] = socket.if_indextoname(ifindex)
+        except OSError:
+            return None
+    return names[ifindex]
+
+
+def netlink_monitor():
+    """
+    Background loop: read rtnetlink notifications, coalesce them for 100 ms, then
+    invalidate the affected interfaces and publish one /events message.
+    """
+    groups = (RTMGRP_LINK | RTMGRP_TC | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE
+              | RTMGRP_IPV6_IFADDR | RTMGRP_IPV6_ROUTE)
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        sock.bind((0, groups))
+    except OSError as e:
+        logging.error(f"Netlink monitor unavailable, interface state will not be cached: {e}")
+        return
+    logging.info("Netlink monitor started")
+    invalidate_interface_state()
+    _monitor_active.set()
+    names = {}
+    while True:
+        changed, kinds, removed = set(), set(), set()
+        deadline = None
+        while deadline is None or time.monotonic() < deadline:
+            sock.settimeout(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            try:
+                data = sock.recv(1 << 16)
+            except socket.timeout:
+                break
+            except OSError as e:
+                # ENOBUFS: notifications were lost, so anything may have changed
+                logging.warning(f"Netlink monitor overrun ({e}); dropping all cached state")
+                invalidate_interface_state()
+                changed.add('*')
+                deadline = deadline or time.monotonic() + 0.1
+                continue
+            for kind, ifindex, ifname, deleted in parse_rtnetlink_events(data):
+                if ifname:
+                    names[ifindex] = ifname
+                name = _ifindex_name(ifindex, names)
+                if name and is_managed_ifb(name):
+                    # Ingress IFB hwifb<N> carries interface N's ingress impairments
+                    name = _ifindex_name(int(name[len(IFB_PREFIX):]), names)
+                if not name:
+                    if kind == 'route':  # blackhole/unreachable routes have no interface but show on /routes
+                        bump_state_generation()
+                    continue
+                changed.add(name)
+                kinds.add(kind)
+                if deleted:
+                    removed.add(name)
+                    names.pop(ifindex, None)
+            if changed and deadline is None:
+                deadline = time.monotonic() + 0.1
+        for name in changed:
+            invalidate_interface_state(None if name == '*' else name)
+        if changed:
+            publish_event({'interfaces': sorted(changed - {'*'}), 'kinds': sorted(kinds),
+                           'removed': sorted(removed), 'all': '*' in changed})
+
+
+# ---------------------------------------------------------------------------
+# Network namespaces — every interface, tc, route and NAT operation can target
+# a named namespace (created with 'ip netns add', listed in NETNS_DIR) instead
+# of the one HyyperWAN runs in. Requests select it with ?netns=<name> (or a
+# form field of that name); it is held per thread for the rest of the request
+# and applied at a single choke point: run_cmd/stream_cmd/spawn_cmd turn ip and
+# tc into 'ip -n <name>' / 'tc -n <name>' and wrap iptables(-restore), ipset and tcpdump
+# in 'ip netns exec <name>'. The link reads served from /sys and /proc for the
+# host namespace (existence, flags, operstate, MTU, queues, counters) go to one
+# long-lived rtnetlink socket per namespace instead, opened once inside the
+# namespace with setns() and cached, so they cost no exec at all. Impairments
+# in named namespaces are not persisted: the namespaces do not survive a
+# reboot either.
+# ---------------------------------------------------------------------------
+
+NETNS_DIR = os.environ.get('NETNS_DIR', '/var/run/netns')
+NETNS_NAME_RE = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+NETNS_EXEC_COMMANDS = ('iptables', 'ip6tables', 'iptables-restore', 'ip6tables-restore', 'ipset', 'tcpdump')
+HOST_NETNS_PREFIX = ['nsenter', '--target', '1', '--net']
+CLONE_NEWNET = 0x40000000
+
+RTM_NEWLINK, RTM_GETLINK = 16, 18
+NLMSG_ERROR, NLMSG_DONE = 2, 3
+NLM_F_REQUEST, NLM_F_DUMP = 0x1, 0x300
+IFLA_MTU, IFLA_OPERSTATE, IFLA_STATS64 = 4, 16, 23
+IFLA_NUM_TX_QUEUES, IFLA_NUM_RX_QUEUES = 31, 32
+IF_OPERSTATES = ('unknown', 'notpresent', 'down', 'lowerlayerdown', 'testing', 'dormant', 'up')
+
+_netns_local = threading.local()
+_netns_sockets = {}  # name -> {'sock', 'lock', 'key': (st_dev, st_ino), 'seq'}
+_netns_sockets_lock = threading.Lock()
+
+
+def list_netns():
+    """Sorted names of the named network namespaces (empty when there are none)."""
+    try:
+        return sorted(name for name in os.listdir(NETNS_DIR) if NETNS_NAME_RE.match(name))
+    except OSError:
+        return []
+
+
+def is_valid_netns(name):
+    return bool(NETNS_NAME_RE.match(name)) and os.path.exists(os.path.join(NETNS_DIR, name))
+
+
+def current_netns():
+    """Namespace the current thread operates on ('' = the one HyyperWAN runs in)."""
+    return getattr(_netns_local, 'name', '')
+
+
+@contextlib.contextmanager
+def in_netns(name):
+    """Run the enclosed block against namespace name ('' for the host)."""
+    previous = current_netns()
+    _netns_local.name = name or ''
+    try:
+        yield
+    finally:
+        _netns_local.name = previous
+
+
+def netns_command(cmd, netns=None):
+    """
+    Rewrite cmd to run in netns (default: the current thread's namespace):
+    'sudo tc qdisc ...' -> 'sudo tc -n <ns> qdisc ...', 'sudo iptables ...' ->
+    'sudo ip netns exec <ns> iptables ...'. The container nsenter prefix is
+    replaced by sudo since the named namespace is entered directly. Anything
+    else (which, ...) is returned unchanged.
+    """
+    netns = current_netns() if netns is None else netns
+    if not netns:
+        return cmd
+    prefix, rest = [], list(cmd)
+    if rest[:4] == HOST_NETNS_PREFIX:
+        prefix, rest = ['sudo'], rest[4:]
+    elif rest[:1] == ['sudo']:
+        prefix, rest = ['sudo'], rest[1:]
+    if rest[:1] in (['ip'], ['tc']):
+        return prefix + [rest[0], '-n', netns] + rest[1:]
+    if rest and rest[0] in NETNS_EXEC_COMMANDS:
+        return prefix + ['ip', 'netns', 'exec', netns] + rest
+    return list(cmd)
+
+
+@app.before_request
+def select_request_netns():
+    """Point this request's commands at ?netns=<name>; an unknown name is refused, never the host."""
+    netns = request.values.get('netns', '').strip()
+    if not netns:
+        return None
+    if not is_valid_netns(netns):
+        message = f"Unknown network namespace: {netns}"
+        if request.is_json or request.path.startswith('/api/'):
+            return jsonify({'success': False, 'error': message}), 404
+        flash(message, 'error')
+        return redirect(url_for('index', netns=''))
+    _netns_local.name = netns
+    return None
+
+
+@app.teardown_request
+def reset_request_netns(exc=None):
+    _netns_local.name = ''
+
+
+@app.url_defaults
+def add_netns_to_urls(endpoint, values):
+    """Links built while serving a namespace stay in it; netns='' means the host."""
+    if endpoint == 'static':
+        return
+    if 'netns' not in values and current_netns():
+        values['netns'] = current_netns()
+    elif 'netns' in values and not values['netns']:
+        values.pop('netns')
+
+
+def _setns(path):
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if libc.setns(fd, CLONE_NEWNET) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+    finally:
+        os.close(fd)
+
+
+def _open_netns_socket(name):
+    """
+    rtnetlink socket living in namespace name. setns() only moves the calling
+    thread, so a throw-away thread enters the namespace and creates the socket,
+    which stays bound to that namespace after the thread exits.
+    """
+    holder = {}
+
+    def opener():
+        try:
+            _setns(os.path.join(NETNS_DIR, name))
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0)  # NETLINK_ROUTE
+            sock.settimeout(2.0)
+            sock.bind((0, 0))
+            holder['sock'] = sock
+        except OSError as e:
+            holder['error'] = e
+
+    thread = threading.Thread(target=opener, name=f'netns-{name}')
+    thread.start()
+    thread.join()
+    if 'error' in holder:
+        raise holder['error']
+    return holder['sock']
+
+
+def _netns_socket(name):
+    """Cached socket entry of namespace name, reopened when the namespace was recreated."""
+    st = os.stat(os.path.join(NETNS_DIR, name))
+    key = (st.st_dev, st.st_ino)
+    with _netns_sockets_lock:
+        entry = _netns_sockets.get(name)
+        if entry and entry['key'] != key:
+            entry['sock'].close()
+            entry = None
+        if entry is None:
+            entry = _netns_sockets[name] = {'sock': _open_netns_socket(name), 'lock': threading.Lock(),
+                                            'key': key, 'seq': 0}
+    return entry
+
+
+def _drop_netns_socket(name):
+    with _netns_sockets_lock:
+        entry = _netns_sockets.pop(name, None)
+    if entry:
+        entry['sock'].close()
+
+
+def parse_link_message(data, offset, end):
+    """Parse one RTM_NEWLINK body (ifinfomsg + attributes) into a link dict."""
+    ifindex, flags = struct.unpack_from('=iI', data, offset + 4)
+    link = {'ifindex': ifindex, 'flags': flags, 'name': None, 'mtu': None, 'operstate': 'unknown',
+            'tx_queues': 1, 'rx_queues': 1, 'rx_bytes': None, 'tx_bytes': None}
+    for rta_type, payload in _rtattrs(data, offset + 16, end):
+        if rta_type == IFLA_IFNAME:
+            link['name'] = payload.split(b'\0', 1)[0].decode(errors='replace')
+        elif rta_type == IFLA_MTU and len(payload) >= 4:
+            link['mtu'] = struct.unpack_from('=I', payload)[0]
+        elif rta_type == IFLA_OPERSTATE and payload:
+            link['operstate'] = IF_OPERSTATES[payload[0]] if payload[0] < len(IF_OPERSTATES) else 'unknown'
+        elif rta_type == IFLA_STATS64 and len(payload) >= 32:
+            # rtnl_link_stats64 starts rx_packets, tx_packets, rx_bytes, tx_bytes
+            link['rx_bytes'], link['tx_bytes'] = struct.unpack_from('=QQ', payload, 16)
+        elif rta_type == IFLA_NUM_TX_QUEUES and len(payload) >= 4:
+            link['tx_queues'] = max(1, struct.unpack_from('=I', payload)[0])
+        elif rta_type == IFLA_NUM_RX_QUEUES and len(payload) >= 4:
+            link['rx_queues'] = max(1, struct.unpack_from('=I', payload)[0])
+    return link
+
+
+def netns_links(name, interface=None):
+    """
+    RTM_GETLINK over the cached socket of namespace name: {ifname: link} for
+    every link, or for interface alone ({} when it does not exist there).
+    """
+    entry = _netns_socket(name)
+    flags = NLM_F_REQUEST
+    attrs = b''
+    if interface:
+        ifname = interface.encode() + b'\0'
+        attrs = struct.pack('=HH', 4 + len(ifname), IFLA_IFNAME) + ifname
+        attrs += b'\0' * (-len(attrs) % 4)
+    else:
+        flags |= NLM_F_DUMP
+    body = struct.pack('=BxHiII', socket.AF_UNSPEC, 0, 0, 0, 0) + attrs
+    links = {}
+    with entry['lock']:
+        entry['seq'] += 1
+        seq = entry['seq']
+        entry['sock'].send(struct.pack('=IHHII', 16 + len(body), RTM_GETLINK, flags, seq, 0) + body)
+        done = False
+        while not done:
+            data = entry['sock'].recv(1 << 16)
+            offset = 0
+            while offset + 16 <= len(data):
+                length, msg_type, _, msg_seq, _ = struct.unpack_from('=IHHII', data, offset)
+                if length < 16:
+                    break
+                if msg_seq == seq:  # anything else is left over from an abandoned request
+                    if msg_type == NLMSG_DONE:
+                        done = True
+                    elif msg_type == NLMSG_ERROR:
+                        done = True
+                        error = -struct.unpack_from('=i', data, offset + 16)[0]
+                        if error and error != errno.ENODEV:
+                            raise OSError(error, os.strerror(error))
+                    elif msg_type == RTM_NEWLINK:
+                        link = parse_link_message(data, offset + 16, offset + length)
+                        links[link['name']] = link
+                        done = done or bool(interface)
+                offset += (length + 3) & ~3
+    return links
+
+
+def netns_link(interface, netns=None):
+    """rtnetlink view of interface in netns (default: the current one), or None."""
+    netns = netns or current_netns()
+    try:
+        if HELPER_SOCKET:  # opening a socket inside another namespace needs root
+            reply = helper_request({'op': 'links', 'netns': netns, 'interface': interface}, COMMAND_TIMEOUT)
+            if 'error' in reply:
+                raise OSError(reply['error'])
+            return reply['links'].get(interface)
+        return netns_links(netns, interface).get(interface)
+    except (OSError, ValueError) as e:
+        logging.error(f"rtnetlink query for {interface} in netns {netns} failed: {e}")
+        if not HELPER_SOCKET:
+            _drop_netns_socket(netns)
+        return None
+
+
+def interface_exists(interface):
+    """True if interface exists in the namespace this thread operates on."""
+    if current_netns():
+        return netns_link(interface) is not None
+    return os.path.exists(f'/sys/class/net/{interface}')
+
+
+def list_interfaces_by_netns(with_state=True):
+    """
+    [(netns, interfaces)] for the host ('') followed by every named namespace.
+    The namespaces are listed in parallel threads that share this request.
+    """
+    names = list_netns()
+    if not names:
+        with in_netns(''):
+            return [('', list_interfaces(with_state))]
+    results = {}
+
+    def worker(name):
+        with in_netns(name):
+            results[name] = list_interfaces(with_state)
+
+    threads = [threading.Thread(target=copy_current_request_context(worker), args=(name,),
+                                name=f'netns-list-{name or "host"}')
+               for name in [''] + names]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return [(name, results.get(name, [])) for name in [''] + names]
+
+
 def get_latency(interface):
     try:
-        result = subprocess.run(['tc', 'qdisc', 'show', 'dev', interface], capture_output=True, text=True)
+        result = run_cmd(['tc', 'qdisc', 'show', 'dev', interface])
         output = result.stdout
         log_command(['tc', 'qdisc', 'show', 'dev', interface], output)
         match = re.search(r'delay (\d+ms|\d+us)', output)
@@ -530,7 +2470,7 @@ def get_latency(interface):
 
 def get_loss(interface):
     try:
-        result = subprocess.run(['tc', 'qdisc', 'show', 'dev', interface], capture_output=True, text=True)
+        result = run_cmd(['tc', 'qdisc', 'show', 'dev', interface])
         output = result.stdout
         log_command(['tc', 'qdisc', 'show', 'dev', interface], output)
         match = re.search(r'loss (\d+)%', output)
@@ -539,196 +2479,1043 @@ def get_loss(interface):
         logging.error(f"Error getting loss for interface {interface}: {str(e)}")
         return '0%'
 
-def get_qdisc_settings(interface):
+def parse_qdisc_state(output, class_output=None):
     """
-    Return (latency, loss, jitter, bandwidth) for the interface.
-    bandwidth is None if no rate limit is set, otherwise a string like '10Mbit'.
-    Works for both simple netem/HTB/TBF and filtered PRIO+netem structures.
+    Parse 'tc qdisc show' output (and optionally 'tc class show' output) into a dict:
+    latency, loss, jitter, bandwidth, shaping_mode, slot, queues, and the queue
+    sizing in place: limit (netem packets), burst (TBF/HTB, as tc prints it) and
+    queue (TBF latency), each None when the tree has none.
+    Returns None for bandwidth when no rate limit is found. When an HTB tree is
+    present but class_output is None, bandwidth is left unresolved (None).
+    For an mq root (one child per TX queue) bandwidth is the sum of the per-queue
+    rates and queues is the number of impaired queues (1 for single-root trees).
     """
-    try:
-        result = subprocess.run(['sudo', 'tc', 'qdisc', 'show', 'dev', interface], capture_output=True, text=True)
-        output = result.stdout
-        log_command(['sudo', 'tc', 'qdisc', 'show', 'dev', interface], output)
+    latency_match = re.search(r'delay (\d+(?:ms|us))', output)
+    jitter_match  = re.search(r'delay \d+(?:ms|us)\s+(\d+(?:ms|us))', output)
+    loss_match    = re.search(r'loss (\d+(?:\.\d+)?)%', output)
+    limit_match   = re.search(r'qdisc netem [^\n]*?\blimit (\d+)', output)
+    queue_match   = re.search(r'qdisc tbf [^\n]*?\blat (\S+)', output)
+    slot_match    = re.search(r'qdisc netem [^\n]*\bslot (\d+(?:\.\d+)?(?:ms|us|s))(?:\s+(\d+(?:\.\d+)?(?:ms|us|s)))?', output)
+
+    state = {
+        'latency': latency_match.group(1) if latency_match else '0ms',
+        'loss': loss_match.group(1) + '%' if loss_match else '0%',
+        'jitter': jitter_match.group(1) if jitter_match else '0ms',
+        'bandwidth': None,
+        'shaping_mode': DEFAULT_SHAPING_MODE,
+        'slot': ' '.join(g for g in slot_match.groups() if g) if slot_match else None,
+        'queues': 1,
+        'limit': int(limit_match.group(1)) if limit_match else None,
+        'burst': None,
+        'queue': queue_match.group(1) if queue_match else None,
+    }
+    burst_match = (re.search(r'qdisc tbf [^\n]*?\bburst (\S+)', output)
+                   or re.search(r'class htb 1:10 [^\n]*?\bburst (\S+)', class_output or '')
+                   or re.search(r'class htb 1:1 [^\n]*?\bburst (\S+)', class_output or ''))
+    if burst_match:
+        state['burst'] = burst_match.group(1)
+
+    # cake prints "bandwidth unlimited" when it is not shaping
+    cake_rates = re.findall(r'qdisc cake [^\n]*?\bbandwidth (\d\S*)', output)
+
+    # Detect bandwidth limit
+    if re.search(r'qdisc mq 1: root', output):
+        # Per-queue children: "qdisc tbf 101: parent 1:1 rate 625Kbit ..." / "qdisc netem 101: parent 1:1 ... rate 625Kbit"
+        children = re.findall(r'qdisc \S+ \S+ parent 1:[0-9a-f]+\b', output)
+        state['queues'] = max(1, len(children))
+        rates = [rate_to_bits(r) for r in re.findall(r'qdisc (?:tbf|netem) [^\n]*?\brate (\S+)', output)]
+        rates = [r for r in rates if r]
+        if rates:
+            state['bandwidth'] = format_rate_bits(sum(rates))
+        if re.search(r'qdisc netem [^\n]*\brate ', output):
+            state['shaping_mode'] = 'netem'
+        if cake_rates:
+            state['bandwidth'] = format_rate_bits(sum(rate_to_bits(r) or 0 for r in cake_rates))
+            state['shaping_mode'] = 'cake'
+    elif cake_rates:
+        # "qdisc cake 10: parent 1:1 bandwidth 25Gbit besteffort ..."
+        state['bandwidth'], state['shaping_mode'] = cake_rates[0], 'cake'
+    elif 'tbf' in output:
+        # e.g. "rate 10Mbit burst 32Kb lat 400ms"
+        rate_match = re.search(r'rate (\S+)', output)
+        if rate_match:
+            state['bandwidth'] = rate_match.group(1)
+    elif 'htb' in output:
+        # Rate is on the class, not the qdisc line
+        if class_output:
+            # Simple tree: classid 1:10. Filtered tree: aggregate class 1:1, unless uncapped.
+            rate_match = (re.search(r'class htb 1:10 [^\n]*?\brate (\S+)', class_output)
+                          or re.search(r'class htb 1:1 [^\n]*?\brate (\S+)', class_output)
+                          or re.search(r'class htb[^\n]+rate (\S+)', class_output))
+            if rate_match and rate_to_bits(rate_match.group(1)) != rate_to_bits(FILTER_UNLIMITED_RATE):
+                state['bandwidth'] = rate_match.group(1)
+    else:
+        # netem-native: "qdisc netem 8001: root ... delay 10ms rate 1Gbit slot 800us 1ms"
+        rate_match = re.search(r'qdisc netem [^\n]*\brate (\S+)', output)
+        if rate_match:
+            state['bandwidth'] = rate_match.group(1)
+            state['shaping_mode'] = 'netem'
 
-        latency_match = re.search(r'delay (\d+(?:ms|us))', output)
-        jitter_match  = re.search(r'delay \d+(?:ms|us)\s+(\d+(?:ms|us))', output)
-        loss_match    = re.search(r'loss (\d+(?:\.\d+)?)%', output)
+    if state['slot']:
+        state['shaping_mode'] = 'netem'
 
-        latency = latency_match.group(1) if latency_match else '0ms'
-        loss    = loss_match.group(1) + '%' if loss_match else '0%'
-        jitter  = jitter_match.group(1) if jitter_match else '0ms'
+    return state
 
-        if jitter_match:
-            logging.info(f"Captured jitter: {jitter}")
-        else:
-            logging.info("No jitter found in tc output")
 
-        # Detect bandwidth limit
-        bandwidth = None
-        if 'tbf' in output:
-            # e.g. "rate 10Mbit burst 32Kb lat 400ms"
-            rate_match = re.search(r'rate (\S+)', output)
-            if rate_match:
-                bandwidth = rate_match.group(1)
-        elif 'htb' in output:
-            # Rate is on the class, not the qdisc line
-            class_result = subprocess.run(
-                ['sudo', 'tc', 'class', 'show', 'dev', interface],
-                capture_output=True, text=True
-            )
-            log_command(['sudo', 'tc', 'class', 'show', 'dev', interface], class_result.stdout)
-            # Pick first class rate (our classid 1:10)
-            rate_match = re.search(r'class htb[^\n]+rate (\S+)', class_result.stdout)
-            if rate_match:
-                bandwidth = rate_match.group(1)
+def read_qdisc_text(interface):
+    """
+    ('tc qdisc show' output, 'tc class show' output) for interface. The class
+    listing is only read for HTB trees (None otherwise) — it is where their rate lives.
+    """
+    result = run_cmd(['sudo', 'tc', 'qdisc', 'show', 'dev', interface])
+    output = result.stdout
+    log_command(['sudo', 'tc', 'qdisc', 'show', 'dev', interface], output)
+
+    class_output = None
+    if 'htb' in output and 'tbf' not in output:
+        class_result = run_cmd(['sudo', 'tc', 'class', 'show', 'dev', interface])
+        log_command(['sudo', 'tc', 'class', 'show', 'dev', interface], class_result.stdout)
+        class_output = class_result.stdout
+    return output, class_output
+
 
-        return latency, loss, jitter, bandwidth
+def get_qdisc_state(interface):
+    """
+    Return the parsed qdisc state dict for the interface (see parse_qdisc_state).
+    Works for simple netem/HTB/TBF, netem-native rate and filtered PRIO+netem structures.
+    """
+    try:
+        state = parse_qdisc_state(*read_qdisc_text(interface))
+        if state['jitter'] != '0ms':
+            logging.info(f"Captured jitter: {state['jitter']}")
+        else:
+            logging.info("No jitter found in tc output")
+        return state
     except subprocess.SubprocessError as e:
         logging.error(f"Error executing tc command for interface {interface}: {str(e)}")
-        return '0ms', '0%', '0ms', None
     except Exception as e:
         logging.error(f"Error getting qdisc settings for interface {interface}: {str(e)}")
-        return '0ms', '0%', '0ms', None
+    return parse_qdisc_state('')
 
-def apply_qdisc(interface, latency=None, loss=None, jitter=None, bandwidth=None):
+
+def get_qdisc_settings(interface):
     """
-    Apply network conditions to an interface using tc qdisc.
+    Return (latency, loss, jitter, bandwidth) for the interface.
+    bandwidth is None if no rate limit is set, otherwise a string like '10Mbit'.
+    Works for both simple netem/HTB/TBF and filtered PRIO+netem structures.
+    """
+    state = get_qdisc_state(interface)
+    return state['latency'], state['loss'], state['jitter'], state['bandwidth']
 
-    Strategy:
-      - Tear down the existing root qdisc unconditionally (ignore errors — there may be none).
-      - Rebuild from scratch based on the merged desired state.
+def cake_shaper_args(rate):
+    """cake shaping the aggregate at rate; it sizes its own memory from the bandwidth and treats all DSCP classes as one."""
+    return ['cake', 'bandwidth', rate, 'besteffort']
+
+
+def build_qdisc_commands(interface, latency, loss, jitter, bandwidth,
+                         shaping_mode=DEFAULT_SHAPING_MODE, slot=None, queues=1, sizing=None):
+    """
+    Return the list of tc commands (argument lists without the leading 'tc') that
+    build the impairment tree for already-normalised settings. Empty if nothing to apply.
 
-    Cases handled:
+    Single-queue trees are installed at root:
       1. netem only (latency/loss/jitter, no bandwidth)
       2. bandwidth only (TBF)
-      3. bandwidth + netem (HTB root → netem leaf)
+      3. bandwidth + netem, shaping_mode 'htb' (HTB root → netem leaf)
+      4. bandwidth + netem, shaping_mode 'netem' (single netem qdisc using rate/slot)
+
+      5. bandwidth, shaping_mode 'cake' (cake at root, or as the child of a
+         netem root when there are impairments too)
+
+    With queues > 1 an mq root is installed with one child per TX queue, so every
+    CPU enqueues on its own queue lock; the bandwidth cap is split evenly
+    (mq_queue_rates, so the children add up to the cap):
+      netem only → netem per queue; bandwidth only → TBF per queue;
+      bandwidth + netem → netem with rate per queue ('netem') or TBF → netem ('htb');
+      'cake' → cake per queue, behind netem if any.
+
+    netem limits, bursts and TBF queues are sized from the bandwidth-delay product
+    (see queue_sizing); sizing defaults to queue_sizing(interface).
+    """
+    has_netem = (latency and latency != '0ms') or (loss and loss != '0%') or (jitter and jitter != '0ms') or bool(slot)
+    has_bw    = bool(bandwidth)
+    dev = ['dev', interface]
+    commands = []
+
+    if not (has_netem or has_bw):
+        return commands
+
+    sizing = sizing or queue_sizing(interface)
+    if queues > 1:
+        queue_rates = mq_queue_rates(bandwidth, queues) if has_bw else [None] * queues
+        commands.append(['qdisc', 'add'] + dev + ['root', 'handle', '1:', 'mq'])
+        for txq, queue_bw in enumerate(queue_rates, start=1):
+            queue_bits = rate_to_bits(queue_bw) if queue_bw else None
+            parent = ['parent', f'1:{txq:x}']
+            handle = mq_child_handle(txq)
+            if has_bw and shaping_mode in FAST_SHAPING_MODES:
+                shaper = cake_shaper_args(queue_bw)
+                if has_netem:
+                    limit = netem_limit(sizing['line_rate'], netem_hold_seconds(latency, jitter, False, sizing), sizing)
+                    commands.append(['qdisc', 'add'] + dev + parent + ['handle', handle, 'netem']
+                                    + build_netem_args(latency, jitter, loss, limit=limit))
+                    commands.append(['qdisc', 'add'] + dev + ['parent', f'{handle}1'] + shaper)
+                else:
+                    commands.append(['qdisc', 'add'] + dev + parent + ['handle', handle] + shaper)
+            elif has_bw and has_netem and shaping_mode == 'netem':
+                limit = netem_limit(queue_bits, netem_hold_seconds(latency, jitter, True, sizing), sizing)
+                commands.append(['qdisc', 'add'] + dev + parent + ['handle', handle, 'netem']
+                                + build_netem_args(latency, jitter, loss, rate=queue_bw, slot=slot, limit=limit))
+            elif has_bw:
+                commands.append(['qdisc', 'add'] + dev + parent + ['handle', handle, 'tbf',
+                                 'rate', queue_bw, 'burst', shaper_burst(queue_bits, sizing),
+                                 'latency', tbf_latency(queue_bits, sizing)])
+                if has_netem:
+                    limit = netem_limit(queue_bits, netem_hold_seconds(latency, jitter, True, sizing), sizing)
+                    commands.append(['qdisc', 'add'] + dev + ['parent', f'{handle}1', 'netem']
+                                    + build_netem_args(latency, jitter, loss, limit=limit))
+            else:
+                limit = netem_limit(sizing['line_rate'], netem_hold_seconds(latency, jitter, False, sizing), sizing)
+                commands.append(['qdisc', 'add'] + dev + parent + ['handle', handle, 'netem']
+                                + build_netem_args(latency, jitter, loss, slot=slot, limit=limit))
+        return commands
+
+    rate_bits = rate_to_bits(bandwidth) if has_bw else sizing['line_rate']
+    limit = netem_limit(rate_bits, netem_hold_seconds(latency, jitter, has_bw, sizing), sizing)
+
+    if has_bw and shaping_mode in FAST_SHAPING_MODES:
+        shaper = cake_shaper_args(bandwidth)
+        if has_netem:
+            # netem releases packets into the shaper, so it holds traffic arriving at line rate
+            limit = netem_limit(max(rate_bits, sizing['line_rate']),
+                                netem_hold_seconds(latency, jitter, False, sizing), sizing)
+            commands.append(['qdisc', 'add'] + dev + ['root', 'handle', '1:', 'netem']
+                            + build_netem_args(latency, jitter, loss, limit=limit))
+            commands.append(['qdisc', 'add'] + dev + ['parent', '1:1'] + shaper)
+        else:
+            commands.append(['qdisc', 'add'] + dev + ['root', 'handle', '1:'] + shaper)
+
+    elif has_bw and has_netem and shaping_mode == 'netem':
+        # Single netem qdisc carrying the rate — one enqueue per packet, no HTB lock
+        commands.append(['qdisc', 'add'] + dev + ['root', 'netem']
+                        + build_netem_args(latency, jitter, loss, rate=bandwidth, slot=slot, limit=limit))
+
+    elif has_bw and has_netem:
+        # HTB root + netem leaf
+        burst = shaper_burst(rate_bits, sizing)
+        commands.append(['qdisc', 'add'] + dev + ['root', 'handle', '1:0', 'htb', 'default', '10'])
+        commands.append(['class', 'add'] + dev + ['parent', '1:0', 'classid', '1:10', 'htb', 'rate', bandwidth,
+                                                  'burst', burst, 'cburst', burst])
+        commands.append(['qdisc', 'add'] + dev + ['parent', '1:10', 'handle', '20:0', 'netem']
+                        + build_netem_args(latency, jitter, loss, limit=limit))
+
+    elif has_bw:
+        # TBF for bandwidth-only
+        commands.append(['qdisc', 'add'] + dev + ['root', 'tbf', 'rate', bandwidth,
+                                                  'burst', shaper_burst(rate_bits, sizing),
+                                                  'latency', tbf_latency(rate_bits, sizing)])
+
+    else:
+        commands.append(['qdisc', 'add'] + dev + ['root', 'netem']
+                        + build_netem_args(latency, jitter, loss, slot=slot, limit=limit))
+
+    return commands
+
+
+def resolve_qdisc_settings(current, latency=None, loss=None, jitter=None, bandwidth=None,
+                           shaping_mode=None, slot=None, cfg=None):
+    """
+    Merge requested settings over the current parsed state (None = keep current)
+    and normalise them. Returns a dict with latency, loss, jitter, bandwidth,
+    shaping_mode and slot ready for build_qdisc_commands().
+
+    shaping_mode None or 'auto' picks the admin fast shaping mode for caps at or
+    above its threshold. Otherwise the installed mode is kept if it is netem, or
+    cake chosen by hand (not the automatic one), else the admin default applies.
+    """
+    cfg = cfg if cfg is not None else load_admin_config()
+
+    latency   = latency   if latency   is not None else current['latency']
+    loss      = loss      if loss      is not None else current['loss']
+    jitter    = jitter    if jitter    is not None else current['jitter']
+    bandwidth = bandwidth if bandwidth is not None else current['bandwidth']
+    slot      = slot      if slot      is not None else current['slot']
+    if shaping_mode in (None, 'auto'):
+        installed = current['shaping_mode']
+        keep = installed == 'netem' or (installed in FAST_SHAPING_MODES and installed != cfg.get('fast_shaping_mode'))
+        shaping_mode = (fast_shaping_mode_for(bandwidth, cfg)
+                        or (installed if keep else cfg.get('default_shaping_mode', DEFAULT_SHAPING_MODE)))
+    if shaping_mode not in SHAPING_MODES:
+        shaping_mode = DEFAULT_SHAPING_MODE
+    if shaping_mode != 'netem':
+        slot = None
+
+    # Normalise latency / jitter units
+    if latency and not latency.endswith(('ms', 'us')):
+        latency += 'ms'
+    if jitter and not jitter.endswith(('ms', 'us')):
+        jitter += 'ms'
+
+    # netem requires a latency value when jitter is set
+    if jitter and jitter != '0ms' and (not latency or latency == '0ms'):
+        latency = '1ms'
+        logging.info("Setting minimal 1ms latency to satisfy netem jitter requirement")
+
+    return {'latency': latency, 'loss': loss, 'jitter': jitter, 'bandwidth': bandwidth,
+            'shaping_mode': shaping_mode, 'slot': slot}
+
+
+def describe_applied(settings, commands, queues):
+    """Short suffix for flash messages describing how a tree was built, e.g. ' (mq, 4 TX queues)'."""
+    notes = []
+    if settings['bandwidth'] and settings['shaping_mode'] == 'netem' and any('netem' in c for c in commands):
+        notes.append("netem-native rate")
+    elif settings['bandwidth'] and settings['shaping_mode'] == 'cake':
+        notes.append("cake shaper")
+    if queues > 1:
+        notes.append(f"mq, {queues} TX queues")
+    return f" ({', '.join(notes)})" if notes else ""
+
+
+# ---------------------------------------------------------------------------
+# Tree diffs — instead of tearing a tree down and rebuilding it on every
+# change, the tree a device carries is compared with the one wanted and only
+# the difference is programmed:
+#   noop     the trees match; nothing runs
+#   change   same qdiscs and classes in the same places, other parameters:
+#            'tc qdisc|class change' for just the lines that differ, so there
+#            is no window in which traffic passes unimpaired
+#   add      the device has no impairment tree yet
+#   rebuild  a different layout: 'qdisc del root' plus the wanted tree
+#   remove   nothing is wanted: 'qdisc del root'
+# The installed tree is modelled by the builder commands that would produce
+# it (from the parsed device state or the recorded desired state) and is only
+# trusted when its layout matches what the device reports.
+# ---------------------------------------------------------------------------
+TREE_QDISC_KINDS = ('netem', 'tbf', 'htb', 'mq', 'prio', 'cake')
+_RATE_TOKEN = re.compile(r'^\d+(?:\.\d+)?(?:bit|kbit|mbit|gbit|tbit)$', re.IGNORECASE)
+_TIME_TOKEN = re.compile(r'^\d+(?:\.\d+)?(?:us|ms|s)$')
+_PERCENT_TOKEN = re.compile(r'^\d+(?:\.\d+)?%$')
+_SIZE_TOKEN = re.compile(r'^(\d+(?:\.\d+)?)(b|kb|mb|gb)$', re.IGNORECASE)
+
+
+def tc_size_bytes(value):
+    """tc size ('5000b', '4Kb', '1Mb') -> bytes (None if unparseable); tc's k/m/g are powers of 1024."""
+    m = _SIZE_TOKEN.match(value or '')
+    if not m:
+        return None
+    return int(float(m.group(1)) * {'b': 1, 'kb': 1024, 'mb': 1024 ** 2, 'gb': 1024 ** 3}[m.group(2).lower()])
+
+
+@functools.lru_cache(maxsize=4096)
+def _tree_token(token):
+    """
+    Comparable form of one tc argument: '10Mbit' == '10mbit', '1.0%' == '1%',
+    '1000us' == '1ms'. Sizes compare to 3 significant digits, as the kernel keeps
+    bursts in clock ticks and prints them back slightly off ('12496875b').
+    """
+    if _RATE_TOKEN.match(token):
+        return rate_to_bits(token)
+    if _SIZE_TOKEN.match(token):
+        return float(f'{tc_size_bytes(token):.3g}')
+    if _TIME_TOKEN.match(token):
+        return round(time_to_seconds(token), 9)
+    if _PERCENT_TOKEN.match(token):
+        return float(token[:-1])
+    return token.lower()
+
+
+def tree_target(cmd):
+    """Where a tc qdisc/class command acts: ('qdisc', kind, 'root'|parent) or ('class', classid)."""
+    if cmd[0] == 'class':
+        return ('class', cmd[cmd.index('classid') + 1])
+    kind = next((arg for arg in cmd if arg in TREE_QDISC_KINDS), None)
+    return ('qdisc', kind, 'root' if 'root' in cmd else cmd[cmd.index('parent') + 1])
+
+
+def tree_layout(commands):
+    """Sorted targets of a tree's qdisc and class commands (filters are not part of the layout)."""
+    return sorted(tree_target(cmd) for cmd in commands if cmd[0] in ('qdisc', 'class'))
+
+
+def device_layout(qdisc_output, class_output=None):
+    """
+    tree_layout() of what a device carries, from 'tc qdisc show' (and, for HTB
+    trees, 'tc class show') output. The ingress side and the kernel's own
+    default qdiscs (handle 0:) are left out.
+    """
+    layout = []
+    for m in re.finditer(r'^qdisc (\S+) (\S+) (?:dev \S+ )?(?:(root)|parent (\S+))', qdisc_output, re.MULTILINE):
+        kind, handle, root, parent = m.groups()
+        if kind in ('ingress', 'clsact') or parent == 'ffff:fff1' or (handle == '0:' and not root):
+            continue
+        layout.append(('qdisc', kind, 'root' if root else parent))
+    for m in re.finditer(r'^class htb (\S+) ', class_output or '', re.MULTILINE):
+        layout.append(('class', m.group(1)))
+    return sorted(layout)
+
+
+def plan_tree(interface, wanted, installed, qdisc_output, class_output=None):
+    """
+    (tc commands, action) that turn the tree on interface into wanted (builder
+    commands, [] for none). installed is the builder commands believed to be on
+    the device, or None if unknown; action is one of noop, change, add, rebuild
+    and remove (see the section comment).
+    """
+    if not has_custom_qdisc(qdisc_output):
+        return (list(wanted), 'add') if wanted else ([], 'noop')
+    delete_root = ['qdisc', 'del', 'dev', interface, 'root']
+    if not wanted:
+        return [delete_root], 'remove'
+
+    def normalised(cmd):
+        return [_tree_token(arg) for arg in cmd[2:]]
+
+    if (installed is not None
+            and tree_layout(installed) == tree_layout(wanted) == device_layout(qdisc_output, class_output)
+            and [normalised(c) for c in installed if c[0] == 'filter']
+            == [normalised(c) for c in wanted if c[0] == 'filter']):
+        current = {tree_target(cmd): normalised(cmd) for cmd in installed if cmd[0] != 'filter'}
+        changes = [[cmd[0], 'change'] + cmd[2:] for cmd in wanted
+                   if cmd[0] != 'filter' and normalised(cmd) != current[tree_target(cmd)]]
+        return (changes, 'change') if changes else ([], 'noop')
+    return [delete_root] + list(wanted), 'rebuild'
+
+
+def installed_tree(interface, state, queues=None, sizing=None):
+    """
+    Builder commands modelling the simple tree parsed into state (see
+    parse_qdisc_state); queues defaults to the number of impaired queues found.
+    The netem limit, burst and TBF queue are the ones on the device, so that a
+    new MTU or sizing setting shows up as a change.
+    """
+    settings = {k: state[k] for k in ('latency', 'loss', 'jitter', 'bandwidth', 'slot')}
+    # Anything but a netem-native rate or cake is shaped by HTB (or TBF per queue), whatever the admin default
+    settings['shaping_mode'] = state['shaping_mode'] if state['shaping_mode'] in SHAPING_MODES else 'htb'
+    sizing = dict(sizing or queue_sizing(interface))
+    if state['limit']:
+        sizing['limit'] = state['limit']
+    if state['burst']:
+        sizing['burst'] = tc_size_bytes(state['burst']) or sizing['burst']
+    if state['queue']:
+        sizing['queue'] = time_to_seconds(state['queue']) or sizing['queue']
+    return build_qdisc_commands(interface, queues=queues or state['queues'], sizing=sizing, **settings)
+
+
+@interface_mutation(merge_settings)
+def apply_qdisc(interface, latency=None, loss=None, jitter=None, bandwidth=None,
+                shaping_mode=None, slot=None, multiqueue=None):
+    """
+    Apply network conditions to an interface using tc qdisc.
+
+    Strategy:
+      - Read the installed tree and merge the requested settings over it.
+      - Program only the difference (see plan_tree): nothing when the tree already
+        matches, 'tc qdisc|class change' for parameter changes, and a teardown
+        plus rebuild only when the layout changes — in a single 'tc -batch' exec.
+
+    shaping_mode None keeps the mode currently installed on the interface, falling
+    back to the admin default. slot (netem-native only) is "<min> [<max>]".
+    multiqueue None follows the admin 'multiqueue_impairments' setting; when enabled
+    and the interface has more than one TX queue, an mq root with per-queue children
+    is installed.
     """
     try:
         alias = get_interface_alias(interface)
         display_name = f"{interface} ({alias})" if alias and alias != interface else interface
 
         # Retrieve current settings and merge
-        current_latency, current_loss, current_jitter, current_bandwidth = get_qdisc_settings(interface)
-
-        latency   = latency   if latency   is not None else current_latency
-        loss      = loss      if loss      is not None else current_loss
-        jitter    = jitter    if jitter    is not None else current_jitter
-        bandwidth = bandwidth if bandwidth is not None else current_bandwidth
-
-        # Normalise latency / jitter units
-        if latency and not latency.endswith(('ms', 'us')):
-            latency += 'ms'
-        if jitter and not jitter.endswith(('ms', 'us')):
-            jitter += 'ms'
-
-        # netem requires a latency value when jitter is set
-        if jitter and jitter != '0ms' and (not latency or latency == '0ms'):
-            latency = '1ms'
-            logging.info("Setting minimal 1ms latency to satisfy netem jitter requirement")
-
-        has_netem = (latency and latency != '0ms') or (loss and loss != '0%') or (jitter and jitter != '0ms')
-        has_bw    = bool(bandwidth)
-
-        # --- Step 1: tear down existing root qdisc (cascades child classes/qdiscs) ---
-        del_result = subprocess.run(
-            ['sudo', 'tc', 'qdisc', 'del', 'dev', interface, 'root'],
-            capture_output=True, text=True
-        )
-        # returncode != 0 is fine here — means no custom qdisc was present
-        log_command(['sudo', 'tc', 'qdisc', 'del', 'dev', interface, 'root'], del_result.stdout)
-
-        # --- Step 2: rebuild ---
-        errors = []
-
-        def run_tc(cmd):
-            r = subprocess.run(cmd, capture_output=True, text=True)
-            log_command(cmd, r.stdout)
-            if r.returncode != 0:
-                errors.append(r.stderr.strip())
-            return r.returncode == 0
-
-        if has_bw and has_netem:
-            # HTB root + netem leaf
-            run_tc(['sudo', 'tc', 'qdisc', 'add', 'dev', interface,
-                    'root', 'handle', '1:0', 'htb', 'default', '10'])
-            run_tc(['sudo', 'tc', 'class', 'add', 'dev', interface,
-                    'parent', '1:0', 'classid', '1:10', 'htb', 'rate', bandwidth])
-            netem_cmd = ['sudo', 'tc', 'qdisc', 'add', 'dev', interface,
-                         'parent', '1:10', 'handle', '20:0', 'netem']
-            if latency and latency != '0ms':
-                if jitter and jitter != '0ms':
-                    netem_cmd.extend(['delay', latency, jitter])
-                else:
-                    netem_cmd.extend(['delay', latency])
-            if loss and loss != '0%':
-                netem_cmd.extend(['loss', loss.replace('%', '')])
-            run_tc(netem_cmd)
-
-        elif has_bw:
-            # TBF for bandwidth-only
-            burst = compute_tbf_burst(bandwidth)
-            run_tc(['sudo', 'tc', 'qdisc', 'add', 'dev', interface,
-                    'root', 'tbf', 'rate', bandwidth, 'burst', burst, 'latency', '400ms'])
-
-        elif has_netem:
-            netem_cmd = ['sudo', 'tc', 'qdisc', 'add', 'dev', interface, 'root', 'netem']
-            if latency and latency != '0ms':
-                if jitter and jitter != '0ms':
-                    netem_cmd.extend(['delay', latency, jitter])
-                else:
-                    netem_cmd.extend(['delay', latency])
-            if loss and loss != '0%':
-                netem_cmd.extend(['loss', loss.replace('%', '')])
-            run_tc(netem_cmd)
-
-        if errors:
+        cfg = load_admin_config()
+        qdisc_output, class_output = read_qdisc_text(interface)
+        current = parse_qdisc_state(qdisc_output, class_output)
+        settings = resolve_qdisc_settings(current, latency, loss, jitter, bandwidth, shaping_mode, slot, cfg)
+        if multiqueue is None:
+            multiqueue = cfg.get('multiqueue_impairments', False)
+        queues = get_tx_queue_count(interface) if multiqueue else 1
+
+        sizing = queue_sizing(interface, cfg)
+        wanted = build_qdisc_commands(interface, queues=queues, sizing=sizing, **settings)
+        commands, action = plan_tree(interface, wanted, installed_tree(interface, current, sizing=sizing),
+                                     qdisc_output, class_output)
+        if action in ('rebuild', 'remove'):
+            # The old tree may have been a matrix-classified filtered tree
+            remove_matrix_classifier(interface)
+            invalidate_matrix_index(interface)
+        ok, errors = run_tc_batch(commands)
+
+        if not ok:
             flash(f"Error applying conditions to {display_name}: {'; '.join(errors)}", "error")
             logging.error(f"tc errors on {interface}: {errors}")
         else:
-            flash(f"Network conditions applied to {display_name}", "success")
+            record_desired_state(interface, 'egress',
+                                 dict(settings, kind='simple', multiqueue=queues > 1) if wanted else None)
+            if action == 'noop':
+                flash(f"Network conditions on {display_name} already match", "info")
+            else:
+                flash(f"Network conditions applied to {display_name}{describe_applied(settings, wanted, queues)}", "success")
 
     except Exception as e:
         flash(f"Error applying network conditions to {interface}: {str(e)}", "error")
         logging.error(f"Error in apply_qdisc for interface {interface}: {str(e)}")
 
-def remove_degradations(interface):
-    """Remove ALL tc qdisc settings (netem, TBF, HTB) from an interface."""
+
+# ---------------------------------------------------------------------------
+# Ingress impairments — traffic received on an interface is redirected by an
+# ingress qdisc + mirred action to a HyyperWAN-managed IFB device, where the
+# normal egress impairment tree is applied. IFB devices are named
+# hwifb<ifindex>, hidden from the UI and garbage-collected when their parent
+# interface disappears or the ingress impairment is removed.
+# ---------------------------------------------------------------------------
+IFB_PREFIX = 'hwifb'
+
+
+def get_ifindex(interface):
+    """Return the ifindex of an interface from sysfs, or None."""
+    if current_netns():
+        link = netns_link(interface)
+        return link['ifindex'] if link else None
+    try:
+        with open(f'/sys/class/net/{interface}/ifindex') as f:
+            return int(f.read().strip())
+    except Exception:
+        return None
+
+
+def get_rx_queue_count(interface):
+    """Return the number of RX queues of an interface from /sys/class/net/<iface>/queues (1 on error)."""
+    if current_netns():
+        link = netns_link(interface)
+        return link['rx_queues'] if link else 1
+    try:
+        queues = os.listdir(f'/sys/class/net/{interface}/queues')
+        return max(1, sum(1 for q in queues if q.startswith('rx-')))
+    except Exception:
+        return 1
+
+
+def ifb_name_for(interface):
+    """Name of the IFB device carrying ingress impairments for interface (None if it has no ifindex)."""
+    ifindex = get_ifindex(interface)
+    return f"{IFB_PREFIX}{ifindex}" if ifindex is not None else None
+
+
+def is_managed_ifb(name):
+    """True for IFB devices created by HyyperWAN (hidden from interface lists)."""
+    return bool(re.match(rf'^{IFB_PREFIX}\d+$', name))
+
+
+def get_ingress_ifb(interface):
+    """Return the existing IFB device name for interface's ingress impairments, or None."""
+    ifb = ifb_name_for(interface)
+    return ifb if ifb and interface_exists(ifb) else None
+
+
+def get_ingress_state(interface):
+    """Parsed qdisc state (see parse_qdisc_state) of interface's ingress IFB, or None if none is set up."""
+    ifb = get_ingress_ifb(interface)
+    if not ifb:
+        return None
+    state = get_qdisc_state(ifb)
+    state['ifb'] = ifb
+    return state
+
+
+def run_ip_batch(commands):
+    """
+    Run many ip commands in a single 'ip -force -batch -' exec.
+    commands is a list of argument lists (without the leading 'ip').
+    Returns (success, errors).
+    """
+    if not commands:
+        return True, []
+    batch = '\n'.join(' '.join(cmd) for cmd in commands) + '\n'
+    cmd = ['sudo', 'ip', '-force', '-batch', '-']
+    result = run_cmd(cmd, input=batch)
+    log_command(cmd, f"{len(commands)} commands\n{batch}{result.stdout}{result.stderr}")
+    # Kernel extack warnings (e.g. "Warning: sch_htb: quantum of class ... is big") are not failures
+    errors = [line.strip() for line in result.stderr.splitlines()
+              if line.strip() and not line.strip().startswith('Warning:')]
+    return result.returncode == 0 and not errors, errors
+
+
+@interface_mutation(merge_settings)
+def apply_ingress_qdisc(interface, latency=None, loss=None, jitter=None, bandwidth=None,
+                        shaping_mode=None, slot=None, multiqueue=None):
+    """
+    Apply network conditions to traffic received on interface.
+
+    One ip batch creates the IFB (as many queues as the interface has RX queues, so
+    receive-side shaping is spread over CPUs) when it does not exist yet; one tc batch
+    installs the ingress qdisc, the matchall → mirred redirect and the impairment tree
+    on the IFB. Settings merge with the current ingress state, and only the difference
+    is programmed, like apply_qdisc().
+    """
+    try:
+        alias = get_interface_alias(interface)
+        display_name = f"{interface} ({alias})" if alias and alias != interface else interface
+
+        ifb = ifb_name_for(interface)
+        if not ifb:
+            flash(f"Interface {display_name} not found", "error")
+            return
+
+        cfg = load_admin_config()
+        existing = get_ingress_ifb(interface)
+        qdisc_output, class_output = read_qdisc_text(existing) if existing else ('', None)
+        current = parse_qdisc_state(qdisc_output, class_output)
+        settings = resolve_qdisc_settings(current, latency, loss, jitter, bandwidth, shaping_mode, slot, cfg)
+        if multiqueue is None:
+            multiqueue = cfg.get('multiqueue_impairments', False)
+        rx_queues = get_rx_queue_count(interface)
+        queues = rx_queues if multiqueue else 1
+
+        # The IFB carries the interface's traffic: size its tree by the interface's MTU and speed
+        sizing = queue_sizing(interface, cfg)
+        tree = build_qdisc_commands(ifb, queues=queues, sizing=sizing, **settings)
+        if not tree:
+            remove_ingress_degradations(interface)
+            record_desired_state(interface, 'ingress', None)
+            return
+
+        errors = []
+        if not existing:
+            ok, ip_errors = run_ip_batch([
+                ['link', 'add', ifb, 'numtxqueues', str(rx_queues), 'numrxqueues', str(rx_queues), 'type', 'ifb'],
+                ['link', 'set', ifb, 'up'],
+            ])
+            if not ok:
+                errors.extend(ip_errors)
+
+        # Only the difference is programmed on an existing IFB tree (see plan_tree)
+        changes, action = plan_tree(ifb, tree, installed_tree(ifb, current, sizing=sizing) if existing else None,
+                                    qdisc_output, class_output)
+        if not errors and action != 'noop':
+            commands = [
+                ['qdisc', 'replace', 'dev', interface, 'handle', 'ffff:', 'ingress'],
+                ['filter', 'replace', 'dev', interface, 'parent', 'ffff:', 'protocol', 'all',
+                 'prio', '1', 'handle', '1', 'matchall', 'action', 'mirred', 'egress', 'redirect', 'dev', ifb],
+            ] + changes
+            ok, tc_errors = run_tc_batch(commands)
+            if not ok:
+                errors.extend(tc_errors)
+
+        if errors:
+            if not existing:
+                # Do not leave a half-built redirect / IFB behind
+                remove_ingress_degradations(interface, quiet=True)
+            flash(f"Error applying ingress conditions to {display_name}: {'; '.join(errors)}", "error")
+            logging.error(f"ingress setup errors on {interface} ({ifb}): {errors}")
+        else:
+            record_desired_state(interface, 'ingress', dict(settings, multiqueue=bool(multiqueue)))
+            if action == 'noop':
+                flash(f"Ingress network conditions on {display_name} already match", "info")
+            else:
+                flash(f"Ingress network conditions applied to {display_name}{describe_applied(settings, tree, queues)}", "success")
+
+    except Exception as e:
+        flash(f"Error applying ingress conditions to {interface}: {str(e)}", "error")
+        logging.error(f"Error in apply_ingress_qdisc for interface {interface}: {str(e)}")
+
+
+@interface_mutation(merge_identical)
+def remove_ingress_degradations(interface, quiet=False):
+    """Remove the ingress redirect from interface and delete its IFB device. Returns True if anything was removed."""
+    ifb = get_ingress_ifb(interface)
+    if not ifb:
+        return False
+    alias = get_interface_alias(interface)
+    display_name = f"{interface} ({alias})" if alias and alias != interface else interface
+
+    # Deleting the ingress qdisc drops its filters; deleting the IFB drops its tree
+    tc_cmd = ['sudo', 'tc', 'qdisc', 'del', 'dev', interface, 'ingress']
+    tc_result = run_cmd(tc_cmd)
+    log_command(tc_cmd, tc_result.stdout + tc_result.stderr)
+    ip_cmd = ['sudo', 'ip', 'link', 'del', ifb]
+    ip_result = run_cmd(ip_cmd)
+    log_command(ip_cmd, ip_result.stdout + ip_result.stderr)
+
+    if ip_result.returncode != 0:
+        flash(f"Error removing ingress conditions from {display_name}: {ip_result.stderr.strip()}", "error")
+        logging.error(f"Error deleting {ifb} for {interface}: {ip_result.stderr.strip()}")
+    elif not quiet:
+        flash(f"Ingress network conditions removed from {display_name}", "success")
+    return ip_result.returncode == 0
+
+
+def gc_ingress_ifbs():
+    """
+    Delete HyyperWAN IFB devices whose parent interface no longer exists or that
+    carry no impairment tree (left over from a failed setup). Deletions are
+    issued as a single ip batch. Returns the list of deleted devices.
+    """
+    try:
+        existing = os.listdir('/sys/class/net')
+    except Exception as e:
+        logging.error(f"Error listing interfaces for IFB garbage collection: {e}")
+        return []
+
+    live = {}
+    for name in existing:
+        if not is_managed_ifb(name):
+            ifindex = get_ifindex(name)
+            if ifindex is not None:
+                live[ifindex] = name
+
+    stale = []
+    orphaned_parents = []
+    for name in existing:
+        if not is_managed_ifb(name):
+            continue
+        parent = live.get(int(name[len(IFB_PREFIX):]))
+        if parent is None:
+            stale.append(name)
+            continue
+        result = run_cmd(['sudo', 'tc', 'qdisc', 'show', 'dev', name])
+        if not has_custom_qdisc(result.stdout):
+            stale.append(name)
+            orphaned_parents.append(parent)
+
+    if orphaned_parents:
+        # Drop the redirect first so the parent does not send traffic into a deleted device
+        run_tc_batch([['qdisc', 'del', 'dev', parent, 'ingress'] for parent in orphaned_parents])
+    if stale:
+        ok, errors = run_ip_batch([['link', 'del', name] for name in stale])
+        logging.info(f"Garbage-collected IFB devices {stale} (errors: {errors})")
+    return stale
+
+@interface_mutation(merge_identical)
+def remove_degradations(interface, direction='both'):
+    """
+    Remove ALL tc qdisc settings (netem, TBF, HTB, per-queue mq trees) from an interface.
+    direction: 'egress', 'ingress' (IFB redirect) or 'both'.
+    """
+    try:
+        alias = get_interface_alias(interface)
+        display_name = f"{interface} ({alias})" if alias and alias != interface else interface
+
+        if direction in ('ingress', 'both'):
+            remove_ingress_degradations(interface)
+            record_desired_state(interface, 'ingress', None)
+        if direction == 'ingress':
+            return
+
+        record_desired_state(interface, 'egress', None)
+        remove_matrix_classifier(interface)
+        invalidate_matrix_index(interface)
+        check_result = run_cmd(['sudo', 'tc', 'qdisc', 'show', 'dev', interface])
+        log_command(['sudo', 'tc', 'qdisc', 'show', 'dev', interface], check_result.stdout)
+
+        if has_custom_qdisc(check_result.stdout):
+            # Deleting root cascades all child classes and qdiscs
+            result = run_cmd(['sudo', 'tc', 'qdisc', 'del', 'dev', interface, 'root'])
+            log_command(['sudo', 'tc', 'qdisc', 'del', 'dev', interface, 'root'], result.stdout)
+            if result.returncode != 0:
+                flash(f"Error removing qdisc from {display_name}: {result.stderr}", "error")
+                logging.error(f"Error removing qdisc from {interface} (rc={result.returncode}): {result.stderr}")
+            else:
+                flash(f"Network conditions removed from {display_name}", "success")
+        else:
+            logging.info(f"No custom qdisc to remove on {interface}")
+    except subprocess.SubprocessError as e:
+        flash(f"Failed to execute tc command for {interface}: {str(e)}", "error")
+        logging.error(f"Subprocess error removing qdisc from {interface}: {str(e)}")
+    except Exception as e:
+        flash(f"Error removing network conditions from {interface}: {str(e)}", "error")
+        logging.error(f"Error in remove_degradations for {interface}: {str(e)}")
+
+
+# ---------------------------------------------------------------------------
+# Desired impairment state — every successful apply/remove records what the
+# interface should carry in a JSON file next to ADMIN_CONFIG_PATH, so the
+# trees can be rebuilt after a reboot or container restart (tc state lives in
+# the kernel and is gone after a reboot).
+#   IMPAIRMENT_STATE_PATH   state file (default: impairments.json beside the admin config)
+#   RESTORE_ON_START        rebuild the recorded trees at startup (default true)
+#   RESTORE_WORKERS         parallel tc batches used by the restore (default 4)
+#
+# File layout: {iface: {"egress": {...}, "ingress": {...}}}. An egress entry
+# is either kind "simple" (resolve_qdisc_settings() output + multiqueue) or
+# kind "filtered" (normalised rules, aggregate bandwidth, classifier); an
+# ingress entry is resolved settings + multiqueue.
+# ---------------------------------------------------------------------------
+IMPAIRMENT_STATE_PATH = os.environ.get(
+    'IMPAIRMENT_STATE_PATH',
+    os.path.join(os.path.dirname(ADMIN_CONFIG_PATH), 'impairments.json')
+)
+RESTORE_ON_START = os.environ.get('RESTORE_ON_START', 'true').lower() == 'true'
+RESTORE_WORKERS = max(1, int(os.environ.get('RESTORE_WORKERS', '4')))
+
+_desired_state_lock = threading.Lock()
+_restore_lock = threading.Lock()
+_restore_progress = {'state': 'idle', 'total': 0, 'done': 0, 'restored': [], 'present': [],
+                     'skipped': [], 'failed': {}, 'seconds': None}
+
+
+def load_desired_state():
+    """Return the recorded desired state ({} when nothing has been recorded)."""
+    if not os.path.exists(IMPAIRMENT_STATE_PATH):
+        return {}
+    try:
+        with open(IMPAIRMENT_STATE_PATH) as f:
+            return json.load(f)
+    except Exception as e:
+        logging.error(f"Error reading impairment state: {e}")
+        return {}
+
+
+def record_desired_state(interface, direction, entry):
+    """Store (or with entry None, forget) the desired tree for one interface direction."""
+    if current_netns():
+        return  # named namespaces are gone after a reboot; nothing to restore into
+    with _desired_state_lock:
+        state = load_desired_state()
+        if entry is None:
+            state.get(interface, {}).pop(direction, None)
+            if not state.get(interface):
+                state.pop(interface, None)
+        else:
+            state.setdefault(interface, {})[direction] = entry
+        try:
+            os.makedirs(os.path.dirname(IMPAIRMENT_STATE_PATH), exist_ok=True)
+            # Write-and-rename so a crash mid-write never leaves a truncated file
+            tmp_path = f"{IMPAIRMENT_STATE_PATH}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp_path, IMPAIRMENT_STATE_PATH)
+        except Exception as e:
+            logging.error(f"Error saving impairment state: {e}")
+
+
+def get_restore_progress():
+    """Snapshot of the startup restore (state idle/running/done, counters, per-interface outcome)."""
+    with _restore_lock:
+        return dict(_restore_progress, restored=list(_restore_progress['restored']),
+                    present=list(_restore_progress['present']), skipped=list(_restore_progress['skipped']),
+                    failed=dict(_restore_progress['failed']))
+
+
+def _restore_mark(interface, outcome, error=None):
+    with _restore_lock:
+        if outcome == 'failed':
+            _restore_progress['failed'][interface] = error
+        else:
+            _restore_progress[outcome].append(interface)
+        _restore_progress['done'] += 1
+
+
+def read_custom_roots():
+    """
+    One 'tc qdisc show' for every device: returns (devices with an impairment root,
+    devices with an ingress qdisc).
+    """
+    result = run_cmd(['sudo', 'tc', 'qdisc', 'show'])
+    roots, ingress = set(), set()
+    for line in result.stdout.splitlines():
+        m = re.match(r'qdisc (\S+) (\S+) dev (\S+) (root|ingress|parent ffff:fff1)', line)
+        if not m:
+            continue
+        kind, handle, dev, where = m.groups()
+        if where == 'root' and is_impairment_root(kind, handle):
+            roots.add(dev)
+        elif where != 'root':
+            ingress.add(dev)
+    return roots, ingress
+
+
+def build_restore_commands(interface, direction, entry, rx_queues=1, sizing=None):
+    """
+    (ip commands, tc commands, ipset rules) that rebuild one recorded entry on an
+    interface that has no tree yet. ipset rules is None unless the filtered
+    tree is classified by a matrix ipset. sizing defaults to queue_sizing(interface).
+    """
+    sizing = sizing or queue_sizing(interface)
+    if direction == 'ingress':
+        ifb = ifb_name_for(interface)
+        settings = {k: entry.get(k) for k in ('latency', 'loss', 'jitter', 'bandwidth', 'shaping_mode', 'slot')}
+        tree = build_qdisc_commands(ifb, queues=rx_queues if entry.get('multiqueue') else 1,
+                                    sizing=sizing, **settings)
+        ip_commands = [
+            ['link', 'add', ifb, 'numtxqueues', str(rx_queues), 'numrxqueues', str(rx_queues), 'type', 'ifb'],
+            ['link', 'set', ifb, 'up'],
+        ]
+        tc_commands = [
+            ['qdisc', 'replace', 'dev', interface, 'handle', 'ffff:', 'ingress'],
+            ['filter', 'replace', 'dev', interface, 'parent', 'ffff:', 'protocol', 'all',
+             'prio', '1', 'handle', '1', 'matchall', 'action', 'mirred', 'egress', 'redirect', 'dev', ifb],
+        ] + tree
+        return ip_commands, tc_commands, None
+
+    if entry.get('kind') == 'filtered':
+        ipset = entry.get('classifier') == 'ipset'
+        commands = build_filtered_commands(interface, entry['rules'], entry.get('bandwidth'),
+                                           with_filters=not ipset, sizing=sizing)
+        return [], commands, entry['rules'] if ipset else None
+
+    settings = {k: entry.get(k) for k in ('latency', 'loss', 'jitter', 'bandwidth', 'shaping_mode', 'slot')}
+    queues = get_tx_queue_count(interface) if entry.get('multiqueue') else 1
+    return [], build_qdisc_commands(interface, queues=queues, sizing=sizing, **settings), None
+
+
+def run_owned_batch(tool, owned_commands):
+    """
+    Run [(owner, argv)] as one '<tool> -force -batch -' exec. Returns {owner: error}
+    for every owner with a failed line ('Command failed -:N' from ip and tc alike).
+    """
+    if not owned_commands:
+        return {}
+    batch = '\n'.join(' '.join(cmd) for _, cmd in owned_commands) + '\n'
+    cmd = ['sudo', tool, '-force', '-batch', '-']
+    result = run_cmd(cmd, input=batch)
+    log_command(cmd, f"{len(owned_commands)} commands\n{batch}{result.stdout}{result.stderr}")
+    failed = {}
+    for line_no, message in parse_batch_failures(result.stderr).items():
+        if 1 <= line_no <= len(owned_commands):
+            failed.setdefault(owned_commands[line_no - 1][0], message)
+    if result.returncode != 0 and not failed:
+        # Whole-exec failure (tool missing, timeout): every owner failed
+        error = result.stderr.strip() or f"{tool} exited {result.returncode}"
+        failed = {owner: error for owner, _ in owned_commands}
+    return failed
+
+
+def restore_desired_state(existing=None):
+    """
+    Rebuild every recorded tree in one pass: one 'tc qdisc show' finds interfaces
+    that still carry a tree (kept as they are), recorded interfaces that no longer
+    exist are skipped, and the rest are programmed with RESTORE_WORKERS tc
+    batches in parallel — plus one ip batch that creates the IFBs the ingress
+    entries need. Interfaces whose lines fail are torn down again so no
+    half-built tree is left classifying traffic. existing overrides the interface
+    names read from /sys/class/net. Progress: get_restore_progress().
+    """
+    state = load_desired_state()
+    start = time.monotonic()
+    with _restore_lock:
+        _restore_progress.update({'state': 'running', 'total': len(state), 'done': 0, 'restored': [],
+                                  'present': [], 'skipped': [], 'failed': {}, 'seconds': None})
+    if not state:
+        with _restore_lock:
+            _restore_progress.update({'state': 'done', 'seconds': 0.0})
+        return get_restore_progress()
+
     try:
-        alias = get_interface_alias(interface)
-        display_name = f"{interface} ({alias})" if alias and alias != interface else interface
-
-        check_result = subprocess.run(
-            ['sudo', 'tc', 'qdisc', 'show', 'dev', interface],
-            capture_output=True, text=True
-        )
-        log_command(['sudo', 'tc', 'qdisc', 'show', 'dev', interface], check_result.stdout)
+        roots, ingress = read_custom_roots()
+        existing = set(existing if existing is not None else os.listdir('/sys/class/net'))
+    except Exception as e:
+        logging.error(f"Impairment restore aborted: {e}")
+        for interface in state:
+            _restore_mark(interface, 'failed', str(e))
+        with _restore_lock:
+            _restore_progress.update({'state': 'done', 'seconds': time.monotonic() - start})
+        return get_restore_progress()
+
+    pending = {}  # interface -> list of (direction, entry)
+    for interface, directions in state.items():
+        if interface not in existing:
+            _restore_mark(interface, 'skipped')
+            continue
+        todo = [(direction, entry) for direction, entry in directions.items()
+                if not (direction == 'egress' and interface in roots)
+                and not (direction == 'ingress' and interface in ingress)]
+        if todo:
+            pending[interface] = todo
+        else:
+            _restore_mark(interface, 'present')
 
-        has_custom = any(kw in check_result.stdout for kw in ('netem', 'htb', 'tbf', 'prio'))
-        if has_custom:
-            # Deleting root cascades all child classes and qdiscs
-            result = subprocess.run(
-                ['sudo', 'tc', 'qdisc', 'del', 'dev', interface, 'root'],
-                capture_output=True, text=True
-            )
-            log_command(['sudo', 'tc', 'qdisc', 'del', 'dev', interface, 'root'], result.stdout)
-            if result.returncode != 0:
-                flash(f"Error removing qdisc from {display_name}: {result.stderr}", "error")
-                logging.error(f"Error removing qdisc from {interface} (rc={result.returncode}): {result.stderr}")
-            else:
-                flash(f"Network conditions removed from {display_name}", "success")
+    ip_commands, tc_groups, ipset_jobs, failed = [], {}, {}, {}
+    cfg = load_admin_config()
+    for interface, todo in pending.items():
+        for direction, entry in todo:
+            try:
+                rx_queues = get_rx_queue_count(interface) if direction == 'ingress' else 1
+                ip_cmds, tc_cmds, ipset_rules = build_restore_commands(interface, direction, entry, rx_queues,
+                                                                       queue_sizing(interface, cfg))
+            except Exception as e:
+                failed.setdefault(interface, f"{direction}: {e}")
+                continue
+            ip_commands += [(interface, c) for c in ip_cmds]
+            # Ingress tc lines reference the IFB, so they go in a batch that runs after the ip batch
+            tc_groups.setdefault((direction, interface), []).extend(tc_cmds)
+            if ipset_rules is not None:
+                ipset_jobs[interface] = ipset_rules
+
+    egress = [(iface, c) for (direction, iface), cmds in tc_groups.items() if direction == 'egress' for c in cmds]
+    ingress_tc = [(iface, c) for (direction, iface), cmds in tc_groups.items() if direction == 'ingress' for c in cmds]
+    owners = sorted({iface for iface, _ in egress})
+    chunks = [set(owners[i::RESTORE_WORKERS]) for i in range(min(RESTORE_WORKERS, len(owners)))]
+    results = []
+
+    def egress_worker(chunk):
+        results.append(run_owned_batch('tc', [(i, c) for i, c in egress if i in chunk]))
+
+    def ingress_worker():
+        ip_failed = run_owned_batch('ip', ip_commands)
+        results.append(ip_failed)
+        results.append(run_owned_batch('tc', [(i, c) for i, c in ingress_tc if i not in ip_failed]))
+
+    threads = [threading.Thread(target=egress_worker, args=(chunk,), name=f'restore-{n}')
+               for n, chunk in enumerate(chunks)]
+    if ip_commands or ingress_tc:
+        threads.append(threading.Thread(target=ingress_worker, name='restore-ingress'))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for result in results:
+        for interface, error in result.items():
+            failed.setdefault(interface, error)
+
+    for interface, rules in ipset_jobs.items():
+        if interface not in failed:
+            ok, errors = install_matrix_classifier(interface, rules)
+            if not ok:
+                failed[interface] = '; '.join(errors)
+
+    if failed:
+        # Tear the half-built trees down again in one batch per tool
+        teardown_tc, teardown_ip = [], []
+        for interface in failed:
+            for direction, _ in pending.get(interface, []):
+                if direction == 'egress':
+                    teardown_tc.append(['qdisc', 'del', 'dev', interface, 'root'])
+                else:
+                    teardown_tc.append(['qdisc', 'del', 'dev', interface, 'ingress'])
+                    teardown_ip.append(['link', 'del', ifb_name_for(interface)])
+            if interface in ipset_jobs:
+                remove_matrix_classifier(interface)
+        run_tc_batch(teardown_tc)
+        run_ip_batch(teardown_ip)
+        logging.error(f"Impairment restore failed on {sorted(failed)}: {failed}")
+
+    for interface in pending:
+        if interface in failed:
+            _restore_mark(interface, 'failed', failed[interface])
         else:
-            logging.info(f"No custom qdisc to remove on {interface}")
-    except subprocess.SubprocessError as e:
-        flash(f"Failed to execute tc command for {interface}: {str(e)}", "error")
-        logging.error(f"Subprocess error removing qdisc from {interface}: {str(e)}")
-    except Exception as e:
-        flash(f"Error removing network conditions from {interface}: {str(e)}", "error")
-        logging.error(f"Error in remove_degradations for {interface}: {str(e)}")
+            invalidate_interface_state(interface)
+            _restore_mark(interface, 'restored')
+    with _restore_lock:
+        _restore_progress.update({'state': 'done', 'seconds': time.monotonic() - start})
+    progress = get_restore_progress()
+    logging.info(f"Impairment restore: {len(progress['restored'])} restored, {len(progress['present'])} already present, "
+                 f"{len(progress['skipped'])} skipped (missing), {len(progress['failed'])} failed "
+                 f"in {progress['seconds']:.2f}s")
+    return progress
+
+
+def startup_restore():
+    """Startup housekeeping thread: rebuild recorded trees, then garbage-collect stale IFBs."""
+    if HELPER_SOCKET:
+        wait_for_helper()
+    if RESTORE_ON_START:
+        restore_desired_state()
+    # After the restore, so an IFB created by it is never mistaken for a leftover
+    gc_ingress_ifbs()
+
 
 def is_tcpdump_available():
     """Check if tcpdump is installed on the system"""
     try:
-        result = subprocess.run(['which', 'tcpdump'], capture_output=True, text=True)
+        result = run_cmd(['which', 'tcpdump'])
         logging.info(f"tcpdump availability check: {'Available' if result.returncode == 0 else 'Not available'}")
         return result.returncode == 0
     except Exception as e:
@@ -738,7 +3525,7 @@ def is_tcpdump_available():
 def is_tc_available():
     """Check if tc utility is installed on the system"""
     try:
-        result = subprocess.run(['which', 'tc'], capture_output=True, text=True)
+        result = run_cmd(['which', 'tc'])
         logging.info(f"tc utility availability check: {'Available' if result.returncode == 0 else 'Not available'}")
         return result.returncode == 0
     except Exception as e:
@@ -748,7 +3535,7 @@ def is_tc_available():
 def is_ip_available():
     """Check if ip command is installed on the system (from iproute2 package)"""
     try:
-        result = subprocess.run(['which', 'ip'], capture_output=True, text=True)
+        result = run_cmd(['which', 'ip'])
         logging.info(f"ip command availability check: {'Available' if result.returncode == 0 else 'Not available'}")
         return result.returncode == 0
     except Exception as e:
@@ -792,9 +3579,11 @@ def get_nat_status(interface):
     else:
         final_cmd = ['sudo'] + base_cmd_parts
         log_context_message = "host (direct sudo)"
+    if current_netns():
+        log_context_message = f"netns {current_netns()}"
 
     try:
-        result = subprocess.run(final_cmd, capture_output=True, text=True, check=False)
+        result = run_cmd(final_cmd)
         log_command(final_cmd, f"Return code: {result.returncode}, Stdout: {result.stdout.strip()}, Stderr: {result.stderr.strip()} (Context: {log_context_message})")
         return result.returncode == 0
     except Exception as e:
@@ -805,44 +3594,125 @@ def get_nat_status(interface):
 # Route table management helpers
 # ---------------------------------------------------------------------------
 
-def parse_routes(ip_version=4):
+ROUTES_PER_PAGE     = 100
+MAX_ROUTES_PER_PAGE = 1000
+
+
+def iter_json_array(chunks):
+    """
+    Incrementally decode a top-level JSON array (as printed by 'ip -j') from an
+    iterable of text chunks, yielding one element at a time.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n[,':
+                pos += 1
+            if pos >= len(buf) or buf[pos] == ']':
+                break
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                break  # element continues in the next chunk
+            yield obj
+        buf = buf[pos:]
+    if buf.strip(' \t\r\n]'):
+        logging.error(f"Trailing data after JSON array: {buf[:80]!r}")
+
+
+def route_from_json(entry):
+    """Compact route dict from one 'ip -j route' element."""
+    destination = entry.get('dst', '')
+    if entry.get('type') not in (None, 'unicast'):
+        destination = f"{entry['type']} {destination}"
+    return {
+        'destination': destination,
+        'gateway': entry.get('gateway', ''),
+        'interface': entry.get('dev', ''),
+        'proto': entry.get('protocol', ''),
+        'metric': str(entry['metric']) if 'metric' in entry else '',
+        'scope': entry.get('scope', ''),
+        'src': entry.get('prefsrc', ''),
+        'table': entry.get('table', ''),
+    }
+
+
+def route_matcher(prefix=None, interface=None, proto=None):
+    """
+    Predicate over raw 'ip -j route' elements. prefix is a CIDR (routes inside it
+    match; 'default' counts as /0) or, if not a valid network, a text prefix of
+    the destination.
+    """
+    import ipaddress
+    network = None
+    if prefix:
+        try:
+            network = ipaddress.ip_network(prefix, strict=False)
+        except ValueError:
+            pass
+    if network is not None:
+        # Integer compare via inet_pton: ip_network() per route is too slow for full tables
+        family = socket.AF_INET if network.version == 4 else socket.AF_INET6
+        net_int, net_len, max_len = int(network.network_address), network.prefixlen, network.max_prefixlen
+        mask = ((1 << net_len) - 1) << (max_len - net_len)
+
+    def inside(dst):
+        if dst == 'default':
+            return net_len == 0
+        addr, _, plen = dst.partition('/')
+        try:
+            if (int(plen) if plen else max_len) < net_len:
+                return False
+            return int.from_bytes(socket.inet_pton(family, addr), 'big') & mask == net_int
+        except (OSError, ValueError):
+            return False
+
+    def matches(entry):
+        if interface and entry.get('dev') != interface:
+            return False
+        if proto and entry.get('protocol', '') != proto:
+            return False
+        if prefix:
+            dst = entry.get('dst', '')
+            return dst.startswith(prefix) if network is None else inside(dst)
+        return True
+    return matches
+
+
+def query_routes(ip_version=4, prefix=None, interface=None, proto=None, table=None, offset=0, limit=None):
     """
-    Run 'ip [−6] route show' and return a list of dicts with parsed fields.
-    Each dict has: destination, gateway, interface, proto, metric, scope, src, raw.
+    Stream 'ip [-6] -j route show [table T]' and return (routes, total): total is the
+    number of routes matching the filters, routes the [offset, offset+limit) slice
+    of them. Only that slice is turned into dicts, so memory stays flat on hosts
+    carrying full BGP tables.
     """
+    cmd = ['ip', '-j'] + (['-6'] if ip_version == 6 else []) + ['route', 'show']
+    if table:
+        cmd += ['table', table]
+    matches = route_matcher(prefix, interface, proto)
+    routes, total = [], 0
     try:
-        cmd = ['ip', '-6', 'route', 'show'] if ip_version == 6 else ['ip', 'route', 'show']
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        log_command(cmd, result.stdout)
-        routes = []
-        for line in result.stdout.strip().splitlines():
-            line = line.strip()
-            if not line:
+        for entry in iter_json_array(stream_cmd(cmd)):
+            if not matches(entry):
                 continue
-            route = {
-                'destination': '', 'gateway': '', 'interface': '',
-                'proto': '', 'metric': '', 'scope': '', 'src': '', 'raw': line,
-            }
-            parts = line.split()
-            if parts:
-                route['destination'] = parts[0]
-            i = 1
-            while i < len(parts):
-                key = parts[i]
-                if key in ('via', 'dev', 'proto', 'metric', 'scope', 'src') and i + 1 < len(parts):
-                    field_map = {
-                        'via': 'gateway', 'dev': 'interface', 'proto': 'proto',
-                        'metric': 'metric', 'scope': 'scope', 'src': 'src',
-                    }
-                    route[field_map[key]] = parts[i + 1]
-                    i += 2
-                else:
-                    i += 1
-            routes.append(route)
-        return routes
+            if total >= offset and (limit is None or len(routes) < limit):
+                routes.append(route_from_json(entry))
+            total += 1
+        log_command(cmd, f"{total} routes matched")
     except Exception as e:
         logging.error(f"Error parsing IPv{ip_version} routes: {str(e)}")
-        return []
+    return routes, total
+
+
+def parse_routes(ip_version=4):
+    """
+    Return every route of the main table as a list of dicts with: destination,
+    gateway, interface, proto, metric, scope, src, table.
+    """
+    return query_routes(ip_version)[0]
 
 
 def exec_ip_route(args, ip_version=4):
@@ -854,41 +3724,1156 @@ def exec_ip_route(args, ip_version=4):
     if ip_version == 6:
         cmd.append('-6')
     cmd.extend(['route'] + args)
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    result = run_cmd(cmd)
     log_command(cmd, result.stdout + result.stderr)
     return result.returncode == 0, result.stderr.strip()
 
 
+# ---------------------------------------------------------------------------
+# Bulk route / address / MTU operations — one 'ip -batch' exec per request.
+# Items come as JSON objects or as text lines:
+#   routes:      [add|del|replace] <dst> [via GW] [dev IF] [metric N] [table T] [proto P] [scope S] [src A]
+#   interfaces:  [add|del] <iface> <address/len>     mtu <iface> <mtu>
+# Non-strict batches run with -force and report every item. Strict batches
+# stop at the first failure and undo the items already applied (from a
+# pre-read of the affected routes / MTUs), so nothing is left half-done.
+# ---------------------------------------------------------------------------
+BULK_MAX_ITEMS     = 100_000
+BULK_ROUTE_ACTIONS = ('add', 'del', 'replace')
+BULK_ROUTE_KEYS    = {'via': 'gateway', 'dev': 'interface', 'metric': 'metric', 'table': 'table',
+                      'proto': 'proto', 'scope': 'scope', 'src': 'src'}
+IFNAME_RE          = re.compile(r'^[A-Za-z0-9_.:@-]{1,15}$')
+ROUTE_WORD_RE      = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+
+def parse_bulk_lines(text):
+    """Non-empty, non-comment lines of a bulk text/file upload."""
+    return [line.strip() for line in (text or '').splitlines()
+            if line.strip() and not line.strip().startswith('#')]
+
+
+def parse_route_line(line):
+    """'add 10.0.0.0/24 via 10.0.0.1 dev eth0 metric 10' -> route item dict (the action is optional)."""
+    tokens = line.split()
+    item = {'action': 'add'}
+    if tokens and tokens[0] in BULK_ROUTE_ACTIONS:
+        item['action'] = tokens.pop(0)
+    if not tokens:
+        return {'error': 'missing destination'}
+    item['destination'] = tokens.pop(0)
+    while tokens:
+        key = tokens.pop(0)
+        if key not in BULK_ROUTE_KEYS or not tokens:
+            return {'error': f"unexpected '{key}'"}
+        item[BULK_ROUTE_KEYS[key]] = tokens.pop(0)
+    return item
+
+
+def route_args_from_json(entry):
+    """ip route arguments that recreate one 'ip -j route' element (used for strict-mode undo)."""
+    args = ([entry['type']] if entry.get('type') not in (None, 'unicast') else []) + [entry.get('dst', '')]
+    for key, json_key in (('via', 'gateway'), ('dev', 'dev'), ('proto', 'protocol'), ('scope', 'scope'),
+                          ('src', 'prefsrc'), ('metric', 'metric'), ('table', 'table')):
+        if json_key in entry:
+            args += [key, str(entry[json_key])]
+    return args
+
+
+def build_route_op(item, ip_version=4):
+    """
+    Validate one route item and return (op, error). op has 'label', 'do' (ip
+    arguments) and 'key' (destination, table) used to look up the prior state.
+    """
+    import ipaddress
+    if isinstance(item, str):
+        item = parse_route_line(item)
+    if not isinstance(item, dict):
+        return None, 'item must be an object or a line of text'
+    if item.get('error'):
+        return None, item['error']
+    action = str(item.get('action') or 'add')
+    destination = str(item.get('destination') or '').strip()
+    if action not in BULK_ROUTE_ACTIONS:
+        return None, f"unknown action '{action}'"
+    version = str(item.get('ip_version') or ip_version)
+    if version not in ('4', '6'):
+        return None, f"invalid ip_version '{item.get('ip_version')}' (4 or 6)"
+    version = int(version)
+    if destination == 'default':
+        destination = '::/0' if version == 6 else '0.0.0.0/0'
+    try:
+        destination = str(ipaddress.ip_network(destination, strict=False))
+    except ValueError:
+        return None, f"invalid destination '{destination}'"
+    args = [action, destination]
+    gateway = str(item.get('gateway') or '').strip()
+    if gateway:
+        try:
+            ipaddress.ip_address(gateway)
+        except ValueError:
+            return None, f"invalid gateway '{gateway}'"
+        args += ['via', gateway]
+    interface = str(item.get('interface') or '').strip()
+    if interface:
+        if not IFNAME_RE.match(interface):
+            return None, f"invalid interface '{interface}'"
+        args += ['dev', interface]
+    for key in ('proto', 'scope', 'table'):
+        value = str(item.get(key) or '').strip()
+        if value:
+            if not ROUTE_WORD_RE.match(value):
+                return None, f"invalid {key} '{value}'"
+            args += [key, value]
+    src = str(item.get('src') or '').strip()
+    if src:
+        try:
+            ipaddress.ip_address(src)
+        except ValueError:
+            return None, f"invalid src '{src}'"
+        args += ['src', src]
+    metric = str(item.get('metric') or '').strip()
+    if metric:
+        if not metric.isdigit():
+            return None, f"invalid metric '{metric}'"
+        args += ['metric', metric]
+    if action == 'add' and not gateway and not interface:
+        return None, 'a gateway (via) or interface (dev) is required'
+    return {'label': ' '.join(args), 'do': ['route'] + args,
+            'key': (destination, str(item.get('table') or 'main'))}, None
+
+
+def build_interface_op(item):
+    """Validate one address / MTU item and return (op, error)."""
+    import ipaddress
+    if isinstance(item, str):
+        tokens = item.split()
+        if tokens and tokens[0] == 'mtu' and len(tokens) == 3:
+            item = {'interface': tokens[1], 'mtu': tokens[2]}
+        elif tokens and tokens[0] in ('add', 'del') and len(tokens) == 3:
+            item = {'action': tokens[0], 'interface': tokens[1], 'address': tokens[2]}
+        elif len(tokens) == 2:
+            item = {'action': 'add', 'interface': tokens[0], 'address': tokens[1]}
+        else:
+            return None, "expected '[add|del] <iface> <address>' or 'mtu <iface> <mtu>'"
+    if not isinstance(item, dict):
+        return None, 'item must be an object or a line of text'
+    interface = str(item.get('interface') or '').strip()
+    if not IFNAME_RE.match(interface):
+        return None, f"invalid interface '{interface}'"
+    if 'mtu' in item:
+        try:
+            mtu = int(item['mtu'])
+            if not (68 <= mtu <= 65535):
+                raise ValueError
+        except (TypeError, ValueError):
+            return None, f"invalid MTU '{item['mtu']}' (68-65535)"
+        return {'label': f"mtu {interface} {mtu}", 'kind': 'mtu', 'interface': interface,
+                'do': ['link', 'set', 'dev', interface, 'mtu', str(mtu)]}, None
+    action = str(item.get('action') or 'add')
+    if action not in ('add', 'del'):
+        return None, f"unknown action '{action}'"
+    try:
+        address = str(ipaddress.ip_interface(str(item.get('address') or '').strip()))
+    except ValueError:
+        return None, f"invalid address '{item.get('address')}'"
+    undo = 'del' if action == 'add' else 'add'
+    return {'label': f"{action} {interface} {address}", 'kind': 'addr', 'interface': interface,
+            'do': ['address', action, address, 'dev', interface],
+            'undo': [['address', undo, address, 'dev', interface]]}, None
+
+
+def parse_batch_failures(stderr):
+    """Map 1-based batch line -> error message from 'ip -batch' stderr ('Command failed -:N')."""
+    failures, messages = {}, []
+    for line in stderr.splitlines():
+        line = line.strip()
+        m = re.match(r'^Command failed -:(\d+)$', line)
+        if m:
+            failures[int(m.group(1))] = '; '.join(messages) or 'failed'
+            messages = []
+        elif line and not line.startswith('Warning:'):
+            messages.append(line)
+    return failures
+
+
+def add_route_undo(ops):
+    """
+    Fill in 'undo' for route ops from one dump per family of the current tables:
+    add -> del (or restore the replaced route), del/replace -> re-add the old route.
+    """
+    existing = {}
+    for version in (4, 6):
+        cmd = ['ip', '-j'] + (['-6'] if version == 6 else []) + ['route', 'show', 'table', 'all']
+        for entry in iter_json_array(stream_cmd(cmd)):
+            if entry.get('type') not in (None, 'unicast'):
+                continue
+            dst = entry.get('dst', '')
+            if dst == 'default':
+                dst = '::/0' if version == 6 else '0.0.0.0/0'
+            elif '/' not in dst:
+                dst += '/128' if ':' in dst else '/32'
+            existing.setdefault((dst, str(entry.get('table', 'main'))), entry)
+    for op in ops:
+        action, old = op['do'][1], existing.get(op['key'])
+        undo = []
+        if action in ('add', 'replace'):
+            undo.append(['route', 'del'] + op['do'][2:])
+        if action in ('del', 'replace') and old is not None:
+            undo.append(['route', 'replace'] + route_args_from_json(old))
+        op['undo'] = undo if (action != 'del' or old is not None) else None
+
+
+def run_ip_bulk(ops, strict=False):
+    """
+    Apply ops (from build_*_op) in one 'ip -batch' exec and return per-op results:
+    [{'item', 'status': ok|failed|skipped|rolled_back|rollback_failed, 'error'}].
+    """
+    if not ops:
+        return []
+    batch = ''.join(' '.join(op['do']) + '\n' for op in ops)
+    cmd = ['sudo', 'ip'] + ([] if strict else ['-force']) + ['-batch', '-']
+    result = run_cmd(cmd, input=batch)
+    log_command(cmd, f"{len(ops)} commands\n{result.stdout}{result.stderr}")
+    failures = parse_batch_failures(result.stderr)
+    if result.returncode != 0 and not failures:
+        # sudo/ip itself failed: nothing was applied
+        failures = {1: result.stderr.strip() or f'ip exited with {result.returncode}'}
+        if not strict:
+            failures = {i + 1: failures[1] for i in range(len(ops))}
+
+    results = [{'item': op['label'], 'status': 'ok', 'error': None} for op in ops]
+    if not strict:
+        for line, message in failures.items():
+            if 1 <= line <= len(ops):
+                results[line - 1].update(status='failed', error=message)
+        return results
+
+    if not failures:
+        return results
+    first = min(failures)
+    results[first - 1].update(status='failed', error=failures[first])
+    for r in results[first:]:
+        r['status'] = 'skipped'
+    applied = ops[:first - 1]
+    undo = [cmd for op in reversed(applied) for cmd in (op.get('undo') or [])]
+    undo_failures = {}
+    if undo:
+        undo_cmd = ['sudo', 'ip', '-force', '-batch', '-']
+        undo_result = run_cmd(undo_cmd, input=''.join(' '.join(u) + '\n' for u in undo))
+        log_command(undo_cmd, f"rollback of {len(undo)} commands\n{undo_result.stderr}")
+        undo_failures = parse_batch_failures(undo_result.stderr)
+    undo_line = 0
+    for index in range(len(applied) - 1, -1, -1):
+        op, r = applied[index], results[index]
+        if op.get('undo') is None:
+            r.update(status='rollback_failed', error='no prior state to restore')
+            continue
+        lines = range(undo_line + 1, undo_line + len(op['undo']) + 1)
+        undo_line += len(op['undo'])
+        errors = [undo_failures[n] for n in lines if n in undo_failures]
+        if errors:
+            r.update(status='rollback_failed', error='; '.join(errors))
+        else:
+            r['status'] = 'rolled_back'
+    return results
+
+
+def bulk_apply(items, builder, strict=False, prepare=None):
+    """
+    Validate items with builder, apply the valid ones with run_ip_bulk and return
+    a summary dict: strict, total, applied, failed, results (in item order).
+    In strict mode one invalid item means nothing is applied.
+    """
+    items = list(items)[:BULK_MAX_ITEMS + 1]
+    if len(items) > BULK_MAX_ITEMS:
+        return {'strict': strict, 'total': len(items), 'applied': 0, 'failed': len(items),
+                'error': f'too many items (max {BULK_MAX_ITEMS})', 'results': []}
+    results, ops, positions = [], [], []
+    for index, item in enumerate(items):
+        op, error = builder(item)
+        label = item if isinstance(item, str) else json.dumps(item, sort_keys=True)
+        results.append({'index': index, 'item': op['label'] if op else label,
+                        'status': 'invalid' if error else 'pending', 'error': error})
+        if op:
+            ops.append(op)
+            positions.append(index)
+
+    if strict and len(ops) != len(items):
+        for r in results:
+            if r['status'] == 'pending':
+                r['status'] = 'skipped'
+        ops = []
+    if ops and strict and prepare:
+        prepare(ops)
+    for index, outcome in zip(positions if ops else [], run_ip_bulk(ops, strict)):
+        results[index].update(outcome)
+    applied = sum(1 for r in results if r['status'] == 'ok')
+    return {'strict': strict, 'total': len(items), 'applied': applied,
+            'failed': len(items) - applied, 'results': results}
+
+
+def add_interface_undo(ops):
+    """MTU undo from sysfs (address ops carry their own undo)."""
+    for op in ops:
+        if op['kind'] == 'mtu':
+            mtu = get_mtu(op['interface'])
+            op['undo'] = [['link', 'set', 'dev', op['interface'], 'mtu', str(mtu)]] if mtu else None
+
+
+def read_bulk_request(list_keys):
+    """
+    Items, strict flag and error from a bulk request: JSON {<key>: [...], "strict": bool}
+    (several keys are concatenated), or a form with 'bulk_file' / 'bulk_text' lines
+    and a 'strict' checkbox. error is set (and nothing should be applied) when the
+    JSON body is not an object of lists; a bad item is left to the builder.
+    """
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if data is None:
+            data = {}
+        if not isinstance(data, dict):
+            return [], False, 'Body must be a JSON object'
+        items = []
+        for key in list_keys:
+            value = data.get(key) or []
+            if not isinstance(value, list):
+                return [], False, f"'{key}' must be a list"
+            items += value
+        return items, bool(data.get('strict')), None
+    text = request.form.get('bulk_text', '')
+    upload = request.files.get('bulk_file')
+    if upload and upload.filename:
+        text = upload.read().decode('utf-8', errors='replace')
+    return parse_bulk_lines(text), 'strict' in request.form, None
+
+
+def flash_bulk_summary(summary, noun):
+    """Flash a bulk result summary plus the first few item errors."""
+    if summary.get('error'):
+        flash(summary['error'], 'error')
+        return
+    category = 'success' if not summary['failed'] else ('warning' if summary['applied'] else 'error')
+    rolled_back = sum(1 for r in summary['results'] if r['status'] == 'rolled_back')
+    message = f"Applied {summary['applied']} of {summary['total']} {noun}"
+    if rolled_back:
+        message += f" ({rolled_back} rolled back after a failure in strict mode)"
+    flash(message + '.', category)
+    errors = [r for r in summary['results'] if r['error']]
+    for r in errors[:10]:
+        flash(f"{r['item']}: {r['error']}", 'error')
+    if len(errors) > 10:
+        flash(f"... and {len(errors) - 10} more errors", 'error')
+
+
+# ---------------------------------------------------------------------------
+# HTTP caching and compression
+#   Every GET that returns HTML or JSON carries a weak ETag of its body, so
+#   clients that send If-None-Match get a body-less 304 when nothing changed.
+#   The state views go further: the index page and its rows, the interface
+#   page, /interface/<name>/state, /routes, /routes/data and /api/v1/state.
+#   While the netlink monitor keeps the state cache fresh, their ETag is
+#   derived from a snapshot of their inputs, so a matching request is answered
+#   304 before any state is gathered or rendered. The snapshot covers the view
+#   and its arguments, the state generation (bumped on every cache
+#   invalidation and route change), the admin, alias and recorded-impairment
+#   files and the restore progress. It is skipped while flash messages are
+#   pending. Live counters (/interface/<name>/stats, /stats/commands) keep the
+#   body ETag only.
+#   Responses of HTTP_GZIP_MIN_BYTES or more are gzip-compressed for clients
+#   that accept it. Static files are linked as /static/<file>?v=<content hash>
+#   and served with a STATIC_MAX_AGE cache lifetime.
+# ---------------------------------------------------------------------------
+
+HTTP_GZIP_MIN_BYTES = int(os.environ.get('HTTP_GZIP_MIN_BYTES', '1024'))
+HTTP_GZIP_LEVEL     = int(os.environ.get('HTTP_GZIP_LEVEL', '6'))
+STATIC_MAX_AGE      = int(os.environ.get('STATIC_MAX_AGE', str(365 * 86400)))
+COMPRESSIBLE_TYPES  = ('text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+                       'application/json', 'application/javascript', 'image/svg+xml')
+
+_boot_token = uuid.uuid4().hex  # templates and code may differ after a restart
+_static_versions = {}  # filename -> (mtime_ns, content hash)
+_static_gzip = {}      # (filename, mtime_ns) -> compressed bytes
+
+
+def static_version(filename):
+    """Short content hash of a static file (recomputed when its mtime changes), or None."""
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _static_versions.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    _static_versions[filename] = (mtime, digest)
+    return digest
+
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        version = static_version(values['filename'])
+        if version:
+            values['v'] = version
+
+
+def state_etag(view):
+    """
+    ETag of everything a state view shows, taken before any state is gathered,
+    or None when only rendering can tell. view names the view and its path
+    arguments ('index', 'interface:eth0'); the query string is added here.
+    """
+    if not _monitor_active.is_set() or list_netns() or session.get('_flashes'):
+        return None
+    parts = [_boot_token, view, request.query_string.decode('latin-1'), str(_state_generation),
+             str(int(time.monotonic() // STATE_CACHE_TTL))]
+    for path in (ADMIN_CONFIG_PATH, ALIASES_FILE, IMPAIRMENT_STATE_PATH):
+        try:
+            parts.append(str(os.stat(path).st_mtime_ns))
+        except OSError:
+            parts.append('-')
+    progress = get_restore_progress()
+    parts.append(f"{progress['state']}:{progress['done']}")
+    return 'st-' + hashlib.sha256('|'.join(parts).encode()).hexdigest()[:24]
+
+
+def not_modified(etag):
+    """A 304 response if the request already holds etag, else None."""
+    if etag and request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    return None
+
+
+def with_etag(body, etag):
+    """Response for body carrying etag (weak), if there is one."""
+    response = make_response(body)
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def _gzip_static(response):
+    """Compressed body of a static file response, compressed once per file version."""
+    filename = request.view_args.get('filename', '')
+    mtime = _static_versions.get(filename, (None,))[0]
+    key = (filename, mtime)
+    if mtime is None or key not in _static_gzip:
+        response.direct_passthrough = False
+        data = gzip.compress(response.get_data(), HTTP_GZIP_LEVEL)
+        if mtime is None:
+            return data
+        _static_gzip[key] = data
+    return _static_gzip[key]
+
+
+@app.after_request
+def add_http_caching(response):
+    """Weak ETag + conditional 304 for HTML/JSON GETs, long-lived static caching, gzip."""
+    static = request.endpoint == 'static'  # file responses count as streamed
+    if request.method not in ('GET', 'HEAD') or response.status_code != 200 or (response.is_streamed and not static):
+        return response
+    compressible = response.mimetype in COMPRESSIBLE_TYPES
+    if static:
+        if request.args.get('v'):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+    elif compressible:
+        if not response.get_etag()[0]:
+            response.add_etag(weak=True)
+        response.make_conditional(request)
+        if response.status_code != 200:
+            return response
+    if not compressible:
+        return response
+    response.vary.add('Accept-Encoding')
+    length = response.content_length
+    if ('gzip' not in request.accept_encodings or response.content_encoding
+            or request.range or (length is not None and length < HTTP_GZIP_MIN_BYTES)):
+        return response
+    if static:
+        data = _gzip_static(response)
+    else:
+        data = response.get_data()
+        if len(data) < HTTP_GZIP_MIN_BYTES:
+            return response
+        data = gzip.compress(data, HTTP_GZIP_LEVEL)
+    response.set_data(data)
+    response.content_encoding = 'gzip'
+    etag, weak = response.get_etag()
+    if etag and not weak:  # the bytes now differ from the uncompressed representation
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# ---------------------------------------------------------------------------
+# Background jobs — long mutations (Reset All, bulk route imports, fleet
+# applies) run on a small worker pool instead of the request thread. The
+# endpoint answers at once with a job id; progress is polled from
+# GET /jobs/<id> or streamed from GET /jobs/<id>/events, per item (interface,
+# agent interface or route). Submitting work whose key matches a queued or
+# running job returns that job instead of starting the work twice.
+#   JOB_WORKERS        worker threads (default 2)
+#   JOB_RETENTION      seconds a finished job stays queryable (default 3600)
+#   JOB_MAX_FINISHED   finished jobs kept at most, oldest dropped first (default 200)
+#   JOB_CHUNK          routes per 'ip -batch' in a non-strict bulk import job (default 1000)
+# ---------------------------------------------------------------------------
+
+JOB_WORKERS      = max(1, int(os.environ.get('JOB_WORKERS', '2')))
+JOB_RETENTION    = float(os.environ.get('JOB_RETENTION', '3600'))
+JOB_MAX_FINISHED = max(1, int(os.environ.get('JOB_MAX_FINISHED', '200')))
+JOB_CHUNK        = max(1, int(os.environ.get('JOB_CHUNK', '1000')))
+
+_jobs = {}                                  # id -> record, in submission order
+_jobs_lock = threading.Lock()
+_jobs_changed = threading.Condition(_jobs_lock)
+_job_queue = queue.Queue()
+_job_threads = []
+
+
+def _job_snapshot(job):
+    """Public copy of a job record (private '_' keys dropped, items as a list)."""
+    snapshot = {k: v for k, v in job.items() if not k.startswith('_')}
+    snapshot['items'] = [dict(item, messages=list(item['messages'])) for item in job['items'].values()]
+    snapshot['messages'] = list(job['messages'])
+    return snapshot
+
+
+def _job_touch(job):
+    """Caller holds _jobs_lock: bump the job's version and wake progress streams."""
+    job['version'] += 1
+    _jobs_changed.notify_all()
+
+
+def _prune_jobs():
+    """Caller holds _jobs_lock: drop finished jobs past JOB_RETENTION or beyond JOB_MAX_FINISHED."""
+    now = time.time()
+    finished = [job for job in _jobs.values() if job['finished'] is not None]
+    expired = [job for job in finished if now - job['finished'] > JOB_RETENTION]
+    expired += [job for job in finished if job not in expired][:max(0, len(finished) - len(expired) - JOB_MAX_FINISHED)]
+    for job in expired:
+        _jobs.pop(job['id'], None)
+
+
+def submit_job(kind, title, fn, items=(), total=None, key=None):
+    """
+    Queue fn(job) on the job workers and return (job snapshot, created).
+    items are the labels progress is reported for (see job_progress); total
+    defaults to their number. fn runs in a request context of its own, in the
+    submitting request's network namespace; whatever it flashes ends up in the
+    job's messages and its return value in 'result'. When key matches a queued
+    or running job, that job is returned with created=False.
+    """
+    with _jobs_lock:
+        _prune_jobs()
+        if key:
+            for job in _jobs.values():
+                if job['_key'] == key and job['finished'] is None:
+                    return _job_snapshot(job), False
+        job = {
+            'id': uuid.uuid4().hex[:12], 'kind': kind, 'title': title, 'state': 'queued',
+            'netns': current_netns(), 'created': time.time(), 'started': None, 'finished': None,
+            'total': len(items) if total is None else total, 'done': 0, 'failed': 0,
+            'items': {label: {'name': label, 'status': 'pending', 'messages': []} for label in items},
+            'messages': [], 'result': None, 'error': None, 'version': 0,
+            '_key': key, '_fn': fn,
+        }
+        _jobs[job['id']] = job
+        while len(_job_threads) < JOB_WORKERS:
+            t = threading.Thread(target=_job_worker, name=f'job-{len(_job_threads)}', daemon=True)
+            _job_threads.append(t)
+            t.start()
+        snapshot = _job_snapshot(job)
+    _job_queue.put(job['id'])
+    logging.info(f"Job {job['id']} queued: {title}")
+    return snapshot, True
+
+
+def job_progress(job, label, status, messages=None):
+    """
+    Record the outcome of one item of a running job: status is 'ok', 'failed'
+    or 'skipped'. Without messages, whatever was flashed since the previous
+    item is attached to this one.
+    """
+    if messages is None:
+        messages = [message for _, message in session.pop('_flashes', [])]
+    with _jobs_lock:
+        item = job['items'].setdefault(label, {'name': label, 'status': 'pending', 'messages': []})
+        previous = item['status']
+        item['status'] = status
+        item['messages'] += messages
+        if previous == 'pending':
+            job['done'] += 1
+        job['failed'] += int(status == 'failed') - int(previous == 'failed')
+        job['total'] = max(job['total'], len(job['items']))
+        _job_touch(job)
+
+
+def _job_worker():
+    while True:
+        job_id = _job_queue.get()
+        with _jobs_lock:
+            job = _jobs.get(job_id)
+            if job is None:
+                continue
+            job['state'] = 'running'
+            job['started'] = time.time()
+            _job_touch(job)
+        result, error = None, None
+        with app.test_request_context(), in_netns(job['netns']):
+            try:
+                result = job['_fn'](job)
+            except Exception as e:
+                logging.error(f"Job {job_id} ({job['title']}) failed: {str(e)}")
+                error = str(e)
+            flashed = [{'category': category, 'message': message}
+                       for category, message in session.pop('_flashes', [])]
+        with _jobs_lock:
+            job.update(state='failed' if error else 'done', finished=time.time(),
+                       result=result, error=error, _fn=None)
+            job['messages'] += flashed
+            _job_touch(job)
+        logging.info(f"Job {job_id} {job['state']}: {job['done']}/{job['total']} items, {job['failed']} failed")
+
+
+def get_job(job_id):
+    """Snapshot of a job, or None if it is unknown or has expired."""
+    with _jobs_lock:
+        _prune_jobs()
+        job = _jobs.get(job_id)
+        return _job_snapshot(job) if job else None
+
+
+def wait_for_job(job_id, after_version=-1, timeout=None):
+    """
+    Block until the job changes past after_version (or finishes, with the
+    default) and return its snapshot; None if the job is gone, the current
+    snapshot on timeout.
+    """
+    with _jobs_changed:
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        if after_version < 0:
+            _jobs_changed.wait_for(lambda: job['finished'] is not None, timeout)
+        else:
+            _jobs_changed.wait_for(lambda: job['version'] > after_version, timeout)
+        return _job_snapshot(job)
+
+
+def wants_job_wait():
+    """?wait=1: block until the job is done and answer like the synchronous endpoint did."""
+    return request.args.get('wait', '').lower() in ('1', 'true', 'yes')
+
+
+def job_accepted(job, created, endpoint):
+    """
+    Reply to the request that submitted job: 202 with the job for API callers,
+    otherwise a flash and a redirect to endpoint, whose page shows the job's progress.
+    """
+    if request.is_json or request.accept_mimetypes.best == 'application/json':
+        return jsonify(dict(job, created=created, url=url_for('job_status', job_id=job['id']))), 202
+    if created:
+        flash(f"{job['title']} started in the background", 'info')
+    else:
+        flash(f"{job['title']} is already running — showing its progress instead of starting it again", 'info')
+    return redirect(url_for(endpoint, job=job['id']))
+
+
+def job_key(*parts):
+    """Dedup key for a job from its kind and (JSON-serialisable) parameters."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@app.route('/jobs')
+def list_jobs():
+    """All queued, running and retained jobs, newest first (items omitted)."""
+    with _jobs_lock:
+        _prune_jobs()
+        jobs = [dict(_job_snapshot(job), items=None) for job in reversed(list(_jobs.values()))]
+    return jsonify({'jobs': jobs})
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Job record: state, done/total/failed counts, per-item status and messages, result."""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown or expired job {job_id}'}), 404
+    return jsonify(job)
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-sent events: a 'progress' event per change of the job, then 'done' once it has finished."""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown or expired job {job_id}'}), 404
+
+    def stream():
+        current, sent = job, None
+        yield 'retry: 5000\n\n'
+        while True:
+            if current['version'] == sent:
+                yield ': keepalive\n\n'
+            else:
+                sent = current['version']
+                event = 'done' if current['finished'] is not None else 'progress'
+                yield f"event: {event}\ndata: {json.dumps(current)}\n\n"
+                if event == 'done':
+                    return
+            current = wait_for_job(job_id, sent, timeout=15)
+            if current is None:
+                return
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# ---------------------------------------------------------------------------
+# In-process capture engine — with CAPTURE_ENGINE=afpacket a capture runs
+# inside HyyperWAN instead of as one 'sudo tcpdump' (plus a stderr thread) per
+# capture. Each interface gets one AF_PACKET socket with a PACKET_MMAP
+# TPACKET_V3 receive ring, drained by one reader thread; every capture on that
+# interface shares it and has its own writer thread producing the pcap file.
+# The host/net/port expression of the capture form is compiled to classic BPF
+# with 'tcpdump -dd' (no device is opened, so that needs no privileges) and
+# attached to the socket before it is bound, so the kernel drops non-matching
+# packets before they are copied into the ring. When a second capture joins a
+# ring, the socket filter is widened to the OR of every filter seen on it and
+# each capture then re-runs its own program in userspace. Packet, byte and
+# ring drop counters live in memory and back /capture_status, so a running
+# capture is never rescanned. The socket needs CAP_NET_RAW in the app process
+# (and CAP_SYS_ADMIN to enter a named namespace); when it cannot be opened the
+# capture falls back to tcpdump.
+#   CAPTURE_ENGINE          tcpdump (default) | afpacket
+#   CAPTURE_RING_BLOCKS     ring blocks per interface (default 64)
+#   CAPTURE_BLOCK_SIZE      bytes per block, a multiple of the page size (default 1048576)
+#   CAPTURE_BLOCK_TIMEOUT   ms before a partly filled block is handed over (default 100)
+# ---------------------------------------------------------------------------
+
+CAPTURE_ENGINE        = os.environ.get('CAPTURE_ENGINE', 'tcpdump').strip().lower()
+CAPTURE_RING_BLOCKS   = max(2, int(os.environ.get('CAPTURE_RING_BLOCKS', '64')))
+CAPTURE_BLOCK_SIZE    = max(1, int(os.environ.get('CAPTURE_BLOCK_SIZE', str(1 << 20))) // mmap.PAGESIZE) * mmap.PAGESIZE
+CAPTURE_BLOCK_TIMEOUT = int(os.environ.get('CAPTURE_BLOCK_TIMEOUT', '100'))
+CAPTURE_MAX_PACKETS   = 10000
+CAPTURE_SNAPLEN       = 262144
+CAPTURE_FRAME_SIZE    = 2048  # TPACKET_V3 packs packets per block; frames only size the request
+
+SOL_PACKET = 263
+PACKET_RX_RING, PACKET_STATISTICS, PACKET_VERSION = 5, 6, 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL, TP_STATUS_USER = 0, 1
+TP_STATUS_VLAN_VALID, TP_STATUS_VLAN_TPID_VALID = 0x10, 0x40
+TPACKET3_HDRLEN = 48  # TPACKET_ALIGN(sizeof(struct tpacket3_hdr)); the sockaddr_ll follows
+PACKET_OUTGOING = 4
+SO_ATTACH_FILTER = 26
+ETH_P_ALL = 0x0003
+ARPHRD_LOOPBACK = 772
+# ARPHRD_* of the bound device -> ('tcpdump -y' link name, pcap LINKTYPE_*)
+CAPTURE_LINK_TYPES = {1: ('EN10MB', 1), ARPHRD_LOOPBACK: ('EN10MB', 1), 65534: ('RAW', 101)}
+# 'ret #snaplen': what the socket filter is widened to when a capture has no filter
+BPF_ACCEPT_ALL = [(0x06, 0, 0, CAPTURE_SNAPLEN)]
+BPF_LOAD_WIDTH = {0x00: 4, 0x08: 2, 0x10: 1}  # BPF_W, BPF_H, BPF_B
+
+_BPF_INSN = re.compile(r'\{\s*(0x[0-9a-fA-F]+|\d+),\s*(\d+),\s*(\d+),\s*(0x[0-9a-fA-F]+|\d+)\s*\}')
+
+_capture_rings = {}  # (netns, interface) -> ring dict, see _open_capture_ring()
+_capture_rings_lock = threading.RLock()
+_bpf_cache = {}
+
+
+class _SockFilter(ctypes.Structure):
+    _fields_ = [('code', ctypes.c_uint16), ('jt', ctypes.c_uint8), ('jf', ctypes.c_uint8),
+                ('k', ctypes.c_uint32)]
+
+
+def parse_bpf_dump(text):
+    """'tcpdump -dd' output -> [(code, jt, jf, k)]."""
+    return [(int(code, 0), int(jt), int(jf), int(k, 0)) for code, jt, jf, k in _BPF_INSN.findall(text)]
+
+
+def compile_capture_filter(expr, link_name):
+    """
+    Classic BPF program for a tcpdump filter expression on a link type
+    ('EN10MB', 'RAW'), cached per expression. Raises ValueError for an
+    expression tcpdump rejects and OSError when tcpdump is not installed.
+    """
+    key = (expr, link_name)
+    program = _bpf_cache.get(key)
+    if program is None:
+        with in_netns(''):  # compiling opens no device, so it runs unprivileged in any namespace
+            result = run_cmd(['tcpdump', '-dd', '-y', link_name, '-s', str(CAPTURE_SNAPLEN), expr])
+        if result.returncode == 127:
+            raise OSError(errno.ENOENT, f"tcpdump not available to compile the filter: {result.stderr.strip()}")
+        program = parse_bpf_dump(result.stdout) if result.returncode == 0 else []
+        if not program:
+            raise ValueError(f"Invalid capture filter '{expr}': "
+                             f"{result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'no program'}")
+        _bpf_cache[key] = program
+    return program
+
+
+def bpf_match(program, data, wirelen):
+    """
+    Run a classic BPF program over one packet as the kernel would: True when it
+    returns a non-zero snap length. Out-of-bounds loads reject the packet.
+    """
+    a = x = 0
+    mem = [0] * 16
+    size = len(data)
+    pc = 0
+    while True:
+        code, jt, jf, k = program[pc]
+        pc += 1
+        cls = code & 0x07
+        if cls <= 1:  # BPF_LD / BPF_LDX
+            mode = code & 0xe0
+            if mode == 0x00:    # BPF_IMM
+                value = k
+            elif mode == 0x60:  # BPF_MEM
+                value = mem[k & 15]
+            elif mode == 0x80:  # BPF_LEN
+                value = wirelen
+            elif mode == 0xa0:  # BPF_MSH: 4 * (P[k] & 0xf), the IPv4 header length
+                if k >= size:
+                    return False
+                value = (data[k] & 0x0f) << 2
+            else:               # BPF_ABS / BPF_IND
+                offset = (k + x) & 0xffffffff if mode == 0x40 else k
+                width = BPF_LOAD_WIDTH.get(code & 0x18, 4)
+                if offset + width > size:
+                    return False
+                value = int.from_bytes(data[offset:offset + width], 'big')
+            if cls == 0:
+                a = value
+            else:
+                x = value
+        elif cls == 2:  # BPF_ST
+            mem[k & 15] = a
+        elif cls == 3:  # BPF_STX
+            mem[k & 15] = x
+        elif cls == 4:  # BPF_ALU
+            op = code & 0xf0
+            value = x if code & 0x08 else k
+            if op == 0x00:
+                a += value
+            elif op == 0x10:
+                a -= value
+            elif op == 0x20:
+                a *= value
+            elif op == 0x30 or op == 0x90:  # BPF_DIV / BPF_MOD
+                if not value:
+                    return False
+                a = a // value if op == 0x30 else a % value
+            elif op == 0x40:
+                a |= value
+            elif op == 0x50:
+                a &= value
+            elif op == 0x60:
+                a = a << value if value < 32 else 0
+            elif op == 0x70:
+                a >>= value
+            elif op == 0x80:  # BPF_NEG
+                a = -a
+            elif op == 0xa0:
+                a ^= value
+            a &= 0xffffffff
+        elif cls == 5:  # BPF_JMP
+            op = code & 0xf0
+            if op == 0x00:  # BPF_JA
+                pc += k
+                continue
+            value = x if code & 0x08 else k
+            if op == 0x10:
+                taken = a == value
+            elif op == 0x20:
+                taken = a > value
+            elif op == 0x30:
+                taken = a >= value
+            else:  # BPF_JSET
+                taken = bool(a & value)
+            pc += jt if taken else jf
+        elif cls == 6:  # BPF_RET
+            rval = code & 0x18
+            return bool(a if rval == 0x10 else x if rval == 0x08 else k)
+        elif code & 0x80:  # BPF_MISC: BPF_TXA
+            a = x
+        else:              # BPF_TAX
+            x = a
+
+
+def _attach_socket_filter(sock, program):
+    """SO_ATTACH_FILTER: the kernel copies the program, so the array only lives for the call."""
+    insns = (_SockFilter * len(program))(*program)
+    fprog = struct.pack('HL', len(program), ctypes.addressof(insns))  # struct sock_fprog
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def _packet_socket(netns):
+    """
+    Unbound AF_PACKET socket in netns. Protocol 0 keeps it from receiving
+    anything until it is bound to ETH_P_ALL, after the ring and the filter are
+    in place. Like the rtnetlink sockets, a throw-away thread enters a named
+    namespace to create it.
+    """
+    if not netns:
+        return socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+    holder = {}
+
+    def opener():
+        try:
+            _setns(os.path.join(NETNS_DIR, netns))
+            holder['sock'] = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        except OSError as e:
+            holder['error'] = e
+
+    thread = threading.Thread(target=opener, name=f'capture-netns-{netns}')
+    thread.start()
+    thread.join()
+    if 'error' in holder:
+        raise holder['error']
+    return holder['sock']
+
+
+def _open_capture_ring(interface, netns):
+    """
+    Socket and mapped TPACKET_V3 ring for interface, bound without a protocol
+    so the link type is known before the filter is compiled; _bind_capture_ring()
+    starts delivery. Raises OSError (no CAP_NET_RAW, no such device, link type
+    pcap output is not written for).
+    """
+    sock = _packet_socket(netns)
+    try:
+        sock.bind((interface, 0))
+        hatype = sock.getsockname()[3]
+        if hatype not in CAPTURE_LINK_TYPES:
+            raise OSError(errno.EPROTONOSUPPORT, f"link type {hatype} is not supported by the capture engine")
+        sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        frames = CAPTURE_BLOCK_SIZE // CAPTURE_FRAME_SIZE * CAPTURE_RING_BLOCKS
+        sock.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                        struct.pack('=7I', CAPTURE_BLOCK_SIZE, CAPTURE_RING_BLOCKS, CAPTURE_FRAME_SIZE,
+                                    frames, CAPTURE_BLOCK_TIMEOUT, 0, 0))  # struct tpacket_req3
+        ring_map = mmap.mmap(sock.fileno(), CAPTURE_BLOCK_SIZE * CAPTURE_RING_BLOCKS,
+                             mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+    except OSError:
+        sock.close()
+        raise
+    link_name, linktype = CAPTURE_LINK_TYPES[hatype]
+    return {'interface': interface, 'netns': netns, 'sock': sock, 'map': ring_map,
+            'link_name': link_name, 'linktype': linktype, 'loopback': hatype == ARPHRD_LOOPBACK,
+            'captures': (), 'filters': set(), 'shared': False, 'closed': False,
+            'packets': 0, 'drops': 0, 'thread': None}
+
+
+def _bind_capture_ring(ring):
+    ring['sock'].bind((ring['interface'], ETH_P_ALL))
+    ring['thread'] = threading.Thread(target=_capture_ring_loop, args=(ring,), daemon=True,
+                                      name=f"capture-{ring['interface']}")
+    ring['thread'].start()
+
+
+def _read_ring_drops(ring):
+    """Fold the socket's PACKET_STATISTICS (reset by every read) into the ring's counters."""
+    try:
+        packets, drops, _ = struct.unpack('=3I', ring['sock'].getsockopt(SOL_PACKET, PACKET_STATISTICS, 12))
+    except OSError:
+        return
+    ring['packets'] += packets
+    ring['drops'] += drops
+
+
+def _deliver_packet(ring, sec, usec, wirelen, data, record):
+    for capture in ring['captures']:
+        if capture['done']:
+            continue
+        if capture['program'] and ring['shared'] and not bpf_match(capture['program'], data, wirelen):
+            continue
+        capture['packets'] += 1
+        capture['bytes'] += wirelen
+        capture['queue'].put((sec, usec, wirelen, record))
+        if capture['packets'] >= CAPTURE_MAX_PACKETS:
+            _release_capture(capture)
+
+
+def _capture_ring_loop(ring):
+    """Reader thread: hand each filled block's packets to the ring's captures, then return the block."""
+    ring_map = ring['map']
+    poller = select.poll()
+    poller.register(ring['sock'].fileno(), select.POLLIN | select.POLLERR)
+    block = 0
+    try:
+        while not ring['closed']:
+            base = block * CAPTURE_BLOCK_SIZE
+            # struct tpacket_block_desc: version, offset_to_priv, then tpacket_hdr_v1
+            status, count, offset = struct.unpack_from('=3I', ring_map, base + 8)
+            if not status & TP_STATUS_USER:
+                poller.poll(250)
+                continue
+            for _ in range(count):
+                at = base + offset
+                # struct tpacket3_hdr
+                next_offset, sec, nsec, snaplen, wirelen, pkt_status, mac = \
+                    struct.unpack_from('=6IH', ring_map, at)
+                data = ring_map[at + mac:at + mac + snaplen]
+                if ring['loopback'] and ring_map[at + TPACKET3_HDRLEN + 10] == PACKET_OUTGOING:
+                    pass  # loopback frames are seen leaving and arriving; keep one copy, like libpcap
+                else:
+                    record = data
+                    if pkt_status & TP_STATUS_VLAN_VALID and ring['linktype'] == 1:
+                        # The kernel strips an offloaded VLAN tag into the header; put it back
+                        tci, tpid = struct.unpack_from('=IH', ring_map, at + 32)
+                        tpid = tpid if pkt_status & TP_STATUS_VLAN_TPID_VALID else 0x8100
+                        record = data[:12] + struct.pack('!HH', tpid, tci & 0xffff) + data[12:]
+                        wirelen += 4
+                    _deliver_packet(ring, sec, nsec // 1000, wirelen, data, record)
+                offset += next_offset
+            struct.pack_into('=I', ring_map, base + 8, TP_STATUS_KERNEL)
+            block = (block + 1) % CAPTURE_RING_BLOCKS
+            _read_ring_drops(ring)
+    except Exception as e:
+        logging.error(f"Capture ring on {ring['interface']} failed: {e}")
+        with _capture_rings_lock:
+            if _capture_rings.get((ring['netns'], ring['interface'])) is ring:
+                del _capture_rings[(ring['netns'], ring['interface'])]
+        for capture in ring['captures']:
+            _release_capture(capture)
+    finally:
+        ring_map.close()
+        ring['sock'].close()
+
+
+def _capture_writer(capture):
+    """Writer thread: pcap (microsecond, native byte order) from the capture's queue until None."""
+    with open(capture['file'], 'wb') as f:
+        f.write(struct.pack('=IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, CAPTURE_SNAPLEN, capture['linktype']))
+        while True:
+            item = capture['queue'].get()
+            if item is None:
+                break
+            sec, usec, wirelen, data = item
+            f.write(struct.pack('=4I', sec, usec, len(data), wirelen))
+            f.write(data)
+
+
+def start_engine_capture(interface, filter_expr, pcap_file):
+    """
+    Join (or open) the shared ring of interface in the current namespace and
+    start a writer for pcap_file. Returns the capture dict; raises ValueError
+    for a filter tcpdump rejects and OSError when the engine cannot capture on
+    this interface (the caller falls back to tcpdump).
+    """
+    netns = current_netns()
+    key = (netns, interface)
+    with _capture_rings_lock:
+        ring = _capture_rings.get(key)
+        fresh = ring is None
+        if fresh:
+            ring = _open_capture_ring(interface, netns)
+        try:
+            program = compile_capture_filter(filter_expr, ring['link_name']) if filter_expr else None
+            if fresh:
+                _attach_socket_filter(ring['sock'], program or BPF_ACCEPT_ALL)
+            elif filter_expr not in ring['filters']:
+                # Widen only: packets already in the ring may match any earlier filter
+                filters = ring['filters'] | {filter_expr}
+                _attach_socket_filter(ring['sock'], BPF_ACCEPT_ALL if '' in filters else compile_capture_filter(
+                    ' or '.join(f'({f})' for f in sorted(filters)), ring['link_name']))
+                ring['shared'] = True
+        except Exception:
+            if fresh:
+                ring['map'].close()
+                ring['sock'].close()
+            raise
+        ring['filters'].add(filter_expr)
+        capture = {'ring': ring, 'file': pcap_file, 'filter': filter_expr, 'program': program,
+                   'linktype': ring['linktype'], 'queue': queue.Queue(), 'packets': 0, 'bytes': 0,
+                   'drops_base': ring['drops'], 'done': False}
+        capture['writer'] = threading.Thread(target=_capture_writer, args=(capture,), daemon=True,
+                                             name=f'capture-writer-{interface}')
+        capture['writer'].start()
+        ring['captures'] += (capture,)
+        if fresh:
+            _capture_rings[key] = ring
+            try:
+                _bind_capture_ring(ring)
+            except OSError:
+                _release_capture(capture)
+                raise
+    logging.info(f"In-process capture on {interface} ({len(ring['captures'])} on this ring): "
+                 f"{filter_expr or 'all packets'}")
+    return capture
+
+
+def _release_capture(capture):
+    """Detach capture from its ring (closing the ring with its last capture) and end its writer."""
+    with _capture_rings_lock:
+        if capture['done']:
+            return
+        capture['done'] = True
+        ring = capture['ring']
+        ring['captures'] = tuple(c for c in ring['captures'] if c is not capture)
+        if not ring['captures']:
+            ring['closed'] = True  # the reader thread unmaps and closes the socket
+            key = (ring['netns'], ring['interface'])
+            if _capture_rings.get(key) is ring:
+                del _capture_rings[key]
+    capture['queue'].put(None)
+
+
+def stop_engine_capture(capture, timeout=10):
+    """Stop capture and wait until its pcap file is complete."""
+    _release_capture(capture)
+    capture['writer'].join(timeout)
+
+
+def engine_capture_status(capture):
+    ring = capture['ring']
+    return {'packet_count': capture['packets'], 'bytes': capture['bytes'],
+            'drops': ring['drops'] - capture['drops_base'], 'filter': capture['filter'],
+            'shared_with': max(0, len(ring['captures']) - (0 if capture['done'] else 1))}
+
+
 # ---------------------------------------------------------------------------
 # Flask routes — main app
 # ---------------------------------------------------------------------------
 
 @app.route('/')
 def index():
+    etag = state_etag('index')
+    cached = not_modified(etag)
+    if cached:
+        return cached
     try:
         ip_available = is_ip_available()
         iptables_available = is_iptables_available()
-        interfaces = list_interfaces() if ip_available else []
+        # Shell only: rows carry the link list and load their tc/NAT state asynchronously
+        netns_groups = list_interfaces_by_netns(with_state=False) if ip_available else []
         hostname = socket.gethostname()
         tcpdump_available = is_tcpdump_available()
         tc_available = is_tc_available()
         cfg = load_admin_config()
 
-        return render_template('index.html', interfaces=interfaces, hostname=hostname,
+        return with_etag(render_template('index.html', netns_groups=netns_groups, hostname=hostname,
                               tcpdump_available=tcpdump_available, tc_available=tc_available,
                               ip_available=ip_available, iptables_available=iptables_available,
                               tools_column_disabled=cfg.get('disable_tools_column', False),
                               iface_overrides=cfg.get('interface_overrides', {}),
-                              hide_admin_link=cfg.get('hide_admin_link', False))
+                              hide_admin_link=cfg.get('hide_admin_link', False),
+                              restore=get_restore_progress()), etag)
     except Exception as e:
         logging.error(f"Error in index route: {str(e)}")
         flash("An error occurred while loading the page", "error")
         hostname = "Unknown"
-        return render_template('index.html', interfaces=[], hostname=hostname,
+        return render_template('index.html', netns_groups=[('', [])], hostname=hostname,
                               tcpdump_available=False, tc_available=False,
                               ip_available=False, iptables_available=False,
                               tools_column_disabled=False, iface_overrides={},
-                              hide_admin_link=False)
+                              hide_admin_link=False, restore=get_restore_progress())
 
 @app.route('/favicon.png')
 def favicon():
@@ -919,6 +4904,12 @@ def apply():
         bw_unit  = request.form.get('bandwidth_unit', 'mbit').strip()
         src_filter = request.form.get('src_filter', '').strip()
         dst_filter = request.form.get('dst_filter', '').strip()
+        proto_filter = request.form.get('proto_filter', '').strip().lower() or None
+        dport_filter = request.form.get('dport_filter', '').strip() or None
+        shaping_mode = request.form.get('shaping_mode', '').strip().lower()
+        shaping_mode = None if shaping_mode in ('', 'auto') else shaping_mode
+        direction = request.form.get('direction', 'egress').strip().lower() or 'egress'
+        slot = request.form.get('slot')
 
         bandwidth_raw = f"{bw_value}{bw_unit}" if bw_value else None
 
@@ -953,11 +4944,26 @@ def apply():
         else:
             bandwidth_raw = bw_clean
 
+        if direction not in ('egress', 'ingress'):
+            validation_errors.append(f"Unknown direction '{direction}'")
+
+        if shaping_mode is not None and shaping_mode not in SHAPING_MODES:
+            validation_errors.append(f"Unknown shaping mode '{shaping_mode}'")
+            shaping_mode = None
+
+        slot_valid, slot_clean, slot_error = validate_slot(slot)
+        if not slot_valid:
+            validation_errors.append(slot_error)
+            slot = None
+        else:
+            slot = slot_clean
+
         # Server-side: ignore filters if disabled by admin for this interface
         cfg_check = load_admin_config()
         if cfg_check.get('interface_overrides', {}).get(interface, {}).get('hide_filter'):
             src_filter = ''
             dst_filter = ''
+            proto_filter = dport_filter = None
 
         src_valid, src_clean, src_error = validate_cidr(src_filter, 'Source filter')
         if not src_valid:
@@ -978,13 +4984,19 @@ def apply():
                 flash(error, 'error')
             return do_redirect()
 
-        # Choose filtered or simple path
-        if src_filter or dst_filter:
-            if bandwidth_raw:
-                flash("Bandwidth limiting is not supported in filtered mode — impairments applied without bandwidth limit.", "warning")
-            apply_qdisc_filtered(interface, latency, loss, jitter, src_filter, dst_filter)
+        # Choose ingress, filtered or simple path
+        if direction == 'ingress':
+            if src_filter or dst_filter or proto_filter or dport_filter:
+                flash("Source/destination filters apply to egress only — ingress impairments applied to all received traffic.", "warning")
+            apply_ingress_qdisc(interface, latency, loss, jitter, bandwidth_raw,
+                                shaping_mode=shaping_mode, slot=slot)
+        elif src_filter or dst_filter or proto_filter or dport_filter:
+            # Bandwidth caps the matched traffic only (the rule's HTB class)
+            apply_qdisc_filtered(interface, latency, loss, jitter, src_filter, dst_filter,
+                                 bandwidth=bandwidth_raw, proto=proto_filter, dport=dport_filter)
         else:
-            apply_qdisc(interface, latency, loss, jitter, bandwidth_raw)
+            apply_qdisc(interface, latency, loss, jitter, bandwidth_raw,
+                        shaping_mode=shaping_mode, slot=slot)
 
         return do_redirect()
     except Exception as e:
@@ -1002,7 +5014,10 @@ def remove():
 
         interface = request.form['interface'].split(' ')[0]
         redirect_to = request.form.get('redirect_to', 'index')
-        remove_degradations(interface)
+        direction = request.form.get('direction', 'both')
+        if direction not in ('egress', 'ingress', 'both'):
+            direction = 'both'
+        remove_degradations(interface, direction)
         if redirect_to == 'interface_detail':
             return redirect(url_for('interface_detail', name=interface))
         return redirect(url_for('index'))
@@ -1013,52 +5028,67 @@ def remove():
 
 @app.route('/reset_all', methods=['POST'], endpoint='reset_all_interfaces')
 def reset_all():
+    """Queue a job removing impairments from every listed interface (see submit_job)."""
     try:
-        # Get all interfaces and remove degradations for each
-        interfaces = list_interfaces()
-        reset_count = 0
-        reset_interfaces = []
-        
-        for interface_info in interfaces:
-            try:
-                interface_name = interface_info['name']
-                
-                check_result = subprocess.run(
-                    ['sudo', 'tc', 'qdisc', 'show', 'dev', interface_name],
-                    capture_output=True, text=True
-                )
-
-                if any(kw in check_result.stdout for kw in ('netem', 'htb', 'tbf')):
-                    remove_degradations(interface_name)
-                    reset_count += 1
-                    
-                    # Format the interface name with alias for display
-                    alias = interface_info.get('alias', '')
-                    if alias and alias != interface_name:
-                        reset_interfaces.append(f"{interface_name} ({alias})")
-                    else:
-                        reset_interfaces.append(interface_name)
-                else:
-                    logging.info(f"No netem qdisc to remove on interface {interface_name}")
-            except Exception as e:
-                logging.error(f"Failed to reset interface {interface_info['name']}: {str(e)}")
-        
-        if reset_count > 0:
-            # If fewer than 4 interfaces were reset, list them all
-            if reset_count <= 3:
-                interfaces_list = ", ".join(reset_interfaces)
-                flash(f"Successfully reset network conditions on {reset_count} interfaces: {interfaces_list}", "success")
-            else:
-                flash(f"Successfully reset network conditions on {reset_count} interfaces", "success")
-        else:
-            flash("No active network conditions found to reset", "info")
-            
-        return redirect(url_for('index'))
+        # Names only (one 'ip' call); the job checks each interface's tc state
+        interfaces = list_interfaces(with_state=False)
+        job, created = submit_job('reset_all', 'Reset All', lambda job: reset_interfaces_job(job, interfaces),
+                                  items=[i['name'] for i in interfaces], key=job_key('reset_all', current_netns()))
+        if wants_job_wait():
+            job = wait_for_job(job['id'])
+            return jsonify(job), (200 if job['state'] == 'done' and not job['failed'] else 207)
+        return job_accepted(job, created, 'index')
     except Exception as e:
         logging.error(f"Error in reset_all route: {str(e)}")
         flash(f"An unexpected error occurred: {str(e)}", "error")
         return redirect(url_for('index'))
 
+
+def reset_interfaces_job(job, interfaces):
+    """Job body of Reset All: remove degradations interface by interface, reporting each."""
+    reset_count = 0
+    reset_interfaces = []
+
+    for interface_info in interfaces:
+        interface_name = interface_info['name']
+        try:
+            check_result = run_cmd(['sudo', 'tc', 'qdisc', 'show', 'dev', interface_name])
+
+            if has_custom_qdisc(check_result.stdout) or get_ingress_ifb(interface_name):
+                remove_degradations(interface_name)
+                reset_count += 1
+
+                # Format the interface name with alias for display
+                alias = interface_info.get('alias', '')
+                if alias and alias != interface_name:
+                    reset_interfaces.append(f"{interface_name} ({alias})")
+                else:
+                    reset_interfaces.append(interface_name)
+                errors = [m for c, m in session.get('_flashes', []) if c == 'error']
+                job_progress(job, interface_name, 'failed' if errors else 'ok')
+            else:
+                logging.info(f"No netem qdisc to remove on interface {interface_name}")
+                job_progress(job, interface_name, 'skipped')
+        except Exception as e:
+            logging.error(f"Failed to reset interface {interface_name}: {str(e)}")
+            job_progress(job, interface_name, 'failed', [str(e)])
+
+    if reset_count > 0:
+        # If fewer than 4 interfaces were reset, list them all
+        if reset_count <= 3:
+            interfaces_list = ", ".join(reset_interfaces)
+            flash(f"Successfully reset network conditions on {reset_count} interfaces: {interfaces_list}", "success")
+        else:
+            flash(f"Successfully reset network conditions on {reset_count} interfaces", "success")
+    else:
+        flash("No active network conditions found to reset", "info")
+    return {'reset': [i['name'] for i in interfaces if job['items'][i['name']]['status'] == 'ok']}
+
+@app.route('/restore/status')
+def restore_status():
+    """Progress of the startup restore of recorded impairments (polled by the index banner)."""
+    return jsonify(get_restore_progress())
+
 @app.route('/update_alias', methods=['POST'], endpoint='update_interface_alias')
 def update_alias():
     try:
@@ -1099,6 +5129,52 @@ def update_alias():
         flash(f"Failed to update interface alias: {str(e)}", "error")
         return redirect(url_for('index'))
 
+def build_capture_filter(host_filter, network_filter, port_filter,
+                         host_filter_logic='or', network_filter_logic='or', port_filter_logic='or'):
+    """
+    tcpdump filter expression for the comma-separated host, network and port
+    lists of the capture form: each list is joined with its own and/or logic,
+    the lists with 'and'. '' captures everything.
+    """
+    filter_parts = []
+    
+    # Process host filter
+    if (host_filter):
+        hosts = host_filter.split(',')
+        hosts = [h.strip() for h in hosts if h.strip()]
+        if hosts:
+            if len(hosts) == 1:
+                filter_parts.append(f"host {hosts[0]}")
+            else:
+                host_expr = f" {host_filter_logic} ".join([f"host {h}" for h in hosts])
+                filter_parts.append(f"({host_expr})")
+    
+    # Process network filter
+    if network_filter:
+        networks = network_filter.split(',')
+        networks = [n.strip() for n in networks if n.strip()]
+        if networks:
+            if len(networks) == 1:
+                filter_parts.append(f"net {networks[0]}")
+            else:
+                net_expr = f" {network_filter_logic} ".join([f"net {n}" for n in networks])
+                filter_parts.append(f"({net_expr})")
+    
+    # Process port filter
+    if port_filter:
+        ports = port_filter.split(',')
+        ports = [p.strip() for p in ports if p.strip()]
+        if ports:
+            if len(ports) == 1:
+                filter_parts.append(f"port {ports[0]}")
+            else:
+                port_expr = f" {port_filter_logic} ".join([f"port {p}" for p in ports])
+                filter_parts.append(f"({port_expr})")
+    
+    # Combine all parts with AND logic
+    return " and ".join(filter_parts)
+
+
 @app.route('/start_capture', methods=['POST'])
 def start_capture():
     try:
@@ -1135,48 +5211,35 @@ def start_capture():
                 return jsonify({'success': False, 'error': f"Cannot create capture directory: {str(e)}"}), 500
         
         # Build complex tcpdump filter expression with separate logic for each filter type
-        filter_parts = []
-        
-        # Process host filter
-        if (host_filter):
-            hosts = host_filter.split(',')
-            hosts = [h.strip() for h in hosts if h.strip()]
-            if hosts:
-                if len(hosts) == 1:
-                    filter_parts.append(f"host {hosts[0]}")
-                else:
-                    host_expr = f" {host_filter_logic} ".join([f"host {h}" for h in hosts])
-                    filter_parts.append(f"({host_expr})")
-        
-        # Process network filter
-        if network_filter:
-            networks = network_filter.split(',')
-            networks = [n.strip() for n in networks if n.strip()]
-            if networks:
-                if len(networks) == 1:
-                    filter_parts.append(f"net {networks[0]}")
-                else:
-                    net_expr = f" {network_filter_logic} ".join([f"net {n}" for n in networks])
-                    filter_parts.append(f"({net_expr})")
-        
-        # Process port filter
-        if port_filter:
-            ports = port_filter.split(',')
-            ports = [p.strip() for p in ports if p.strip()]
-            if ports:
-                if len(ports) == 1:
-                    filter_parts.append(f"port {ports[0]}")
-                else:
-                    port_expr = f" {port_filter_logic} ".join([f"port {p}" for p in ports])
-                    filter_parts.append(f"({port_expr})")
-        
-        # Combine all parts with AND logic
-        filter_expr = ""
-        if filter_parts:
-            filter_expr = " and ".join(filter_parts)
-        
+        filter_expr = build_capture_filter(host_filter, network_filter, port_filter,
+                                           host_filter_logic, network_filter_logic, port_filter_logic)
+
+        if CAPTURE_ENGINE == 'afpacket':
+            try:
+                capture = start_engine_capture(interface, filter_expr, pcap_file)
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
+            except OSError as e:
+                capture = None
+                logging.warning(f"In-process capture on {interface} unavailable ({e}); using tcpdump")
+            if capture is not None:
+                active_captures[capture_id] = {
+                    'engine': 'afpacket',
+                    'capture': capture,
+                    'interface': interface,
+                    'display_name': display_name,
+                    'file': pcap_file,
+                    'start_time': time.time(),
+                    'filter': filter_expr
+                }
+                return jsonify({
+                    'success': True,
+                    'capture_id': capture_id,
+                    'message': f"Capture started on {display_name}"
+                })
+
         # Build tcpdump command with packet count limit
-        cmd = ['sudo', 'tcpdump', '-i', interface, '-w', pcap_file, '-c', '10000']  # Base command
+        cmd = ['sudo', 'tcpdump', '-i', interface, '-w', pcap_file, '-c', str(CAPTURE_MAX_PACKETS)]  # Base command
 
         # Add -Z option only if not running inside a Docker container
         if not is_running_in_container(): # MODIFIED: Use the helper function
@@ -1198,7 +5261,7 @@ def start_capture():
         logging.info(f"Starting capture with command: {' '.join(cmd)}")
         
         # Start capture process with stderr redirected to pipe for error logging
-        process = subprocess.Popen(cmd, stderr=subprocess.PIPE, text=True)
+        process = spawn_cmd(cmd, stderr=subprocess.PIPE, text=True)
         
         # Start a thread to monitor stderr for errors
         def monitor_stderr():
@@ -1210,6 +5273,7 @@ def start_capture():
         stderr_thread.start()
         
         active_captures[capture_id] = {
+            'engine': 'tcpdump',
             'process': process,
             'interface': interface,
             'display_name': display_name,
@@ -1235,7 +5299,6 @@ def count_pcap_packets(filepath):
         size = os.path.getsize(filepath)
         if size < 24:
             return 0
-        import struct
         with open(filepath, 'rb') as f:
             magic = f.read(4)
             if len(magic) < 4:
@@ -1266,8 +5329,12 @@ def capture_status(capture_id):
     if capture_id not in active_captures:
         return jsonify({'active': False, 'packet_count': 0})
     info = active_captures[capture_id]
+    if info['engine'] == 'afpacket':
+        # Live counters of the shared ring: no file to rescan
+        return jsonify(dict(engine_capture_status(info['capture']), active=True, engine='afpacket',
+                            max_packets=CAPTURE_MAX_PACKETS))
     count = count_pcap_packets(info['file']) if os.path.exists(info['file']) else 0
-    return jsonify({'active': True, 'packet_count': count, 'max_packets': 10000})
+    return jsonify({'active': True, 'engine': 'tcpdump', 'packet_count': count, 'max_packets': CAPTURE_MAX_PACKETS})
 
 
 @app.route('/stop_capture/<capture_id>', methods=['POST'])
@@ -1277,19 +5344,23 @@ def stop_capture(capture_id):
             return jsonify({'success': False, 'error': 'Capture not found'}), 404
         
         capture_info = active_captures[capture_id].copy()  # Copy the info
-        process = capture_info['process']
-        
-        # Stop the capture process
-        if process.poll() is None:  # Process is still running
-            process.send_signal(signal.SIGTERM)
-            try:
-                process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                # Force kill if still running
-                process.kill()
-        
-        # Wait a moment for tcpdump to flush its output
-        time.sleep(1)
+        if capture_info['engine'] == 'afpacket':
+            # Leaves the shared ring and waits for the writer to close the pcap
+            stop_engine_capture(capture_info['capture'])
+        else:
+            process = capture_info['process']
+
+            # Stop the capture process
+            if process.poll() is None:  # Process is still running
+                process.send_signal(signal.SIGTERM)
+                try:
+                    process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    # Force kill if still running
+                    process.kill()
+
+            # Wait a moment for tcpdump to flush its output
+            time.sleep(1)
         
         # Store info in completed_captures for download
         completed_captures[capture_id] = {
@@ -1383,6 +5454,13 @@ def download_capture(capture_id):
 
 @app.route('/toggle_nat/<interface_name>', methods=['POST'])
 def toggle_nat(interface_name):
+    # The status check and the iptables change run as one step on the interface's mutation queue
+    with serialized_mutation('toggle_nat', interface_name):
+        return toggle_nat_from_form(interface_name)
+
+
+def toggle_nat_from_form(interface_name):
+    """Enable or disable MASQUERADE on interface_name as the form's 'action' asks; redirects to the index."""
     if not is_iptables_available():
         flash("iptables (and nsenter if in container) command not found.", "error")
         return redirect(url_for('index'))
@@ -1408,6 +5486,8 @@ def toggle_nat(interface_name):
     else:
         cmd_prefix_list = ['sudo']
         log_context_message = "host (direct sudo)"
+    if current_netns():
+        log_context_message = f"netns {current_netns()}"
 
     # Determine current NAT status using the correct context
     current_nat_status = get_nat_status(interface_name)
@@ -1435,8 +5515,12 @@ def toggle_nat(interface_name):
         return redirect(url_for('index'))
 
     try:
-        result = subprocess.run(final_cmd, capture_output=True, text=True, check=False)
+        result = run_cmd(final_cmd)
         log_command(final_cmd, f"Return code: {result.returncode}, Stdout: {result.stdout.strip()}, Stderr: {result.stderr.strip()} (Context: {log_context_message})")
+        # iptables changes raise no rtnetlink event: refresh the cached row and tell browsers ourselves
+        invalidate_interface_state(interface_name)
+        publish_event({'interfaces': [interface_name], 'kinds': ['nat'], 'removed': [], 'all': False,
+                       'netns': current_netns()})
         if result.returncode == 0:
             flash(success_msg, "success")
         else:
@@ -1448,24 +5532,85 @@ def toggle_nat(interface_name):
     
     return redirect(url_for('index'))
 
+
+def route_query_args():
+    """Filter and paging parameters shared by /routes and /routes/data."""
+    try:
+        per_page = min(max(int(request.args.get('per_page', ROUTES_PER_PAGE)), 1), MAX_ROUTES_PER_PAGE)
+    except ValueError:
+        per_page = ROUTES_PER_PAGE
+    pages = {}
+    for version in (4, 6):
+        try:
+            pages[version] = max(int(request.args.get(f'page{version}', 1)), 1)
+        except ValueError:
+            pages[version] = 1
+    filters = {key: request.args.get(key, '').strip() or None for key in ('prefix', 'dev', 'proto', 'table')}
+    return filters, pages, per_page
+
+
+def fetch_route_pages(filters, pages, per_page):
+    """Query both families in parallel and return {4: page dict, 6: page dict}."""
+    results = {}
+    netns = current_netns()
+
+    def worker(version):
+        with in_netns(netns):
+            routes, total = query_routes(version, prefix=filters['prefix'], interface=filters['dev'],
+                                         proto=filters['proto'], table=filters['table'],
+                                         offset=(pages[version] - 1) * per_page, limit=per_page)
+        results[version] = {'routes': routes, 'total': total, 'page': pages[version],
+                            'pages': max(1, -(-total // per_page))}
+
+    threads = [threading.Thread(target=worker, args=(v,), name=f'routes-v{v}') for v in (4, 6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
 @app.route('/routes')
 def routes_page():
+    etag = state_etag('routes')
+    cached = not_modified(etag)
+    if cached:
+        return cached
     try:
-        routes_v4 = parse_routes(4)
-        routes_v6 = parse_routes(6)
-        interfaces = list_interfaces()
+        filters, pages, per_page = route_query_args()
+        results = fetch_route_pages(filters, pages, per_page)
+        interfaces = list_interfaces(with_state=False)
         hostname = socket.gethostname()
         cfg = load_admin_config()
-        return render_template('routes.html', routes_v4=routes_v4, routes_v6=routes_v6,
-                               interfaces=interfaces, hostname=hostname,
-                               disable_routes=cfg.get('disable_routes', False),
-                               hide_admin_link=cfg.get('hide_admin_link', False))
+        return with_etag(render_template('routes.html', routes_v4=results[4]['routes'], routes_v6=results[6]['routes'],
+                                         page_v4=results[4], page_v6=results[6],
+                                         filters=filters, per_page=per_page,
+                                         interfaces=interfaces, hostname=hostname,
+                                         namespaces=list_netns(), netns=current_netns(),
+                                         disable_routes=cfg.get('disable_routes', False),
+                                         hide_admin_link=cfg.get('hide_admin_link', False)), etag)
     except Exception as e:
         logging.error(f"Error in routes_page: {str(e)}")
         flash(f"Error loading route table: {str(e)}", "error")
         return redirect(url_for('index'))
 
 
+@app.route('/routes/data')
+def routes_data():
+    """
+    JSON route listing with the same filters as /routes:
+    ?prefix=10.0.0.0/8&dev=eth0&proto=bgp&table=main&page4=1&page6=1&per_page=100
+    """
+    etag = state_etag('routes-data')
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    filters, pages, per_page = route_query_args()
+    results = fetch_route_pages(filters, pages, per_page)
+    return with_etag(jsonify({'filters': filters, 'per_page': per_page, 'ipv4': results[4], 'ipv6': results[6]}),
+                     etag)
+
+
 @app.route('/routes/add', methods=['POST'])
 def add_route_handler():
     if load_admin_config().get('disable_routes'):
@@ -1508,6 +5653,60 @@ def add_route_handler():
     return redirect(url_for('routes_page'))
 
 
+@app.route('/routes/bulk', methods=['POST'])
+def bulk_routes_handler():
+    """
+    Apply many routes in one 'ip -batch' exec. JSON: {"routes": [obj | line, ...],
+    "strict": bool} -> per-item results. Form: bulk_file / bulk_text + strict.
+    """
+    if load_admin_config().get('disable_routes'):
+        if request.is_json:
+            return jsonify({'error': 'Route modifications are disabled by admin.'}), 403
+        flash("Route modifications are disabled by admin.", "error")
+        return redirect(url_for('routes_page'))
+    items, strict, error = read_bulk_request(['routes'])
+    if error:
+        return jsonify({'error': error}), 400
+    ip_version = 6 if str(request.values.get('ip_version', '4')) == '6' else 4
+    job, created = submit_job('routes_bulk', f'Route import ({len(items)} routes)',
+                              lambda job: bulk_routes_job(job, items, ip_version, strict), total=len(items),
+                              key=job_key('routes_bulk', current_netns(), ip_version, strict, items))
+    if wants_job_wait():
+        job = wait_for_job(job['id'])
+        if job['result'] is None:
+            return jsonify({'error': job['error']}), 500
+        return jsonify(job['result']), (200 if not job['result']['failed'] else 207)
+    return job_accepted(job, created, 'routes_page')
+
+
+def bulk_routes_job(job, items, ip_version, strict):
+    """
+    Job body of a bulk route import. Strict imports are one all-or-nothing
+    batch; otherwise the routes go in JOB_CHUNK-sized batches so progress moves
+    as they are applied. Returns the merged bulk_apply summary.
+    """
+    builder = lambda item: build_route_op(item, ip_version)
+
+    def report(start, results):
+        for r in results:
+            status = {'ok': 'ok', 'skipped': 'skipped', 'rolled_back': 'skipped'}.get(r['status'], 'failed')
+            job_progress(job, f"#{start + r['index'] + 1} {r['item']}", status, [r['error']] if r.get('error') else [])
+
+    if strict or len(items) > BULK_MAX_ITEMS:
+        merged = bulk_apply(items, builder, strict, prepare=add_route_undo)
+        report(0, merged['results'])
+    else:
+        merged = {'strict': strict, 'total': len(items), 'applied': 0, 'failed': 0, 'results': []}
+        for start in range(0, len(items), JOB_CHUNK):
+            summary = bulk_apply(items[start:start + JOB_CHUNK], builder)
+            report(start, summary['results'])
+            merged['applied'] += summary['applied']
+            merged['results'] += [dict(r, index=start + r['index']) for r in summary['results']]
+        merged['failed'] = len(items) - merged['applied']
+    flash_bulk_summary(merged, 'routes')
+    return merged
+
+
 @app.route('/routes/del', methods=['POST'])
 def del_route_handler():
     if load_admin_config().get('disable_routes'):
@@ -1517,17 +5716,20 @@ def del_route_handler():
         destination = request.form.get('destination', '').strip()
         gateway     = request.form.get('gateway', '').strip()
         interface   = request.form.get('interface', '').strip()
+        table       = request.form.get('table', '').strip()
         ip_version  = int(request.form.get('ip_version', 4))
 
         if not destination:
             flash("Destination is required to delete a route", "error")
             return redirect(url_for('routes_page'))
 
-        args = ['del', destination]
+        args = ['del'] + destination.split()
         if gateway:
             args += ['via', gateway]
         if interface:
             args += ['dev', interface]
+        if table:
+            args += ['table', table]
 
         ok, err = exec_ip_route(args, ip_version)
         if ok:
@@ -1540,16 +5742,22 @@ def del_route_handler():
     return redirect(url_for('routes_page'))
 
 
-# Ensure all captures are stopped and clean up the pcap directory when the application exits
-import atexit
 # ---------------------------------------------------------------------------
 # Interface detail page — helpers
 # ---------------------------------------------------------------------------
 
+PROC_NET_DEV = '/proc/net/dev'  # module-level so benchmarks can point it at a fixture
+
+
 def read_proc_net_dev(interface):
     """Read rx/tx byte counters directly from /proc/net/dev (no subprocess)."""
+    if current_netns():
+        link = netns_link(interface)
+        if link is None or link['rx_bytes'] is None:
+            return None
+        return {'rx_bytes': link['rx_bytes'], 'tx_bytes': link['tx_bytes'], 'timestamp': time.time()}
     try:
-        with open('/proc/net/dev', 'r') as f:
+        with open(PROC_NET_DEV, 'r') as f:
             for line in f:
                 if ':' not in line:
                     continue
@@ -1566,8 +5774,7 @@ def read_proc_net_dev(interface):
 def get_interface_addresses(interface):
     """Return list of dicts {address, family} for an interface via 'ip addr show'."""
     try:
-        result = subprocess.run(['ip', 'addr', 'show', 'dev', interface],
-                                capture_output=True, text=True)
+        result = run_cmd(['ip', 'addr', 'show', 'dev', interface])
         addrs = []
         for line in result.stdout.splitlines():
             line = line.strip()
@@ -1589,7 +5796,8 @@ def exec_ip_addr(action, interface, address):
     Returns (success, stderr).
     """
     cmd = ['sudo', 'ip', 'addr', action, address, 'dev', interface]
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    with serialized_mutation('exec_ip_addr', interface):
+        result = run_cmd(cmd)
     log_command(cmd, result.stdout + result.stderr)
     return result.returncode == 0, result.stderr.strip()
 
@@ -1603,6 +5811,12 @@ def get_link_state(interface):
                that don't report proper operstate)
     Returns None on error.
     """
+    if current_netns():
+        link = netns_link(interface)
+        if link is None:
+            return None
+        return {'admin_up': bool(link['flags'] & 0x1), 'oper_up': link['operstate'] in ('up', 'unknown'),
+                'operstate': link['operstate']}
     try:
         flags_path = f'/sys/class/net/{interface}/flags'
         with open(flags_path, 'r') as f:
@@ -1621,6 +5835,7 @@ def get_link_state(interface):
         return None
 
 
+@interface_mutation(merge_replace)
 def set_link_state(interface, state):
     """
     Bring interface up or down via 'sudo ip link set <iface> up|down'.
@@ -1630,13 +5845,16 @@ def set_link_state(interface, state):
     if state not in ('up', 'down'):
         return False, 'Invalid state — must be "up" or "down"'
     cmd = ['sudo', 'ip', 'link', 'set', interface, state]
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    result = run_cmd(cmd)
     log_command(cmd, result.stdout + result.stderr)
     return result.returncode == 0, result.stderr.strip()
 
 
 def get_mtu(interface):
     """Return current MTU for interface as an int, or None on failure."""
+    if current_netns():
+        link = netns_link(interface)
+        return link['mtu'] if link else None
     try:
         mtu_path = f'/sys/class/net/{interface}/mtu'
         with open(mtu_path, 'r') as f:
@@ -1646,32 +5864,360 @@ def get_mtu(interface):
         return None
 
 
+@interface_mutation(merge_replace)
 def set_mtu(interface, mtu):
     """
     Run 'sudo ip link set <interface> mtu <mtu>'.
     Returns (success, stderr).
     """
     cmd = ['sudo', 'ip', 'link', 'set', interface, 'mtu', str(mtu)]
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    result = run_cmd(cmd)
     log_command(cmd, result.stdout + result.stderr)
     return result.returncode == 0, result.stderr.strip()
 
 
+# ---------------------------------------------------------------------------
+# Metrics sampler — a background thread takes one host-wide sample every
+# METRICS_INTERVAL seconds (0 disables it) and /metrics renders the cached
+# sample, so a Prometheus scrape never runs a command. One sample costs:
+#   /proc/net/dev and /sys/class/net (no exec), one 'tc -s qdisc show' for all
+#   devices, one 'tc -batch' reading the classes of every HTB device and one
+#   'iptables -S' for NAT.
+# ---------------------------------------------------------------------------
+METRICS_INTERVAL = float(os.environ.get('METRICS_INTERVAL', '10'))
+HTTP_BUCKETS     = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics_sample = {}
+_metrics_lock = threading.Lock()
+_http_stats = {}
+_http_stats_lock = threading.Lock()
+
+
+def read_proc_net_dev_all():
+    """All /proc/net/dev counters: {iface: {rx_bytes, rx_packets, rx_drop, tx_bytes, tx_packets, tx_drop}}."""
+    counters = {}
+    try:
+        with open(PROC_NET_DEV, 'r') as f:
+            for line in f:
+                if ':' not in line:
+                    continue
+                iface, data = line.split(':', 1)
+                fields = [int(v) for v in data.split()]
+                counters[iface.strip()] = {'rx_bytes': fields[0], 'rx_packets': fields[1], 'rx_drop': fields[3],
+                                           'tx_bytes': fields[8], 'tx_packets': fields[9], 'tx_drop': fields[11]}
+    except Exception as e:
+        logging.error(f"Error reading {PROC_NET_DEV}: {e}")
+    return counters
+
+
+def parse_tc_stats(output):
+    """
+    Split 'tc -s qdisc show' output (all devices) into
+    {dev: {'text': <qdisc lines for parse_qdisc_state>, 'qdiscs': [stats dicts]}}.
+    """
+    devices = {}
+    current = None
+    for line in output.splitlines():
+        if line.startswith('qdisc '):
+            m = re.match(r'qdisc (\S+) (\S+) dev (\S+) (root|parent \S+|ingress)?', line)
+            if not m:
+                current = None
+                continue
+            kind, handle, dev = m.group(1), m.group(2), m.group(3)
+            current = {'kind': kind, 'handle': handle, 'parent': (m.group(4) or '').replace('parent ', ''),
+                       'bytes': 0, 'packets': 0, 'drops': 0, 'overlimits': 0, 'backlog_bytes': 0, 'backlog_packets': 0}
+            entry = devices.setdefault(dev, {'text': '', 'qdiscs': []})
+            entry['text'] += line + '\n'
+            entry['qdiscs'].append(current)
+        elif current is not None:
+            m = re.search(r'Sent (\d+) bytes (\d+) pkt \(dropped (\d+), overlimits (\d+)', line)
+            if m:
+                current.update(bytes=int(m.group(1)), packets=int(m.group(2)),
+                               drops=int(m.group(3)), overlimits=int(m.group(4)))
+            m = re.search(r'backlog (\d+(?:\.\d+)?)([KMG]?)b (\d+)p', line)
+            if m:
+                scale = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}[m.group(2)]
+                current.update(backlog_bytes=int(float(m.group(1)) * scale), backlog_packets=int(m.group(3)))
+    return devices
+
+
+def read_htb_classes(devices):
+    """
+    'tc class show' output for each HTB device in one 'tc -batch' exec. tc does
+    not print the device name, so each 'class show dev X' is followed by
+    'qdisc show dev X': a run of class lines ends at the device's qdisc lines.
+    Falls back to one exec per device if the batch fails (e.g. a device vanished).
+    """
+    if not devices:
+        return {}
+    batch = ''.join(f"class show dev {dev}\nqdisc show dev {dev}\n" for dev in devices)
+    result = run_cmd(['sudo', 'tc', '-batch', '-'], input=batch)
+    if result.returncode == 0:
+        sections, current, in_qdisc = [], [], False
+        for line in result.stdout.splitlines():
+            if line.startswith('qdisc '):
+                in_qdisc = True
+                continue
+            if in_qdisc:
+                sections.append(current)
+                current, in_qdisc = [], False
+            current.append(line)
+        if in_qdisc:
+            sections.append(current)
+        if len(sections) == len(devices):
+            return {dev: '\n'.join(lines) + '\n' for dev, lines in zip(devices, sections)}
+    return {dev: run_cmd(['sudo', 'tc', 'class', 'show', 'dev', dev]).stdout for dev in devices}
+
+
+def read_nat_interfaces():
+    """Set of interfaces with a MASQUERADE rule in nat POSTROUTING (one iptables exec)."""
+    if not is_iptables_available():
+        return set()
+    cmd = netfilter_cmd_prefix() + ['iptables', '-t', 'nat', '-S', 'POSTROUTING']
+    result = run_cmd(cmd)
+    return set(re.findall(r'^-A POSTROUTING -o (\S+) -j MASQUERADE\s*$', result.stdout, re.MULTILINE))
+
+
+def time_to_seconds(value):
+    """'10ms' / '500us' / '1s' -> seconds (0.0 if unparseable)."""
+    m = re.match(r'^(\d+(?:\.\d+)?)(us|ms|s)$', (value or '').strip())
+    if not m:
+        return 0.0
+    return float(m.group(1)) * {'us': 1e-6, 'ms': 1e-3, 's': 1.0}[m.group(2)]
+
+
+def sample_host():
+    """Take one host-wide sample and store it as the current metrics snapshot."""
+    start = time.perf_counter()
+    counters = read_proc_net_dev_all()
+    tc_result = run_cmd(['sudo', 'tc', '-s', 'qdisc', 'show'])
+    tc_devices = parse_tc_stats(tc_result.stdout)
+
+    htb_devices = [dev for dev, entry in tc_devices.items()
+                   if 'htb' in entry['text'] and 'tbf' not in entry['text']]
+    classes = read_htb_classes(htb_devices)
+    states = {dev: parse_qdisc_state(entry['text'], classes.get(dev))
+              for dev, entry in tc_devices.items()}
+
+    interfaces = {}
+    for name, counter in counters.items():
+        if name == 'lo' or is_managed_ifb(name):
+            continue
+        ifb = ifb_name_for(name)
+        interfaces[name] = {
+            'counters': counter,
+            'qdiscs': tc_devices.get(name, {}).get('qdiscs', []),
+            'egress': states.get(name),
+            'ingress': states.get(ifb) if ifb in counters else None,
+            'link': get_link_state(name),
+        }
+
+    sample = {'interfaces': interfaces, 'nat': read_nat_interfaces(),
+              'timestamp': time.time(), 'duration': time.perf_counter() - start,
+              'ok': tc_result.returncode == 0}
+    sample['lines'] = render_sample_metrics(sample)
+    with _metrics_lock:
+        sample['count'] = _metrics_sample.get('count', 0) + 1
+        sample['errors'] = _metrics_sample.get('errors', 0) + (0 if sample['ok'] else 1)
+        _metrics_sample.clear()
+        _metrics_sample.update(sample)
+    return sample
+
+
+def metrics_sampler():
+    """Background loop behind /metrics."""
+    while True:
+        try:
+            sample_host()
+        except Exception as e:
+            logging.error(f"Metrics sample failed: {e}")
+        time.sleep(METRICS_INTERVAL)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_http_timing(response):
+    """Per-endpoint request count and latency histogram for /metrics."""
+    start = g.get('request_start')
+    if start is None:
+        return response
+    seconds = time.perf_counter() - start
+    key = (request.endpoint or 'unmatched', request.method, str(response.status_code))
+    with _http_stats_lock:
+        stats = _http_stats.get(key)
+        if stats is None:
+            stats = _http_stats[key] = {'count': 0, 'total_seconds': 0.0, 'buckets': [0] * (len(HTTP_BUCKETS) + 1)}
+        stats['count'] += 1
+        stats['total_seconds'] += seconds
+        for i, bound in enumerate(HTTP_BUCKETS):
+            if seconds <= bound:
+                stats['buckets'][i] += 1
+                break
+        else:
+            stats['buckets'][-1] += 1
+    return response
+
+
+def _prom_labels(**labels):
+    """{k="v",...} with Prometheus label-value escaping."""
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def _prom_histogram(lines, name, bounds, buckets, total, count, **labels):
+    running = 0
+    for bound, n in zip(list(bounds) + ['+Inf'], buckets):
+        running += n
+        lines.append(f"{name}_bucket{_prom_labels(**labels, le=bound)} {running}")
+    lines.append(f"{name}_sum{_prom_labels(**labels)} {total:.6f}")
+    lines.append(f"{name}_count{_prom_labels(**labels)} {count}")
+
+
+def _prom_family(lines, name, kind, help_text):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+
+
+def render_sample_metrics(sample):
+    """Exposition lines for one host sample (rendered once per sample by sample_host)."""
+    lines = []
+
+    def family(name, kind, help_text):
+        _prom_family(lines, name, kind, help_text)
+
+    interfaces = sample.get('interfaces', {})
+    for field, name, help_text in (
+            ('rx_bytes', 'hyyperwan_interface_receive_bytes_total', 'Bytes received (/proc/net/dev).'),
+            ('rx_packets', 'hyyperwan_interface_receive_packets_total', 'Packets received.'),
+            ('rx_drop', 'hyyperwan_interface_receive_drop_total', 'Receive drops.'),
+            ('tx_bytes', 'hyyperwan_interface_transmit_bytes_total', 'Bytes transmitted.'),
+            ('tx_packets', 'hyyperwan_interface_transmit_packets_total', 'Packets transmitted.'),
+            ('tx_drop', 'hyyperwan_interface_transmit_drop_total', 'Transmit drops.')):
+        family(name, 'counter', help_text)
+        for iface, data in sorted(interfaces.items()):
+            lines.append(f"{name}{_prom_labels(interface=iface)} {data['counters'][field]}")
+
+    for field, name, kind, help_text in (
+            ('bytes', 'hyyperwan_qdisc_sent_bytes_total', 'counter', 'Bytes sent by the qdisc.'),
+            ('packets', 'hyyperwan_qdisc_sent_packets_total', 'counter', 'Packets sent by the qdisc.'),
+            ('drops', 'hyyperwan_qdisc_drops_total', 'counter', 'Packets dropped by the qdisc.'),
+            ('overlimits', 'hyyperwan_qdisc_overlimits_total', 'counter', 'Qdisc overlimit events.'),
+            ('backlog_bytes', 'hyyperwan_qdisc_backlog_bytes', 'gauge', 'Bytes queued in the qdisc.'),
+            ('backlog_packets', 'hyyperwan_qdisc_backlog_packets', 'gauge', 'Packets queued in the qdisc.')):
+        family(name, kind, help_text)
+        for iface, data in sorted(interfaces.items()):
+            for qdisc in data['qdiscs']:
+                labels = _prom_labels(interface=iface, kind=qdisc['kind'], handle=qdisc['handle'],
+                                      parent=qdisc['parent'])
+                lines.append(f"{name}{labels} {qdisc[field]}")
+
+    for name, help_text, value in (
+            ('hyyperwan_impairment_delay_seconds', 'Configured netem delay.',
+             lambda s: time_to_seconds(s['latency'])),
+            ('hyyperwan_impairment_jitter_seconds', 'Configured netem jitter.',
+             lambda s: time_to_seconds(s['jitter'])),
+            ('hyyperwan_impairment_loss_ratio', 'Configured netem loss (0-1).',
+             lambda s: float(s['loss'].rstrip('%') or 0) / 100),
+            ('hyyperwan_impairment_rate_bits_per_second', 'Configured rate limit (0 = unlimited).',
+             lambda s: rate_to_bits(s['bandwidth']) or 0)):
+        family(name, 'gauge', help_text)
+        for iface, data in sorted(interfaces.items()):
+            for direction in ('egress', 'ingress'):
+                if data[direction] is not None:
+                    lines.append(f"{name}{_prom_labels(interface=iface, direction=direction)} "
+                                 f"{value(data[direction]):g}")
+
+    family('hyyperwan_interface_admin_up', 'gauge', 'IFF_UP flag.')
+    family('hyyperwan_interface_oper_up', 'gauge', 'Operational state up (or unknown).')
+    for iface, data in sorted(interfaces.items()):
+        if data['link']:
+            lines.append(f"hyyperwan_interface_admin_up{_prom_labels(interface=iface)} {int(data['link']['admin_up'])}")
+            lines.append(f"hyyperwan_interface_oper_up{_prom_labels(interface=iface)} {int(data['link']['oper_up'])}")
+    family('hyyperwan_interface_nat_enabled', 'gauge', 'MASQUERADE rule present for the interface.')
+    for iface in sorted(interfaces):
+        lines.append(f"hyyperwan_interface_nat_enabled{_prom_labels(interface=iface)} "
+                     f"{int(iface in sample.get('nat', ()))}")
+
+    return lines
+
+
+def render_metrics():
+    """Prometheus text exposition: the cached sample plus live HTTP and command statistics."""
+    with _metrics_lock:
+        sample = dict(_metrics_sample)
+    with _http_stats_lock:
+        http = {k: dict(v, buckets=list(v['buckets'])) for k, v in _http_stats.items()}
+    with _cmd_stats_lock:
+        commands = {k: dict(v, buckets=list(v['buckets'])) for k, v in _cmd_stats.items()}
+
+    lines = list(sample.get('lines', ()))
+
+    def family(name, kind, help_text):
+        _prom_family(lines, name, kind, help_text)
+
+    family('hyyperwan_sample_timestamp_seconds', 'gauge', 'Unix time of the cached sample (0 = none yet).')
+    lines.append(f"hyyperwan_sample_timestamp_seconds {sample.get('timestamp', 0):.3f}")
+    family('hyyperwan_sample_duration_seconds', 'gauge', 'Time taken by the last sample.')
+    lines.append(f"hyyperwan_sample_duration_seconds {sample.get('duration', 0):.6f}")
+    family('hyyperwan_samples_total', 'counter', 'Samples taken.')
+    lines.append(f"hyyperwan_samples_total {sample.get('count', 0)}")
+    family('hyyperwan_sample_errors_total', 'counter', 'Samples whose tc read failed.')
+    lines.append(f"hyyperwan_sample_errors_total {sample.get('errors', 0)}")
+
+    family('hyyperwan_http_request_duration_seconds', 'histogram', 'HTTP request latency by endpoint.')
+    for (endpoint, method, code), stats in sorted(http.items()):
+        _prom_histogram(lines, 'hyyperwan_http_request_duration_seconds', HTTP_BUCKETS, stats['buckets'],
+                        stats['total_seconds'], stats['count'], endpoint=endpoint, method=method, code=code)
+
+    family('hyyperwan_command_failures_total', 'counter', 'External commands that exited non-zero.')
+    for sig, stats in sorted(commands.items()):
+        lines.append(f"hyyperwan_command_failures_total{_prom_labels(command=sig)} {stats['failures']}")
+    family('hyyperwan_command_timeouts_total', 'counter', 'External commands killed by COMMAND_TIMEOUT or STREAM_TIMEOUT.')
+    for sig, stats in sorted(commands.items()):
+        lines.append(f"hyyperwan_command_timeouts_total{_prom_labels(command=sig)} {stats['timeouts']}")
+    family('hyyperwan_command_duration_seconds', 'histogram', 'External command latency (count = executions).')
+    for sig, stats in sorted(commands.items()):
+        _prom_histogram(lines, 'hyyperwan_command_duration_seconds', COMMAND_BUCKETS, stats['buckets'],
+                        stats['total_seconds'], stats['count'], command=sig)
+    family('hyyperwan_interface_mutations_total', 'counter',
+           'Interface changes by kind and outcome: executed, serialized (waited behind another change '
+           'to the same interface) or coalesced (merged into a pending change).')
+    for kind, stats in get_mutation_stats().items():
+        for outcome in ('executed', 'serialized', 'coalesced'):
+            lines.append(f"hyyperwan_interface_mutations_total{_prom_labels(kind=kind, outcome=outcome)} {stats[outcome]}")
+    return '\n'.join(lines) + '\n'
+
+
 # ---------------------------------------------------------------------------
 # Interface detail page — routes
 # ---------------------------------------------------------------------------
 
 @app.route('/interface/<name>')
 def interface_detail(name):
+    etag = state_etag(f'interface:{name}')
+    cached = not_modified(etag)
+    if cached:
+        return cached
     try:
         hostname = socket.gethostname()
         alias = get_interface_alias(name)
         addresses = get_interface_addresses(name)
         stats = read_proc_net_dev(name)
         mtu = get_mtu(name)
-        latency, loss, jitter, bandwidth = get_qdisc_settings(name)
+        qdisc_state = get_qdisc_state(name)
+        latency, loss, jitter, bandwidth = (qdisc_state['latency'], qdisc_state['loss'],
+                                            qdisc_state['jitter'], qdisc_state['bandwidth'])
         bw_value, bw_unit = split_bandwidth(bandwidth)
-        src_filter, dst_filter = get_qdisc_filter(name)
+        filter_rules, filter_bandwidth = get_qdisc_filter_rules(name)
+        src_filter, dst_filter = ((filter_rules[0]['src'], filter_rules[0]['dst'])
+                                  if filter_rules else (None, None))
+        filter_bw_value, filter_bw_unit = split_bandwidth(filter_bandwidth)
+        ingress = get_ingress_state(name)
         tc_available = is_tc_available()
         tcpdump_available = is_tcpdump_available()
         iptables_available = is_iptables_available()
@@ -1680,7 +6226,7 @@ def interface_detail(name):
         cfg = load_admin_config()
         iface_ov = cfg.get('interface_overrides', {}).get(name, {})
         tools_column_disabled = cfg.get('disable_tools_column', False)
-        return render_template('interface.html',
+        return with_etag(render_template('interface.html',
                                hostname=hostname,
                                iface_name=name,
                                iface_alias=alias,
@@ -1693,8 +6239,27 @@ def interface_detail(name):
                                bandwidth=bandwidth,
                                bw_value=bw_value,
                                bw_unit=bw_unit,
+                               shaping_mode=(qdisc_state['shaping_mode'] if bandwidth
+                                             else cfg.get('default_shaping_mode', DEFAULT_SHAPING_MODE)),
+                               # Auto unless the installed mode is one Auto would not pick
+                               shaping_choice=(qdisc_state['shaping_mode'] if bandwidth and qdisc_state['shaping_mode']
+                                               not in (cfg.get('default_shaping_mode'), cfg.get('fast_shaping_mode'))
+                                               else 'auto'),
+                               fast_shaping_mode=cfg.get('fast_shaping_mode'),
+                               fast_shaping_threshold=cfg.get('fast_shaping_threshold'),
+                               slot=qdisc_state['slot'],
+                               impaired_queues=qdisc_state['queues'],
+                               queue_limit=qdisc_state['limit'],
+                               queue_burst=qdisc_state['burst'],
+                               queue_latency=qdisc_state['queue'],
+                               ingress=ingress,
                                src_filter=src_filter,
                                dst_filter=dst_filter,
+                               filter_rules=filter_rules,
+                               filter_desc=describe_filter_match(filter_rules[0]) if filter_rules else '',
+                               filter_rules_text='\n'.join(format_filter_rule(r) for r in filter_rules),
+                               filter_bw_value=filter_bw_value,
+                               filter_bw_unit=filter_bw_unit,
                                tc_available=tc_available,
                                tcpdump_available=tcpdump_available,
                                iptables_available=iptables_available,
@@ -1704,7 +6269,8 @@ def interface_detail(name):
                                disable_interface_ips=cfg.get('disable_interface_ips', False),
                                disable_mtu=cfg.get('disable_mtu', False),
                                iface_override=iface_ov,
-                               hide_admin_link=cfg.get('hide_admin_link', False))
+                               netns=current_netns(),
+                               hide_admin_link=cfg.get('hide_admin_link', False)), etag)
     except Exception as e:
         logging.error(f"Error in interface_detail for {name}: {e}")
         flash(f"Error loading interface detail: {e}", "error")
@@ -1720,6 +6286,187 @@ def interface_stats(name):
     return jsonify(stats)
 
 
+@app.route('/interface/<name>/state')
+def interface_state(name):
+    """JSON row state for the index page (same fields as list_interfaces)."""
+    if not IFNAME_RE.match(name) or not interface_exists(name):
+        return jsonify({'error': f'Interface {name} not found'}), 404
+    etag = state_etag(f'state:{name}')
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    state = dict(get_interface_state(name), name=name, alias=load_interface_aliases().get(name, ''),
+                 link_state=get_link_state(name))
+    return with_etag(jsonify(state), etag)
+
+
+@app.route('/interface/<name>/row')
+def interface_row(name):
+    """Full index table row (HTML fragment) for a row the shell rendered as pending."""
+    if not IFNAME_RE.match(name) or not interface_exists(name):
+        return jsonify({'error': f'Interface {name} not found'}), 404
+    etag = state_etag(f'row:{name}')
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    result = run_cmd(['ip', '-j', 'addr', 'show', 'dev', name])
+    log_command(['ip', '-j', 'addr', 'show', 'dev', name], result.stdout)
+    try:
+        entry = json.loads(result.stdout)[0]
+    except (json.JSONDecodeError, IndexError):
+        entry = {'ifname': name}
+    cfg = load_admin_config()
+    return with_etag(render_template('_interface_row.html',
+                                     interface=build_interface_row(entry, load_interface_aliases()),
+                                     netns=current_netns(),
+                                     tcpdump_available=is_tcpdump_available(), tc_available=is_tc_available(),
+                                     iptables_available=is_iptables_available(),
+                                     tools_column_disabled=cfg.get('disable_tools_column', False),
+                                     iface_overrides=cfg.get('interface_overrides', {})), etag)
+
+
+@app.route('/interface/<name>/filter_rules', methods=['GET', 'POST'])
+def interface_filter_rules(name):
+    """
+    GET  — JSON read-back of the filtered rule set: {rules: [...], bandwidth}.
+    POST — replace the egress tree with one HTB class + netem per rule. Accepts the
+           rules textarea (form) or JSON {"rules": [{dst, delay, ...}], "bandwidth": "1gbit"}.
+    """
+    if request.method == 'GET':
+        rules, bandwidth = get_qdisc_filter_rules(name)
+        return jsonify({'interface': name, 'rules': rules, 'bandwidth': bandwidth})
+
+    cfg = load_admin_config()
+    iface_ov = cfg.get('interface_overrides', {}).get(name, {})
+    data = request.get_json(silent=True) if request.is_json else None
+
+    if data is not None:
+        if not isinstance(data, dict):
+            return jsonify({'success': False, 'errors': ["Body must be a JSON object"]}), 400
+        rules, errors = [], []
+        raw_rules = data.get('rules') or []
+        if not isinstance(raw_rules, list):
+            errors.append("rules must be a list of objects")
+            raw_rules = []
+        for index, raw in enumerate(raw_rules, start=1):
+            if not isinstance(raw, dict):
+                errors.append(f"Rule {index}: must be an object")
+                continue
+            raw = {FILTER_RULE_KEYS.get(k, k): str(v) for k, v in raw.items() if v is not None}
+            rule, rule_errors = normalise_filter_rule(raw)
+            errors.extend(f"Rule {index}: {e}" for e in rule_errors)
+            rules.append(rule)
+        bandwidth = data.get('bandwidth') or None
+        if bandwidth is not None and not isinstance(bandwidth, str):
+            errors.append("bandwidth must be a string such as '100mbit'")
+            bandwidth = None
+    else:
+        rules, errors = parse_filter_rules(request.form.get('rules', ''))
+        bw_value = request.form.get('bandwidth_value', '').strip()
+        bandwidth = f"{bw_value}{request.form.get('bandwidth_unit', 'mbit').strip()}" if bw_value else None
+
+    if iface_ov.get('hide_filter'):
+        errors.append(f"Filtered impairments are disabled for {name} by admin")
+    if iface_ov.get('hide_bandwidth'):
+        bandwidth = None
+    bw_valid, bandwidth, bw_error = validate_bandwidth(bandwidth)
+    if not bw_valid:
+        errors.append(bw_error)
+    if not errors and not rules:
+        errors.append("No filter rules specified")
+    if len(rules) > MAX_FILTER_RULES:
+        errors.append(f"At most {MAX_FILTER_RULES} rules are supported ({len(rules)} given)")
+
+    if data is not None:
+        if errors:
+            return jsonify({'success': False, 'errors': errors}), 400
+        apply_qdisc_filtered_rules(name, rules, bandwidth)
+        messages = get_flashed_messages(with_categories=True)
+        ok = not any(category == 'error' for category, _ in messages)
+        return jsonify({'success': ok, 'messages': [m for _, m in messages],
+                        'rules': len(rules)}), (200 if ok else 500)
+
+    if errors:
+        for error in errors:
+            flash(error, 'error')
+    else:
+        apply_qdisc_filtered_rules(name, rules, bandwidth)
+    return redirect(url_for('interface_detail', name=name))
+
+
+@app.route('/interface/<name>/matrix', methods=['POST'])
+def interface_matrix(name):
+    """
+    Install an impairment matrix from an uploaded CSV ('matrix_file') or pasted
+    text ('matrix_text'): prefix,delay,jitter,loss,rate per line.
+    'backend' is auto (ipset when available, else flower), flower or ipset.
+    """
+    cfg = load_admin_config()
+    iface_ov = cfg.get('interface_overrides', {}).get(name, {})
+    errors = []
+
+    upload = request.files.get('matrix_file')
+    if upload and upload.filename:
+        try:
+            text = upload.read().decode('utf-8-sig')
+        except UnicodeDecodeError:
+            text = ''
+            errors.append("Matrix file must be UTF-8 CSV")
+    else:
+        text = request.form.get('matrix_text', '')
+
+    backend = request.form.get('backend', 'auto').strip().lower() or 'auto'
+    if backend not in MATRIX_BACKENDS:
+        errors.append(f"Unknown matrix backend '{backend}'")
+    elif backend == 'ipset' and not is_ipset_available():
+        errors.append("ipset backend requested but ipset/iptables are not available")
+
+    rules, rule_errors = parse_matrix_csv(text)
+    errors.extend(rule_errors)
+    if not rule_errors and not rules:
+        errors.append("Matrix is empty")
+    if len(rules) > MAX_FILTER_RULES:
+        errors.append(f"At most {MAX_FILTER_RULES} prefixes are supported ({len(rules)} given)")
+    if iface_ov.get('hide_filter'):
+        errors.append(f"Filtered impairments are disabled for {name} by admin")
+
+    bw_value = request.form.get('bandwidth_value', '').strip()
+    bandwidth = None
+    if bw_value and not iface_ov.get('hide_bandwidth'):
+        bw_valid, bandwidth, bw_error = validate_bandwidth(f"{bw_value}{request.form.get('bandwidth_unit', 'mbit').strip()}")
+        if not bw_valid:
+            errors.append(bw_error)
+
+    if errors:
+        for error in errors[:20]:
+            flash(error, 'error')
+        if len(errors) > 20:
+            flash(f"... and {len(errors) - 20} more errors", 'error')
+    else:
+        apply_qdisc_filtered_rules(name, rules, bandwidth, classifier=resolve_matrix_backend(backend, rules))
+    return redirect(url_for('interface_detail', name=name))
+
+
+@app.route('/interface/<name>/matrix/lookup')
+def interface_matrix_lookup(name):
+    """JSON: which installed destination rule a destination address hits (longest prefix match)."""
+    import ipaddress
+    dst = request.args.get('dst', '').strip()
+    try:
+        ipaddress.ip_address(dst)
+    except ValueError:
+        return jsonify({'error': f"'{dst}' is not a valid IP address"}), 400
+    rules, index = get_matrix_index(name)
+    hit = index.lookup(dst)
+    if hit is None:
+        return jsonify({'dst': dst, 'match': None, 'prefixes': len(index)})
+    prefix, position = hit
+    return jsonify({'dst': dst, 'match': {'prefix': prefix, 'rule': position + 1,
+                                          'classid': filter_rule_classid(position),
+                                          **rules[position]},
+                    'prefixes': len(index)})
+
+
 @app.route('/interface/<name>/set_link', methods=['POST'])
 def interface_set_link(name):
     """Bring an interface up or down."""
@@ -1785,6 +6532,49 @@ def interface_set_mtu(name):
     return redirect(url_for('interface_detail', name=name))
 
 
+@app.route('/interfaces/bulk', methods=['POST'])
+def bulk_interfaces_handler():
+    """
+    Add/remove addresses and set MTUs in one 'ip -batch' exec. JSON:
+    {"addresses": [{"interface", "address", "action"} | line], "mtu": [{"interface", "mtu"} | line],
+    "strict": bool}. Form: bulk_file / bulk_text + strict; an 'interface' field
+    lets lines omit the interface ('10.0.0.1/24', 'del 10.0.0.1/24', 'mtu 9000').
+    """
+    cfg = load_admin_config()
+    items, strict, error = read_bulk_request(['addresses', 'mtu'])
+    if error:
+        return jsonify({'error': error}), 400
+    default_iface = request.form.get('interface', '').strip()
+    back = (url_for('interface_detail', name=default_iface) if default_iface else url_for('index'))
+    if default_iface:
+        expanded = []
+        for line in items:
+            tokens = line.split()
+            if len(tokens) == 1:
+                tokens = [default_iface] + tokens
+            elif len(tokens) == 2 and tokens[0] in ('add', 'del', 'mtu'):
+                tokens.insert(1, default_iface)
+            expanded.append(' '.join(tokens))
+        items = expanded
+
+    def builder(item):
+        op, error = build_interface_op(item)
+        if op and op['kind'] == 'mtu' and cfg.get('disable_mtu'):
+            return None, 'MTU changes are disabled by admin'
+        if op and op['kind'] == 'addr' and cfg.get('disable_interface_ips'):
+            return None, 'IP address changes are disabled by admin'
+        return op, error
+
+    # Queue behind (and hold off) other changes to every interface the batch touches
+    touched = [op['interface'] for op in (builder(item)[0] for item in items[:BULK_MAX_ITEMS]) if op]
+    with serialized_mutation('bulk_interfaces', *touched):
+        summary = bulk_apply(items, builder, strict, prepare=add_interface_undo)
+    if request.is_json:
+        return jsonify(summary), (200 if not summary['failed'] else 207)
+    flash_bulk_summary(summary, 'address/MTU changes')
+    return redirect(back)
+
+
 @app.route('/interface/<name>/del_addr', methods=['POST'])
 def interface_del_addr(name):
     if load_admin_config().get('disable_interface_ips'):
@@ -1805,8 +6595,6 @@ def interface_del_addr(name):
 # ---------------------------------------------------------------------------
 # Admin routes
 # ---------------------------------------------------------------------------
-import functools
-from flask import Response
 
 def _check_admin_auth(username, password):
     if not ADMIN_PASSWORD:
@@ -1835,9 +6623,9 @@ def admin():
     # Get live interface list for the interface overrides table
     all_interfaces = []
     try:
-        result = subprocess.run(['ip', '-j', 'addr'], capture_output=True, text=True)
+        result = run_cmd(['ip', '-j', 'addr'])
         data = json.loads(result.stdout)
-        all_interfaces = [i['ifname'] for i in data if i['ifname'] != 'lo']
+        all_interfaces = [i['ifname'] for i in data if i['ifname'] != 'lo' and not is_managed_ifb(i['ifname'])]
     except Exception:
         pass
     hostname = socket.gethostname()
@@ -1859,9 +6647,20 @@ def admin_save():
     cfg['hidden_interfaces'] = [i.strip() for i in hidden_raw.split(',') if i.strip()]
     cfg['disable_tools_column']   = 'disable_tools_column'   in request.form
     cfg['default_theme']          = request.form.get('default_theme', '')
+    shaping_mode = request.form.get('default_shaping_mode', 'htb')
+    cfg['default_shaping_mode']   = shaping_mode if shaping_mode in SHAPING_MODES else DEFAULT_SHAPING_MODE
+    fast_mode = request.form.get('fast_shaping_mode', '')
+    cfg['fast_shaping_mode']      = fast_mode if fast_mode in FAST_SHAPING_MODES else ''
+    threshold = request.form.get('fast_shaping_threshold', '').strip().lower()
+    if rate_to_bits(threshold):
+        cfg['fast_shaping_threshold'] = threshold
     cfg['disable_routes']         = 'disable_routes'         in request.form
     cfg['disable_interface_ips']  = 'disable_interface_ips'  in request.form
     cfg['disable_mtu']            = 'disable_mtu'            in request.form
+    cfg['multiqueue_impairments'] = 'multiqueue_impairments' in request.form
+    for key, default in (('netem_limit', 0), ('shaper_burst', 0), ('shaper_queue_ms', 100)):
+        value = request.form.get(key, '').strip()
+        cfg[key] = int(value) if value.isdigit() else default
     hide_admin_now = 'hide_admin_link' in request.form
     was_hidden = cfg.get('hide_admin_link', False)
     cfg['hide_admin_link'] = hide_admin_now
@@ -1940,10 +6739,1051 @@ def admin_import_aliases():
     return redirect(url_for('admin'))
 
 
+@app.route('/stats/commands', methods=['GET'])
+def command_stats():
+    """JSON: per-command counts, failures, timeouts, latency and cumulative histograms, plus mutation counters."""
+    return jsonify({'backend': COMMAND_BACKEND,
+                    'timeout_seconds': COMMAND_TIMEOUT,
+                    'commands': get_command_stats(),
+                    'mutations': get_mutation_stats()})
+
+
+@app.route('/stats/commands/reset', methods=['POST'])
+@_require_admin_auth
+def command_stats_reset():
+    reset_command_stats()
+    reset_mutation_stats()
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/events')
+def events():
+    """
+    Server-sent events: one 'change' event per burst of rtnetlink notifications,
+    data = {"interfaces": [...], "kinds": [...], "removed": [...], "all": bool};
+    NAT changes made in a named namespace also carry "netns".
+    """
+    def stream():
+        q = subscribe_events()
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = q.get(timeout=15)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"event: change\ndata: {json.dumps(event)}\n\n"
+        finally:
+            unsubscribe_events(q)
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text format, rendered from the sampler cache (never runs a command)."""
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+# ---------------------------------------------------------------------------
+# Fleet — every instance serves a small JSON agent API under /api/v1, and any
+# instance can act as a controller for other instances: /fleet shows the
+# interfaces of every registered agent and fans apply/remove/profile
+# operations out to them concurrently over pooled keep-alive HTTP connections.
+#   FLEET_AGENTS      seed for the agent list on first start ("box1=http://10.0.0.1:8080,...")
+#   FLEET_TIMEOUT     seconds per agent request (default 5)
+#   FLEET_WORKERS     agent requests in flight at once (default 16)
+#   FLEET_TLS_VERIFY  verify https agents' certificates (default true)
+# Agents and profiles are stored in the admin config (fleet_agents, fleet_profiles).
+# ---------------------------------------------------------------------------
+
+FLEET_TIMEOUT = float(os.environ.get('FLEET_TIMEOUT', '5'))
+FLEET_WORKERS = max(1, int(os.environ.get('FLEET_WORKERS', '16')))
+FLEET_TLS_VERIFY = os.environ.get('FLEET_TLS_VERIFY', 'true').lower() == 'true'
+FLEET_NAME_RE = re.compile(r'^[\w.-]{1,64}$')
+API_DIRECTIONS = ('egress', 'ingress')
+
+_agent_pool = {}  # (scheme, netloc) -> idle keep-alive connections
+_agent_pool_lock = threading.Lock()
+
+
+def parse_fleet_agents(text):
+    """'box1=http://10.0.0.1:8080,box2=...' -> [{'name', 'url'}] (malformed pairs are dropped)."""
+    agents = []
+    for pair in text.split(','):
+        name, _, url = pair.strip().partition('=')
+        name, url = name.strip(), url.strip().rstrip('/')
+        if FLEET_NAME_RE.match(name) and urlsplit(url).scheme in ('http', 'https'):
+            agents.append({'name': name, 'url': url})
+    return agents
+
+
+def take_flashes():
+    """Pop the messages flashed so far in this request as (category, message) pairs."""
+    return session.pop('_flashes', [])
+
+
+def validate_api_item(item):
+    """
+    Validate one /api/v1/apply item ({interface, direction, latency, loss, jitter,
+    bandwidth, shaping_mode}). Returns (kwargs for the apply functions, errors).
+    Omitted values keep what the interface currently has, as in the UI form.
+    """
+    errors = []
+    if not isinstance(item, dict):
+        return None, ["Item must be an object"]
+    interface = str(item.get('interface') or '')
+    if not IFNAME_RE.match(interface) or not interface_exists(interface):
+        errors.append(f"Interface '{interface}' not found")
+    direction = item.get('direction') or 'egress'
+    if direction not in API_DIRECTIONS:
+        errors.append(f"Unknown direction '{direction}'")
+    shaping_mode = None if item.get('shaping_mode') in (None, '', 'auto') else item['shaping_mode']
+    if shaping_mode is not None and shaping_mode not in SHAPING_MODES:
+        errors.append(f"Unknown shaping mode '{shaping_mode}'")
+
+    kwargs = {'interface': interface, 'direction': direction, 'shaping_mode': shaping_mode}
+    for key, validate in (('latency', lambda v: validate_latency_jitter(v, 'Latency')),
+                          ('jitter', lambda v: validate_latency_jitter(v, 'Jitter')),
+                          ('loss', validate_loss), ('bandwidth', validate_bandwidth)):
+        value = item.get(key)
+        valid, clean, error = validate(str(value) if value is not None else None)
+        if not valid:
+            errors.append(error)
+        kwargs[key] = clean
+    return kwargs, errors
+
+
+def read_api_items():
+    """Items of an /api/v1 request body: {"items": [...]} or a single item object."""
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and isinstance(data.get('items'), list):
+        return data['items']
+    if isinstance(data, dict) and 'interface' in data:
+        return [data]
+    return None
+
+
+def api_results_response(results):
+    """200 when every item succeeded, 207 (Multi-Status) when some failed."""
+    ok = all(r['ok'] for r in results)
+    return jsonify({'success': ok, 'hostname': socket.gethostname(), 'results': results}), (200 if ok else 207)
+
+
+def _agent_connection(key):
+    """Idle pooled connection for (scheme, netloc), or a new one. Returns (conn, reused)."""
+    with _agent_pool_lock:
+        idle = _agent_pool.get(key)
+        if idle:
+            return idle.pop(), True
+    scheme, netloc = key
+    if scheme == 'https':
+        context = None if FLEET_TLS_VERIFY else ssl._create_unverified_context()
+        return http.client.HTTPSConnection(netloc, timeout=FLEET_TIMEOUT, context=context), False
+    return http.client.HTTPConnection(netloc, timeout=FLEET_TIMEOUT), False
+
+
+def _release_connection(key, conn):
+    with _agent_pool_lock:
+        idle = _agent_pool.setdefault(key, [])
+        if len(idle) < FLEET_WORKERS:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+def agent_request(agent, method, path, body=None, timeout=None):
+    """
+    One request to an agent over a pooled keep-alive connection. Returns
+    (status, data, error): data is parsed JSON for JSON responses, text
+    otherwise; error is set when no response arrived. A pooled connection the
+    agent has closed in the meantime is retried once on a fresh one.
+    """
+    parts = urlsplit(agent['url'])
+    key = (parts.scheme, parts.netloc)
+    payload = json.dumps(body).encode() if body is not None else None
+    headers = {'Accept': 'application/json'}
+    if payload is not None:
+        headers['Content-Type'] = 'application/json'
+
+    for attempt in range(2):
+        conn, reused = _agent_connection(key)
+        conn.timeout = timeout or FLEET_TIMEOUT
+        if conn.sock is not None:
+            conn.sock.settimeout(conn.timeout)
+        try:
+            conn.request(method, parts.path.rstrip('/') + path, body=payload, headers=headers)
+            response = conn.getresponse()
+            raw = response.read()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+            conn.close()
+            if reused and attempt == 0:
+                continue
+            return None, None, f"connection closed: {e}"
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            return None, None, str(e) or type(e).__name__
+        if response.will_close:
+            conn.close()
+        else:
+            _release_connection(key, conn)
+        text = raw.decode('utf-8', 'replace')
+        if 'json' in (response.getheader('Content-Type') or ''):
+            try:
+                return response.status, json.loads(text), None
+            except ValueError:
+                pass
+        return response.status, text, None
+
+
+def fan_out(agents, call, on_result=None):
+    """
+    Run call(agent) -> (status, data, error) for every agent, FLEET_WORKERS at a
+    time. Returns one result per agent, in agent order:
+    {agent, ok, status, data, error, seconds}; ok means HTTP 200. on_result(result)
+    is called from the worker thread as each agent answers.
+    """
+    results = [None] * len(agents)
+    jobs = queue.Queue()
+    for index in range(len(agents)):
+        jobs.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = jobs.get_nowait()
+            except queue.Empty:
+                return
+            agent = agents[index]
+            start = time.monotonic()
+            try:
+                status, data, error = call(agent)
+            except Exception as e:
+                status, data, error = None, None, str(e)
+            if error is None and status != 200:
+                error = (data.get('error') if isinstance(data, dict) else None) or f"HTTP {status}"
+            results[index] = {'agent': agent['name'], 'ok': status == 200 and error is None, 'status': status,
+                              'data': data, 'error': error, 'seconds': time.monotonic() - start}
+            if on_result:
+                on_result(results[index])
+
+    threads = [threading.Thread(target=worker, name=f'fleet-{n}')
+               for n in range(min(FLEET_WORKERS, len(agents)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def fleet_dispatch(agents, items, action, on_result=None):
+    """
+    Group items ({agent, interface, ...}) by agent and send each agent one
+    /api/v1/<action> request carrying all of its items. Unknown agents fail.
+    on_result is passed on to fan_out (and also sees the unknown agents).
+    """
+    by_name = {agent['name']: agent for agent in agents}
+    grouped = {}
+    for item in items:
+        grouped.setdefault(item.get('agent'), []).append({k: v for k, v in item.items() if k != 'agent'})
+    targets = [by_name[name] for name in grouped if name in by_name]
+    results = fan_out(targets, lambda agent: agent_request(agent, 'POST', f'/api/v1/{action}',
+                                                           {'items': grouped[agent['name']]}), on_result)
+    for name in grouped:
+        if name not in by_name:
+            results.append({'agent': name, 'ok': False, 'status': None, 'data': None,
+                            'error': 'unknown agent', 'seconds': 0.0})
+            if on_result:
+                on_result(results[-1])
+    return results
+
+
+def flash_fleet_results(results, verb):
+    """One flash per agent: success, or the agent-level / per-interface errors."""
+    for r in results:
+        data = r['data'] if isinstance(r['data'], dict) else {}
+        failed = [f"{item['interface']}: {'; '.join(item['messages'])}"
+                  for item in data.get('results', []) if not item.get('ok')]
+        if r['ok']:
+            flash(f"{r['agent']}: {verb} {len(data.get('results', []))} interface(s) "
+                  f"in {r['seconds'] * 1000:.0f} ms", 'success')
+        elif failed:
+            flash(f"{r['agent']}: {'; '.join(failed)}", 'error')
+        else:
+            flash(f"{r['agent']}: {r['error']}", 'error')
+
+
+def read_fleet_targets():
+    """Items from the /fleet form: checked 'agent|interface' targets plus the shared settings."""
+    settings = {key: request.form.get(key, '').strip() or None
+                for key in ('latency', 'jitter', 'loss', 'shaping_mode')}
+    bw_value = request.form.get('bandwidth_value', '').strip()
+    settings['bandwidth'] = f"{bw_value}{request.form.get('bandwidth_unit', 'mbit')}" if bw_value else None
+    settings['direction'] = request.form.get('direction', 'egress')
+    items = []
+    for target in request.form.getlist('targets'):
+        agent, _, interface = target.partition('|')
+        if agent and interface:
+            items.append(dict(settings, agent=agent, interface=interface))
+    return items
+
+
+def fleet_items_error(items):
+    """Why a JSON list of fleet items can not be dispatched, or None."""
+    if not isinstance(items, list):
+        return 'items must be a list'
+    for number, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            return f"Item {number}: must be an object"
+        for key in ('agent', 'interface'):
+            if not isinstance(item.get(key), str) or not item[key]:
+                return f"Item {number}: '{key}' must be a non-empty string"
+    return None
+
+
+def merge_agent_metrics(results):
+    """
+    Merge agents' /metrics into one exposition: every sample gets an agent
+    label, and HELP/TYPE appear once per family. Adds per-agent up and scrape
+    duration gauges.
+    """
+    families, order = {}, []
+    for r in results:
+        if not r['ok'] or not isinstance(r['data'], str):
+            continue
+        agent_label = _prom_labels(agent=r['agent'])[1:-1]
+        family = None
+        for line in r['data'].splitlines():
+            if line.startswith(('# HELP ', '# TYPE ')):
+                family = line.split(' ', 3)[2]
+                if family not in families:
+                    families[family] = ([], [])
+                    order.append(family)
+                if line not in families[family][0]:
+                    families[family][0].append(line)
+            elif line and not line.startswith('#') and family is not None:
+                name, brace, rest = line.partition('{')
+                if brace:
+                    sample = f"{name}{{{agent_label},{rest}" if not rest.startswith('}') else f"{name}{{{agent_label}{rest}"
+                else:
+                    name, _, value = line.partition(' ')
+                    sample = f"{name}{{{agent_label}}} {value}"
+                families[family][1].append(sample)
+
+    lines = []
+    _prom_family(lines, 'hyyperwan_fleet_agent_up', 'gauge', 'Whether the agent answered the last /metrics scrape')
+    for r in results:
+        lines.append(f"hyyperwan_fleet_agent_up{_prom_labels(agent=r['agent'])} {1 if r['ok'] else 0}")
+    _prom_family(lines, 'hyyperwan_fleet_scrape_seconds', 'gauge', 'Duration of the last /metrics scrape per agent')
+    for r in results:
+        lines.append(f"hyyperwan_fleet_scrape_seconds{_prom_labels(agent=r['agent'])} {r['seconds']:.6f}")
+    for family in order:
+        lines.extend(families[family][0])
+        lines.extend(families[family][1])
+    return '\n'.join(lines) + '\n'
+
+
+# ---- Agent API -------------------------------------------------------------
+
+@app.route('/api/v1/interfaces')
+def api_interfaces():
+    """Interface rows (same fields as the index page) for a fleet controller."""
+    return jsonify({'hostname': socket.gethostname(), 'interfaces': list_interfaces()})
+
+
+@app.route('/api/v1/apply', methods=['POST'])
+def api_apply():
+    """
+    Apply impairments: {"items": [{interface, direction, latency, loss, jitter,
+    bandwidth, shaping_mode}]} or a single item. Per-item results; 207 on partial failure.
+    """
+    items = read_api_items()
+    if items is None:
+        return jsonify({'error': 'Expected {"items": [...]} or a single item with "interface"'}), 400
+    results = []
+    for item in items:
+        kwargs, errors = validate_api_item(item)
+        interface = kwargs['interface'] if kwargs else None
+        if errors:
+            results.append({'interface': interface, 'ok': False, 'messages': errors})
+            continue
+        direction = kwargs.pop('direction')
+        if direction == 'ingress':
+            apply_ingress_qdisc(**kwargs)
+        else:
+            apply_qdisc(**kwargs)
+        messages = take_flashes()
+        results.append({'interface': interface, 'ok': not any(c == 'error' for c, _ in messages),
+                        'messages': [m for _, m in messages]})
+    return api_results_response(results)
+
+
+@app.route('/api/v1/remove', methods=['POST'])
+def api_remove():
+    """Remove impairments: {"items": [{interface, direction}]} (direction egress/ingress/both, default both)."""
+    items = read_api_items()
+    if items is None:
+        return jsonify({'error': 'Expected {"items": [...]} or a single item with "interface"'}), 400
+    results = []
+    for item in items:
+        interface = str(item.get('interface') or '') if isinstance(item, dict) else ''
+        direction = (item.get('direction') if isinstance(item, dict) else None) or 'both'
+        if not IFNAME_RE.match(interface) or not interface_exists(interface):
+            results.append({'interface': interface, 'ok': False, 'messages': [f"Interface '{interface}' not found"]})
+            continue
+        if direction not in API_DIRECTIONS + ('both',):
+            results.append({'interface': interface, 'ok': False, 'messages': [f"Unknown direction '{direction}'"]})
+            continue
+        remove_degradations(interface, direction)
+        messages = take_flashes()
+        results.append({'interface': interface, 'ok': not any(c == 'error' for c, _ in messages),
+                        'messages': [m for _, m in messages]})
+    return api_results_response(results)
+
+
+# ---- Host state document -----------------------------------------------------
+# PUT /api/v1/state reconciles the host to a declarative document:
+#   {"interfaces": {"eth1": {"egress": {latency, jitter, loss, bandwidth, shaping_mode, slot, multiqueue}
+#                                      | {"rules": [...] | "rule text", "bandwidth"} | null,
+#                            "ingress": {latency, ...} | null,
+#                            "nat": bool, "mtu": int, "up": bool}},
+#    "prune": bool, "dry_run": bool}
+# An impairment object is the whole wanted state of that direction (omitted
+# values are zero, not "keep"); a key left out of an interface leaves that
+# aspect alone, and with "prune" interfaces missing from the document lose
+# their impairments and NAT. The host is read in one snapshot — one 'tc qdisc
+# show' for every device, one 'tc -batch' for HTB classes, one 'iptables -S'
+# when NAT is involved, sysfs for MTU and link state — every interface is
+# planned against it with plan_tree(), and only the changes run, one batch
+# per tool:  ip (MTU, link, new IFBs) -> tc -> ip (IFBs removed) -> iptables-restore.
+# An interface that already matches adds no line; a host that matches runs
+# nothing after the snapshot. GET returns the current document; dry_run (or
+# ?dry_run=1) returns the plan and an apply-time estimate without applying.
+# Filter rules are classified with flower here (the ipset matrix classifier
+# keeps its own endpoint).
+#   RECONCILE_EXEC_SECONDS  assumed cost of a batch exec not timed yet (default 0.01)
+#   RECONCILE_LINE_SECONDS  assumed cost of one batch line (default 0.0005)
+RECONCILE_EXEC_SECONDS = float(os.environ.get('RECONCILE_EXEC_SECONDS', '0.01'))
+RECONCILE_LINE_SECONDS = float(os.environ.get('RECONCILE_LINE_SECONDS', '0.0005'))
+STATE_KEYS = ('egress', 'ingress', 'nat', 'mtu', 'up')
+STATE_SETTING_KEYS = ('latency', 'jitter', 'loss', 'bandwidth', 'shaping_mode', 'slot', 'multiqueue')
+
+
+def read_host_snapshot(nat=False):
+    """
+    {'qdiscs': {dev: 'tc qdisc show' lines}, 'classes': {dev: 'tc class show'
+    output for HTB devices}, 'nat': MASQUERADE interfaces (None unless nat)}.
+    """
+    result = run_cmd(['sudo', 'tc', 'qdisc', 'show'])
+    qdiscs = {}
+    for line in result.stdout.splitlines():
+        m = re.match(r'qdisc \S+ \S+ dev (\S+) ', line)
+        if m:
+            qdiscs[m.group(1)] = qdiscs.get(m.group(1), '') + line + '\n'
+    htb = [dev for dev, text in qdiscs.items() if 'htb' in text and 'tbf' not in text]
+    return {'qdiscs': qdiscs, 'classes': read_htb_classes(htb),
+            'nat': read_nat_interfaces() if nat else None}
+
+
+def validate_state_settings(spec, direction, cfg):
+    """
+    Normalise one impairment object of a state document. Returns (entry, errors):
+    a recordable desired-state entry (kind 'simple' or 'filtered', see the
+    desired-state section) or None when the object asks for no impairment.
+    """
+    if not isinstance(spec, dict):
+        return None, [f"{direction} must be an object or null"]
+    if 'rules' in spec:
+        if direction != 'egress':
+            return None, ["Filter rules apply to egress only"]
+        raw, errors = spec['rules'], []
+        if isinstance(raw, str):
+            rules, errors = parse_filter_rules(raw)
+        elif isinstance(raw, list):
+            rules = []
+            for number, rule in enumerate(raw, start=1):
+                unknown = sorted(set(rule) - set(FILTER_RULE_KEYS)) if isinstance(rule, dict) else None
+                if unknown is None or unknown:
+                    errors.append(f"Rule {number}: " + ("must be an object" if unknown is None
+                                                         else f"unknown keys {', '.join(unknown)}"))
+                    continue
+                clean, rule_errors = normalise_filter_rule(
+                    {FILTER_RULE_KEYS[k]: str(v) for k, v in rule.items() if v is not None})
+                errors.extend(f"Rule {number}: {e}" for e in rule_errors)
+                rules.append(clean)
+        else:
+            return None, ["rules must be a list of rule objects or rule text"]
+        if len(rules) > MAX_FILTER_RULES:
+            errors.append(f"At most {MAX_FILTER_RULES} rules are supported")
+        valid, bandwidth, error = validate_bandwidth(str(spec.get('bandwidth') or ''))
+        if not valid:
+            errors.append(error)
+        if not rules:
+            return None, errors
+        return {'kind': 'filtered', 'rules': rules, 'bandwidth': bandwidth, 'classifier': 'flower'}, errors
+
+    errors = [f"Unknown {direction} key '{key}'" for key in spec if key not in STATE_SETTING_KEYS]
+    values = {}
+    for key, label in (('latency', 'Latency'), ('jitter', 'Jitter')):
+        value = str(spec.get(key) or '').strip().lower()
+        if _TIME_TOKEN.match(value):
+            values[key] = value          # '500us', '1.5ms' as read back by GET
+            continue
+        valid, clean, error = validate_latency_jitter(value, label)
+        if not valid:
+            errors.append(error)
+        values[key] = f"{clean}ms" if clean else '0ms'
+    loss = str(spec.get('loss') or '').strip()
+    if _PERCENT_TOKEN.match(loss) and float(loss[:-1]) <= 100:
+        values['loss'] = loss
+    else:
+        valid, clean, error = validate_loss(loss)
+        if not valid:
+            errors.append(error)
+        values['loss'] = f"{clean}%" if clean else '0%'
+    valid, values['bandwidth'], error = validate_bandwidth(str(spec.get('bandwidth') or ''))
+    if not valid:
+        errors.append(error)
+    valid, values['slot'], error = validate_slot(str(spec.get('slot') or ''))
+    if not valid:
+        errors.append(error)
+    # None / 'auto' resolves to the fast shaping mode for high caps, else the admin default
+    shaping_mode = None if spec.get('shaping_mode') in (None, '', 'auto') else spec['shaping_mode']
+    if shaping_mode is not None and shaping_mode not in SHAPING_MODES:
+        errors.append(f"Unknown shaping mode '{shaping_mode}'")
+    multiqueue = spec.get('multiqueue')
+    if multiqueue is not None and not isinstance(multiqueue, bool):
+        errors.append("multiqueue must be true or false")
+    if errors:
+        return None, errors
+
+    settings = resolve_qdisc_settings(parse_qdisc_state(''), shaping_mode=shaping_mode, cfg=cfg, **values)
+    if not build_qdisc_commands('-', sizing=queue_sizing(None, cfg), **settings):
+        return None, []
+    if multiqueue is None:
+        multiqueue = cfg.get('multiqueue_impairments', False)
+    return dict(settings, kind='simple', multiqueue=multiqueue), []
+
+
+def validate_state_document(data, cfg):
+    """
+    Validate a PUT /api/v1/state body. Returns (interfaces {name: entry}, errors
+    {name or '': [messages]}); entries carry only the aspects the document sets.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('interfaces'), dict):
+        return {}, {'': ['Expected {"interfaces": {name: {...}}}']}
+    interfaces, errors = {}, {}
+    for name, entry in data['interfaces'].items():
+        problems = []
+        if not IFNAME_RE.match(str(name)) or not interface_exists(name) or is_managed_ifb(name):
+            problems.append(f"Interface '{name}' not found")
+        elif not isinstance(entry, dict):
+            problems.append("Interface entry must be an object")
+        else:
+            overrides = cfg.get('interface_overrides', {}).get(name, {})
+            clean = {}
+            problems += [f"Unknown key '{key}'" for key in entry if key not in STATE_KEYS]
+            for direction in API_DIRECTIONS:
+                if direction in entry:
+                    if entry[direction] is None:
+                        clean[direction] = None
+                    else:
+                        clean[direction], direction_errors = validate_state_settings(entry[direction], direction, cfg)
+                        problems += [f"{direction}: {e}" for e in direction_errors]
+            if (clean.get('egress') or {}).get('kind') == 'filtered' and overrides.get('hide_filter'):
+                problems.append("Filter rules are disabled for this interface by admin")
+            if 'nat' in entry:
+                if not isinstance(entry['nat'], bool):
+                    problems.append("nat must be true or false")
+                elif overrides.get('hide_nat'):
+                    problems.append("NAT control is disabled for this interface by admin")
+                elif not is_iptables_available():
+                    problems.append("iptables is not available")
+                clean['nat'] = entry['nat']
+            if 'mtu' in entry:
+                mtu = entry['mtu']
+                if not isinstance(mtu, int) or isinstance(mtu, bool) or not (68 <= mtu <= 65535):
+                    problems.append("mtu must be an integer between 68 and 65535")
+                elif cfg.get('disable_mtu'):
+                    problems.append("MTU changes are disabled by admin")
+                clean['mtu'] = mtu
+            if 'up' in entry:
+                if not isinstance(entry['up'], bool):
+                    problems.append("up must be true or false")
+                elif overrides.get('hide_link_ctrl'):
+                    problems.append("Link control is disabled for this interface by admin")
+                clean['up'] = entry['up']
+            interfaces[name] = clean
+        if problems:
+            errors[name] = problems
+    return interfaces, errors
+
+
+def egress_tree(interface, entry, sizing=None):
+    """Builder commands for a recorded egress entry (None -> no tree)."""
+    if not entry:
+        return []
+    if entry.get('kind') == 'filtered':
+        return build_filtered_commands(interface, entry['rules'], entry.get('bandwidth'),
+                                       with_filters=entry.get('classifier') != 'ipset', sizing=sizing)
+    settings = {k: entry.get(k) for k in ('latency', 'loss', 'jitter', 'bandwidth', 'shaping_mode', 'slot')}
+    queues = get_tx_queue_count(interface) if entry.get('multiqueue') else 1
+    return build_qdisc_commands(interface, queues=queues, sizing=sizing, **settings)
+
+
+def plan_interface_state(name, entry, snapshot, recorded, cfg=None):
+    """
+    Plan one interface of a validated document against the snapshot. Returns
+    {'actions': {aspect: action}, 'ip', 'tc', 'ip_post': command lists,
+    'nat': iptables-restore line or None, 'record': {direction: entry},
+    'matrix': True if a matrix-classified tree is torn down}.
+    """
+    qdisc_output = snapshot['qdiscs'].get(name, '')
+    class_output = snapshot['classes'].get(name)
+    plan = {'actions': {}, 'ip': [], 'tc': [], 'ip_post': [], 'nat': None, 'record': {}, 'matrix': False}
+    # Trees are sized for the MTU the document leaves the interface with
+    sizing = queue_sizing(name, cfg) if ('egress' in entry or 'ingress' in entry) else None
+    if sizing and 'mtu' in entry:
+        sizing['mtu'] = entry['mtu']
+
+    if 'egress' in entry:
+        wanted = egress_tree(name, entry['egress'], sizing)
+        before = recorded.get('egress')
+        if before and before.get('kind') == 'filtered':
+            installed = egress_tree(name, before, sizing)
+        else:
+            installed = installed_tree(name, parse_qdisc_state(qdisc_output, class_output), sizing=sizing)
+        commands, action = plan_tree(name, wanted, installed, qdisc_output, class_output)
+        plan['tc'] += commands
+        plan['actions']['egress'] = action
+        plan['record']['egress'] = entry['egress']
+        plan['matrix'] = action in ('rebuild', 'remove') and bool(before) and before.get('classifier') == 'ipset'
+
+    if 'ingress' in entry:
+        ifb = ifb_name_for(name)
+        ifb_exists = interface_exists(ifb)
+        redirected = re.search(r'^qdisc ingress ffff: ', qdisc_output, re.MULTILINE) is not None
+        spec = entry['ingress']
+        rx_queues = get_rx_queue_count(name)
+        tree = build_qdisc_commands(ifb, queues=rx_queues if spec and spec['multiqueue'] else 1, sizing=sizing,
+                                    **{k: spec[k] for k in ('latency', 'loss', 'jitter', 'bandwidth',
+                                                            'shaping_mode', 'slot')}) if spec else []
+        if not tree:
+            action = 'remove' if (ifb_exists or redirected) else 'noop'
+            if redirected:
+                plan['tc'].append(['qdisc', 'del', 'dev', name, 'ingress'])
+            if ifb_exists:
+                plan['ip_post'].append(['link', 'del', ifb])
+        else:
+            ifb_output = snapshot['qdiscs'].get(ifb, '') if ifb_exists else ''
+            ifb_classes = snapshot['classes'].get(ifb)
+            if not ifb_exists:
+                plan['ip'] += [['link', 'add', ifb, 'numtxqueues', str(rx_queues), 'numrxqueues', str(rx_queues),
+                                'type', 'ifb'],
+                               ['link', 'set', ifb, 'up']]
+            installed = (installed_tree(ifb, parse_qdisc_state(ifb_output, ifb_classes), sizing=sizing)
+                         if ifb_exists else None)
+            changes, action = plan_tree(ifb, tree, installed, ifb_output, ifb_classes)
+            if not redirected:
+                plan['tc'] += [['qdisc', 'replace', 'dev', name, 'handle', 'ffff:', 'ingress'],
+                               ['filter', 'replace', 'dev', name, 'parent', 'ffff:', 'protocol', 'all',
+                                'prio', '1', 'handle', '1', 'matchall',
+                                'action', 'mirred', 'egress', 'redirect', 'dev', ifb]]
+                action = 'add' if action == 'noop' else action
+            plan['tc'] += changes
+        plan['actions']['ingress'] = action
+        plan['record']['ingress'] = {k: v for k, v in spec.items() if k != 'kind'} if tree else None
+
+    if 'nat' in entry:
+        enabled = name in snapshot['nat']
+        if entry['nat'] != enabled:
+            plan['nat'] = f"{'-A' if entry['nat'] else '-D'} POSTROUTING -o {name} -j MASQUERADE"
+        plan['actions']['nat'] = 'noop' if entry['nat'] == enabled else ('enable' if entry['nat'] else 'disable')
+
+    if 'mtu' in entry:
+        changed = get_mtu(name) != entry['mtu']
+        if changed:
+            plan['ip'].append(['link', 'set', 'dev', name, 'mtu', str(entry['mtu'])])
+        plan['actions']['mtu'] = 'set' if changed else 'noop'
+
+    if 'up' in entry:
+        link = get_link_state(name)
+        changed = link is None or link['admin_up'] != entry['up']
+        if changed:
+            plan['ip'].append(['link', 'set', 'dev', name, 'up' if entry['up'] else 'down'])
+        plan['actions']['up'] = 'set' if changed else 'noop'
+    return plan
+
+
+def prune_state_entries(interfaces, snapshot):
+    """Entries removing impairments and NAT from every interface the document leaves out."""
+    pruned = {}
+    for dev, text in snapshot['qdiscs'].items():
+        if dev in interfaces or is_managed_ifb(dev):
+            continue
+        if has_custom_qdisc(text):
+            pruned.setdefault(dev, {})['egress'] = None
+        if re.search(r'^qdisc ingress ffff: ', text, re.MULTILINE):
+            pruned.setdefault(dev, {})['ingress'] = None
+    for dev in snapshot['nat'] or ():
+        if dev not in interfaces and interface_exists(dev):
+            pruned.setdefault(dev, {})['nat'] = False
+    return pruned
+
+
+def nat_restore_command():
+    return netfilter_cmd_prefix() + ['iptables-restore', '--noflush']
+
+
+def estimate_batch_seconds(cmd, lines):
+    """Rough apply time of one batch exec: its measured mean (or RECONCILE_EXEC_SECONDS) plus a per-line cost."""
+    if not lines:
+        return 0.0
+    stats = get_command_stats().get(command_signature(cmd))
+    per_exec = stats['mean_ms'] / 1000 if stats else RECONCILE_EXEC_SECONDS
+    return per_exec + lines * RECONCILE_LINE_SECONDS
+
+
+def plan_host_state(interfaces, prune=False):
+    """
+    Snapshot the host and plan every interface of a validated document (plus the
+    pruned ones). Returns {name: interface plan} and the batches
+    {'ip', 'tc', 'ip_post': [(owner, argv)], 'nat': [(owner, line)]}.
+    """
+    nat = prune or any('nat' in entry for entry in interfaces.values())
+    snapshot = read_host_snapshot(nat=nat)
+    if prune:
+        interfaces = dict(interfaces, **prune_state_entries(interfaces, snapshot))
+    desired = load_desired_state() if not current_netns() else {}
+    cfg = load_admin_config()
+    plans, batches = {}, {'ip': [], 'tc': [], 'ip_post': [], 'nat': []}
+    for name, entry in interfaces.items():
+        plan = plan_interface_state(name, entry, snapshot, desired.get(name, {}), cfg)
+        plans[name] = plan
+        for tool in ('ip', 'tc', 'ip_post'):
+            batches[tool] += [(name, cmd) for cmd in plan[tool]]
+        if plan['nat']:
+            batches['nat'].append((name, plan['nat']))
+    return plans, batches
+
+
+def describe_host_plan(plans, batches):
+    """JSON summary of a plan: per-interface actions, the batch lines, exec count and estimated seconds."""
+    execs = {'ip': ['sudo', 'ip', '-force', '-batch', '-'], 'tc': ['sudo', 'tc', '-force', '-batch', '-'],
+             'ip_post': ['sudo', 'ip', '-force', '-batch', '-'], 'nat': nat_restore_command()}
+    return {
+        'interfaces': {name: plan['actions'] for name, plan in plans.items()},
+        'batches': {tool: [line if tool == 'nat' else ' '.join(line) for _, line in owned]
+                    for tool, owned in batches.items()},
+        'execs': sum(1 for tool in batches if batches[tool]),
+        'estimated_seconds': round(sum(estimate_batch_seconds(execs[tool], len(batches[tool]))
+                                       for tool in batches), 6),
+    }
+
+
+def apply_host_plan(plans, batches):
+    """
+    Run the planned batches in order. Interfaces with a failed line are skipped
+    by the later batches, keep their recorded state and lose any tree the failed
+    batch left half-built. Returns {name: error}.
+    """
+    failed = run_owned_batch('ip', batches['ip'])
+    tc_failed = run_owned_batch('tc', [(o, c) for o, c in batches['tc'] if o not in failed])
+    failed.update(tc_failed)
+    for name, error in run_owned_batch('ip', [(o, c) for o, c in batches['ip_post'] if o not in failed]).items():
+        failed.setdefault(name, error)
+
+    # Tear down trees left half-built by a failed tc line, as the startup restore does
+    teardown_tc, teardown_ip = [], []
+    for name in tc_failed:
+        actions = plans[name]['actions']
+        if actions.get('egress') in ('add', 'rebuild'):
+            teardown_tc.append(['qdisc', 'del', 'dev', name, 'root'])
+        if actions.get('ingress') == 'add':
+            teardown_tc.append(['qdisc', 'del', 'dev', name, 'ingress'])
+            teardown_ip.append(['link', 'del', ifb_name_for(name)])
+    run_tc_batch(teardown_tc)
+    run_ip_batch(teardown_ip)
+
+    nat_lines = [(name, line) for name, line in batches['nat'] if name not in failed]
+    if nat_lines:
+        # One atomic iptables-restore: all NAT changes apply or none do
+        cmd = nat_restore_command()
+        rules = '*nat\n' + ''.join(line + '\n' for _, line in nat_lines) + 'COMMIT\n'
+        result = run_cmd(cmd, input=rules)
+        log_command(cmd, f"{rules}{result.stdout}{result.stderr}")
+        if result.returncode != 0:
+            error = result.stderr.strip() or f"iptables-restore exited {result.returncode}"
+            for name, _ in nat_lines:
+                failed.setdefault(name, error)
+
+    changed = []
+    for name, plan in plans.items():
+        if plan['matrix']:
+            remove_matrix_classifier(name)
+            invalidate_matrix_index(name)
+        if name in failed:
+            continue
+        for direction, entry in plan['record'].items():
+            record_desired_state(name, direction, entry)
+        if any(action != 'noop' for action in plan['actions'].values()):
+            changed.append(name)
+            invalidate_interface_state(name)
+    if any(name in changed for name, _ in nat_lines):
+        # iptables changes raise no rtnetlink event
+        publish_event({'interfaces': [name for name, _ in nat_lines if name in changed], 'kinds': ['nat'],
+                       'removed': [], 'all': False, 'netns': current_netns()})
+    if failed:
+        logging.error(f"State reconcile failed on {sorted(failed)}: {failed}")
+    return failed
+
+
+def current_state_document():
+    """The host's current state as a PUT /api/v1/state document (one snapshot)."""
+    snapshot = read_host_snapshot(nat=is_iptables_available())
+    desired = load_desired_state() if not current_netns() else {}
+    interfaces = {}
+    for dev, text in sorted(snapshot['qdiscs'].items()):
+        if dev == 'lo' or is_managed_ifb(dev):
+            continue
+        entry = {}
+        recorded = desired.get(dev, {}).get('egress')
+        if not has_custom_qdisc(text):
+            entry['egress'] = None
+        elif recorded and recorded.get('kind') == 'filtered' and recorded.get('classifier') != 'ipset':
+            entry['egress'] = {'rules': '\n'.join(format_filter_rule(rule) for rule in recorded['rules']),
+                               'bandwidth': recorded.get('bandwidth')}
+        else:
+            state = parse_qdisc_state(text, snapshot['classes'].get(dev))
+            entry['egress'] = dict({k: state[k] for k in STATE_SETTING_KEYS[:-1]}, multiqueue=state['queues'] > 1)
+        ifb = ifb_name_for(dev)
+        if ifb in snapshot['qdiscs']:
+            state = parse_qdisc_state(snapshot['qdiscs'][ifb], snapshot['classes'].get(ifb))
+            entry['ingress'] = dict({k: state[k] for k in STATE_SETTING_KEYS[:-1]}, multiqueue=state['queues'] > 1)
+        else:
+            entry['ingress'] = None
+        if snapshot['nat'] is not None:
+            entry['nat'] = dev in snapshot['nat']
+        entry['mtu'] = get_mtu(dev)
+        link = get_link_state(dev)
+        if link:
+            entry['up'] = link['admin_up']
+        interfaces[dev] = entry
+    return {'interfaces': interfaces}
+
+
+@app.route('/api/v1/state', methods=['GET'])
+def api_state():
+    """The host's current state document (see the section comment)."""
+    etag = state_etag('api-state')
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    return with_etag(jsonify(dict(current_state_document(), hostname=socket.gethostname())), etag)
+
+
+@app.route('/api/v1/state', methods=['PUT'])
+def api_put_state():
+    """
+    Reconcile the host to a state document. 200 with the plan and per-interface
+    outcome, 207 when some interfaces failed, 400 (nothing applied) when the
+    document does not validate. dry_run returns the plan only.
+    """
+    data = request.get_json(silent=True)
+    cfg = load_admin_config()
+    interfaces, errors = validate_state_document(data, cfg)
+    if errors:
+        return jsonify({'success': False, 'errors': errors}), 400
+    dry_run = request.args.get('dry_run', '').lower() in ('1', 'true', 'yes') or data.get('dry_run') is True
+    prune = data.get('prune') is True
+
+    start = time.monotonic()
+    if dry_run:
+        plans, batches = plan_host_state(interfaces, prune)
+        return jsonify(dict(describe_host_plan(plans, batches), success=True, dry_run=True,
+                            hostname=socket.gethostname(), seconds=round(time.monotonic() - start, 6)))
+
+    # Hold the interfaces' mutation queues from the snapshot to the last batch, so
+    # no single-interface change lands in between and invalidates the plan. The
+    # interfaces a prune touches are only known from a snapshot: plan once to find them.
+    names = set(plan_host_state(interfaces, prune)[0]) if prune else set(interfaces)
+    with serialized_mutation('reconcile', *names):
+        plans, batches = plan_host_state(interfaces, prune)
+        failed = apply_host_plan(plans, batches)
+    summary = describe_host_plan(plans, batches)
+    summary['interfaces'] = {name: dict(actions, ok=name not in failed, **({'error': failed[name]} if name in failed else {}))
+                             for name, actions in summary['interfaces'].items()}
+    return jsonify(dict(summary, success=not failed, dry_run=False, hostname=socket.gethostname(),
+                        seconds=round(time.monotonic() - start, 6))), (207 if failed else 200)
+
+
+# ---- Controller --------------------------------------------------------------
+
+@app.route('/fleet')
+def fleet():
+    cfg = load_admin_config()
+    agents = cfg.get('fleet_agents', [])
+    results = fan_out(agents, lambda agent: agent_request(agent, 'GET', '/api/v1/interfaces'))
+    return render_template('fleet.html', hostname=socket.gethostname(),
+                           agents=[dict(r, url=a['url']) for a, r in zip(agents, results)],
+                           profiles=cfg.get('fleet_profiles', {}),
+                           hide_admin_link=cfg.get('hide_admin_link', False))
+
+
+@app.route('/fleet/apply', methods=['POST'])
+def fleet_apply():
+    """
+    Fan an apply or remove out to the selected agent interfaces. Form posts
+    (targets = 'agent|interface', action = apply/remove) redirect back to /fleet;
+    JSON {"action", "items": [{agent, interface, ...}]} returns per-agent results.
+    """
+    data = request.get_json(silent=True) if request.is_json else None
+    if data is not None:
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Body must be a JSON object'}), 400
+        action = data.get('action', 'apply')
+        items = data.get('items') or []
+        error = fleet_items_error(items)
+        if error:
+            return jsonify({'error': error}), 400
+    else:
+        action = request.form.get('action', 'apply')
+        items = read_fleet_targets()
+    if action not in ('apply', 'remove'):
+        action = 'apply'
+    agents = load_admin_config().get('fleet_agents', [])
+
+    if not items:
+        if data is not None:
+            return jsonify({'error': 'No items'}), 400
+        flash("Select at least one agent interface", 'error')
+        return redirect(url_for('fleet'))
+
+    verb = 'applied to' if action == 'apply' else 'removed from'
+    job, created = submit_job(f'fleet_{action}', f"Fleet {action} ({len(items)} interfaces)",
+                              lambda job: fleet_dispatch_job(job, agents, items, action, verb),
+                              items=fleet_item_labels(items), key=job_key('fleet', action, items))
+    if wants_job_wait():
+        job = wait_for_job(job['id'])
+        results = job['result'] or []
+        ok = job['state'] == 'done' and all(r['ok'] for r in results)
+        return jsonify({'success': ok, 'results': results}), (200 if ok else 207)
+    return job_accepted(job, created, 'fleet')
+
+
+@app.route('/fleet/profiles/<name>/apply', methods=['POST'])
+def fleet_apply_profile(name):
+    """Apply a saved profile: its items go out to their agents in one fan-out."""
+    cfg = load_admin_config()
+    profile = cfg.get('fleet_profiles', {}).get(name)
+    if profile is None:
+        flash(f"Unknown profile '{name}'", 'error')
+        return redirect(url_for('fleet'))
+    agents, items = cfg.get('fleet_agents', []), profile['items']
+    job, created = submit_job('fleet_profile', f"Profile '{name}'",
+                              lambda job: fleet_dispatch_job(job, agents, items, 'apply', f"profile '{name}' applied to"),
+                              items=fleet_item_labels(items), key=job_key('fleet_profile', name, items))
+    if wants_job_wait():
+        job = wait_for_job(job['id'])
+        results = job['result'] or []
+        ok = job['state'] == 'done' and all(r['ok'] for r in results)
+        return jsonify({'success': ok, 'profile': name, 'results': results}), (200 if ok else 207)
+    return job_accepted(job, created, 'fleet')
+
+
+def fleet_item_labels(items):
+    """Job progress labels for fleet items: 'agent:interface'."""
+    return [f"{item.get('agent')}:{item.get('interface')}" for item in items]
+
+
+def fleet_dispatch_job(job, agents, items, action, verb):
+    """Job body of a fleet fan-out: each agent's answer marks its interfaces done."""
+    def on_result(r):
+        data = r['data'] if isinstance(r['data'], dict) else {}
+        answered = {item.get('interface'): item for item in data.get('results', [])}
+        for item in items:
+            if item.get('agent') != r['agent']:
+                continue
+            outcome = answered.get(item.get('interface'))
+            if outcome is not None:
+                job_progress(job, f"{r['agent']}:{item.get('interface')}", 'ok' if outcome.get('ok') else 'failed',
+                             list(outcome.get('messages') or []))
+            else:
+                job_progress(job, f"{r['agent']}:{item.get('interface')}", 'ok' if r['ok'] else 'failed',
+                             [] if r['ok'] else [r['error'] or 'no result'])
+
+    results = fleet_dispatch(agents, items, action, on_result)
+    flash_fleet_results(results, verb)
+    return results
+
+
+@app.route('/fleet/metrics')
+def fleet_metrics():
+    """Every agent's /metrics merged into one exposition with an agent label."""
+    agents = load_admin_config().get('fleet_agents', [])
+    results = fan_out(agents, lambda agent: agent_request(agent, 'GET', '/metrics'))
+    return merge_agent_metrics(results), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/fleet/agents', methods=['POST'])
+@_require_admin_auth
+def fleet_agents():
+    """Register (action=add, name, url) or unregister (action=remove, name) an agent."""
+    cfg = load_admin_config()
+    agents = cfg.get('fleet_agents', [])
+    name = request.form.get('name', '').strip()
+    if request.form.get('action') == 'remove':
+        cfg['fleet_agents'] = [a for a in agents if a['name'] != name]
+        message = f"Agent '{name}' removed"
+    else:
+        url = request.form.get('url', '').strip().rstrip('/')
+        if not FLEET_NAME_RE.match(name):
+            flash("Agent name may contain letters, digits, '.', '_' and '-' only", 'error')
+            return redirect(url_for('fleet'))
+        if urlsplit(url).scheme not in ('http', 'https') or not urlsplit(url).netloc:
+            flash("Agent URL must look like http://host:8080", 'error')
+            return redirect(url_for('fleet'))
+        cfg['fleet_agents'] = [a for a in agents if a['name'] != name] + [{'name': name, 'url': url}]
+        message = f"Agent '{name}' registered at {url}"
+    ok, err = save_admin_config(cfg)
+    flash(message if ok else f"Error saving settings: {err}", 'success' if ok else 'error')
+    return redirect(url_for('fleet'))
+
+
+@app.route('/fleet/profiles', methods=['POST'])
+@_require_admin_auth
+def fleet_profiles():
+    """Save the current /fleet selection and settings as a named profile, or delete one (action=delete)."""
+    cfg = load_admin_config()
+    profiles = cfg.get('fleet_profiles', {})
+    name = request.form.get('profile_name', '').strip()
+    if request.form.get('action') == 'delete':
+        profiles.pop(name, None)
+        message = f"Profile '{name}' deleted"
+    else:
+        items = read_fleet_targets()
+        if not FLEET_NAME_RE.match(name):
+            flash("Profile name may contain letters, digits, '.', '_' and '-' only", 'error')
+            return redirect(url_for('fleet'))
+        if not items:
+            flash("Select at least one agent interface for the profile", 'error')
+            return redirect(url_for('fleet'))
+        profiles[name] = {'items': items}
+        message = f"Profile '{name}' saved ({len(items)} interfaces)"
+    cfg['fleet_profiles'] = profiles
+    ok, err = save_admin_config(cfg)
+    flash(message if ok else f"Error saving settings: {err}", 'success' if ok else 'error')
+    return redirect(url_for('fleet'))
+
+
 def cleanup_on_exit():
     # First stop any active captures
     for capture_id, capture_info in active_captures.items():
         try:
+            if capture_info['engine'] == 'afpacket':
+                stop_engine_capture(capture_info['capture'], timeout=1)
+                continue
             process = capture_info['process']
             if process.poll() is None:  # Process is still running
                 logging.info(f"Stopping active capture on exit: {capture_info['display_name']}")
@@ -1959,11 +7799,37 @@ def cleanup_on_exit():
     except Exception as e:
         logging.error(f"Error removing pcap directory on exit: {str(e)}")
 
-atexit.register(cleanup_on_exit)
 
-if __name__ == '__main__':
+def start_background_work():
+    """
+    Start the web server's background threads. Only the server entrypoint calls
+    this, so importing app (tests, benches) leaves the host untouched.
+    """
+    # Rebuild recorded impairments, then remove IFB devices left behind by interfaces
+    # that disappeared while we were not running
+    threading.Thread(target=startup_restore, name='startup-restore', daemon=True).start()
+
+    if METRICS_INTERVAL > 0:
+        threading.Thread(target=metrics_sampler, name='metrics-sampler', daemon=True).start()
+
+    if NETLINK_MONITOR:
+        threading.Thread(target=netlink_monitor, name='netlink-monitor', daemon=True).start()
+
+
+# The privileged helper process only serves its socket: no web background work
+# and no exit cleanup of the web process's captures
+HELPER_MODE = __name__ == '__main__' and '--privileged-helper' in sys.argv
+
+if not HELPER_MODE:
+    atexit.register(cleanup_on_exit)
+
+if HELPER_MODE:
+    run_privileged_helper()
+elif __name__ == '__main__':
     from werkzeug.serving import make_server
 
+    start_background_work()
+
     # ---------------------------------------------------------------------------
     # Listener configuration
     #
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Side-by-side throughput / CPU comparison of HyyperWAN shaping modes on a veth pair.
+
+For every bandwidth cap and shaping mode the script applies the impairment with
+app.apply_qdisc() to the local veth end, pushes TCP traffic through it for
+--duration seconds and reports achieved rate, host CPU time and CPU per Gbit.
+Modes are htb (HTB + netem, or TBF with --latency 0), netem, cake and auto
+(whatever the admin high-rate settings pick for the cap).
+
+    sudo python3 bench/compare_shaping.py --latency 10ms --bandwidth 1gbit,5gbit,20gbit
+    sudo python3 bench/compare_shaping.py --latency 0 --bandwidth 10gbit,25gbit --modes htb,cake
+    sudo python3 bench/compare_shaping.py --modes htb,netem --json > shaping.json
+    sudo python3 bench/compare_shaping.py --txqueues 16 --multiqueue --bandwidth 10gbit
+
+Needs root, iproute2 and the sch_netem / sch_htb / sch_tbf / sch_cake kernel
+modules; a mode whose qdisc is missing is reported and skipped.
+"""
+import argparse
+import json
+import sys
+
+from netns_lab import VethLab, format_rate, import_app, tcp_throughput
+
+
+def apply(app, interface, args, bandwidth, mode):
+    """Apply one cap in one mode; returns (parsed qdisc state, error messages)."""
+    from flask import get_flashed_messages
+    with app.app.test_request_context():
+        app.remove_degradations(interface)
+        app.apply_qdisc(interface, args.latency, args.loss, args.jitter, bandwidth,
+                        shaping_mode=None if mode == 'auto' else mode, slot=args.slot, multiqueue=args.multiqueue)
+        errors = [m for category, m in get_flashed_messages(with_categories=True) if category == 'error']
+        return app.get_qdisc_state(interface), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', default='10ms')
+    parser.add_argument('--jitter', default=None)
+    parser.add_argument('--loss', default=None)
+    parser.add_argument('--slot', default=None, help='netem slot for netem mode, e.g. "800us 2ms"')
+    parser.add_argument('--bandwidth', default='1gbit,5gbit',
+                        help='comma-separated caps to test (default: 1gbit,5gbit)')
+    parser.add_argument('--modes', default='htb,netem,cake',
+                        help='comma-separated shaping modes: htb, netem, cake, auto')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per run')
+    parser.add_argument('--txqueues', type=int, default=1, help='veth TX queue count')
+    parser.add_argument('--multiqueue', action='store_true',
+                        help='install an mq root with per-queue children (use with --txqueues > 1)')
+    parser.add_argument('--json', action='store_true', help='emit JSON instead of a table')
+    args = parser.parse_args()
+
+    app = import_app()
+    results = []
+    with VethLab(txqueues=args.txqueues) as lab:
+        for bandwidth in [b.strip() for b in args.bandwidth.split(',') if b.strip()]:
+            for mode in [m.strip() for m in args.modes.split(',') if m.strip()]:
+                state, errors = apply(app, lab.local_if, args, bandwidth, mode)
+                if errors:
+                    print(f"{bandwidth} {mode}: skipped, {'; '.join(errors)}", file=sys.stderr)
+                    continue
+                run = tcp_throughput(lab, duration=args.duration)
+                gbits = run['bits_per_sec'] / 1e9
+                results.append({
+                    'bandwidth': bandwidth,
+                    'mode': mode,
+                    'installed_mode': state['shaping_mode'],
+                    'installed_rate': state['bandwidth'],
+                    'bits_per_sec': run['bits_per_sec'],
+                    'cpu_seconds': run['cpu_seconds'],
+                    'cpu_seconds_per_gbit': run['cpu_seconds'] / gbits if gbits else None,
+                })
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    print(f"{'cap':>8}  {'mode':<6} {'installed':<16} {'achieved':>14} {'cpu s':>8} {'cpu s/Gbit':>11}")
+    for r in results:
+        per_gbit = f"{r['cpu_seconds_per_gbit']:.2f}" if r['cpu_seconds_per_gbit'] is not None else '-'
+        installed = f"{r['installed_mode']}/{r['installed_rate']}"
+        print(f"{r['bandwidth']:>8}  {r['mode']:<6} {installed:<16} {format_rate(r['bits_per_sec']):>14} "
+              f"{r['cpu_seconds']:>8.2f} {per_gbit:>11}")
+
+
+if __name__ == '__main__':
+    main()
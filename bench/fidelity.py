@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Fidelity self-test: does what apply_qdisc() programs match what packets get?
+
+Builds a veth pair across network namespaces, then walks through a list of
+impairment configurations (plain latency/jitter/loss/bandwidth, both shaping
+modes and a filtered rule). Each configuration is applied on top of the
+previous one while a 1 ms UDP probe stream runs, which gives the apply time
+and the packets lost during the change. The script then measures:
+
+  * RTT distribution and loss with a UDP echo in the peer namespace
+    (added RTT vs configured latency, RTT stdev vs the uniform-jitter stdev
+    jitter/sqrt(3), loss % vs configured loss)
+  * TCP goodput vs configured bandwidth
+  * for filtered rules, the RTT of an unmatched control address (should be +0)
+
+    sudo python3 bench/fidelity.py
+    sudo python3 bench/fidelity.py --probes 5000 --json > fidelity.json
+    sudo python3 bench/fidelity.py --configs my_configs.json --max-error 0.1
+
+A --configs file is a JSON list of objects with name plus either latency,
+jitter, loss, bandwidth, shaping_mode, or rules (filter-rule text; "{peer}"
+and "{control}" are replaced with the lab addresses). Impairments are egress
+only, so expected RTT = unimpaired RTT + latency.
+
+Needs root, iproute2 and the sch_netem / sch_htb / sch_tbf / cls_flower modules.
+"""
+import argparse
+import json
+import math
+import re
+import statistics
+import sys
+import threading
+import time
+
+from netns_lab import UdpEcho, VethLab, import_app, tcp_throughput, udp_probe
+
+CONTROL_ADDR = '10.254.1.2'
+
+DEFAULT_CONFIGS = [
+    {'name': 'delay 20ms', 'latency': '20ms'},
+    {'name': 'delay 50ms jitter 10ms', 'latency': '50ms', 'jitter': '10ms'},
+    {'name': 'loss 5%', 'loss': '5%'},
+    {'name': 'bw 50mbit', 'bandwidth': '50mbit'},
+    {'name': 'delay 30ms + 100mbit (htb)', 'latency': '30ms', 'bandwidth': '100mbit', 'shaping_mode': 'htb'},
+    {'name': 'delay 30ms + 100mbit (netem)', 'latency': '30ms', 'bandwidth': '100mbit', 'shaping_mode': 'netem'},
+    {'name': 'filtered dst 40ms', 'rules': 'dst={peer}/32 delay=40ms'},
+]
+
+
+MS_PER_UNIT = {'us': 0.001, 'ms': 1.0, 's': 1000.0}
+
+
+def ms(value):
+    """'20ms' / '1.5s' / '500us' / None -> milliseconds; a bare number is ms, as app.py reads it."""
+    if not value:
+        return 0.0
+    m = re.match(r'^(\d+(?:\.\d+)?)(us|ms|s)?$', value.strip().lower())
+    if not m:
+        raise ValueError(f"unrecognised time '{value}' (use us, ms or s)")
+    return float(m.group(1)) * MS_PER_UNIT[m.group(2) or 'ms']
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    k = (len(ordered) - 1) * pct / 100
+    lo, hi = math.floor(k), math.ceil(k)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def rtt_summary(samples):
+    """Summarise udp_probe() output: loss % and RTT percentiles/stdev in ms."""
+    rtts = [rtt * 1000 for _, rtt in samples if rtt is not None]
+    return {
+        'sent': len(samples),
+        'received': len(rtts),
+        'loss_pct': 100.0 * (len(samples) - len(rtts)) / len(samples) if samples else 0.0,
+        'p50_ms': percentile(rtts, 50),
+        'p90_ms': percentile(rtts, 90),
+        'p99_ms': percentile(rtts, 99),
+        'stdev_ms': statistics.pstdev(rtts) if len(rtts) > 1 else 0.0,
+    }
+
+
+def apply_config(app, interface, cfg, lab):
+    """Apply one configuration through HyyperWAN; returns (seconds, error messages)."""
+    from flask import get_flashed_messages
+    start = time.monotonic()
+    with app.app.test_request_context():
+        if cfg.get('rules'):
+            rules, errors = app.parse_filter_rules(cfg['rules'].format(peer=lab.peer_addr, control=CONTROL_ADDR))
+            if errors:
+                return 0.0, errors
+            app.apply_qdisc_filtered_rules(interface, rules, cfg.get('bandwidth'))
+        else:
+            # Explicit zero values so nothing is inherited from the previous configuration
+            app.apply_qdisc(interface, cfg.get('latency') or '0ms', cfg.get('loss') or '0%',
+                            cfg.get('jitter') or '0ms', cfg.get('bandwidth') or '',
+                            shaping_mode=cfg.get('shaping_mode'))
+        messages = get_flashed_messages(with_categories=True)
+    return time.monotonic() - start, [m for category, m in messages if category == 'error']
+
+
+def measure_change(app, interface, cfg, lab, port, interval, lead=0.5, tail=0.5):
+    """
+    Probe every `interval` s while the configuration is applied `lead` s into the
+    stream. Returns apply time plus probes sent and lost inside the apply window.
+    """
+    holder = {}
+    count = int((lead + tail) / interval) + 1
+
+    def do_apply():
+        holder['start'] = time.monotonic()
+        holder['seconds'], holder['errors'] = apply_config(app, interface, cfg, lab)
+        holder['end'] = time.monotonic()
+
+    timer = threading.Timer(lead, do_apply)
+    timer.start()
+    samples = udp_probe(lab.peer_addr, port, count, interval,
+                        linger=2.0 + ms(cfg.get('latency')) / 1000 * 4)
+    timer.join()
+    window = [rtt for sent, rtt in samples if holder['start'] <= sent <= holder['end']]
+    return {
+        'apply_seconds': holder['seconds'],
+        'errors': holder['errors'],
+        'window_probes': len(window),
+        'window_lost': sum(1 for rtt in window if rtt is None),
+    }
+
+
+def metric(name, configured, achieved, unit):
+    error = None if achieved is None else achieved - configured
+    rel = (error / configured) if (error is not None and configured) else None
+    return {'metric': name, 'unit': unit, 'configured': configured, 'achieved': achieved,
+            'error': error, 'rel_error': rel}
+
+
+def evaluate(app, cfg, base, steady, control, throughput):
+    """Build the configured-vs-achieved metric rows for one configuration."""
+    rows = []
+    rules = cfg.get('rules')
+    latency = ms(cfg.get('latency'))
+    if rules:
+        # Filtered rules carry their own delay; take it from the rule text
+        latency = ms(next((t.split('=', 1)[1] for t in rules.split() if t.startswith('delay=')), None))
+    rows.append(metric('added RTT p50', latency,
+                       steady['p50_ms'] - base['p50_ms'] if steady['p50_ms'] is not None else None, 'ms'))
+    jitter = ms(cfg.get('jitter'))
+    rows.append(metric('RTT stdev', jitter / math.sqrt(3), steady['stdev_ms'], 'ms'))
+    loss = float((cfg.get('loss') or '0').rstrip('%'))
+    rows.append(metric('loss', loss, steady['loss_pct'], '%'))
+    if control is not None:
+        rows.append(metric('control added RTT p50', 0.0,
+                           control['p50_ms'] - base['p50_ms'] if control['p50_ms'] is not None else None, 'ms'))
+    if throughput is not None:
+        rows.append(metric('TCP goodput', app.rate_to_bits(cfg['bandwidth']) / 1e6,
+                           throughput['bits_per_sec'] / 1e6, 'Mbit/s'))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--configs', default=None, help='JSON file with a list of configurations')
+    parser.add_argument('--probes', type=int, default=1000, help='steady-state UDP probes per configuration')
+    parser.add_argument('--probe-interval', type=float, default=0.005, help='seconds between steady-state probes')
+    parser.add_argument('--change-interval', type=float, default=0.001,
+                        help='seconds between probes while a change is applied')
+    parser.add_argument('--duration', type=float, default=5.0, help='TCP throughput seconds (bandwidth configs)')
+    parser.add_argument('--port', type=int, default=5300)
+    parser.add_argument('--max-error', type=float, default=None,
+                        help='exit 1 if any relative error exceeds this fraction (e.g. 0.1)')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    configs = DEFAULT_CONFIGS
+    if args.configs:
+        with open(args.configs) as f:
+            configs = json.load(f)
+
+    app = import_app()
+    results = []
+    with VethLab() as lab, UdpEcho(lab, args.port):
+        lab.add_peer_address(CONTROL_ADDR)
+        with app.app.test_request_context():
+            app.remove_degradations(lab.local_if)
+        base = rtt_summary(udp_probe(lab.peer_addr, args.port, args.probes, args.probe_interval, linger=1.0))
+
+        for cfg in configs:
+            change = measure_change(app, lab.local_if, cfg, lab, args.port, args.change_interval)
+            entry = {'name': cfg['name'], 'config': cfg, 'change': change, 'rows': []}
+            results.append(entry)
+            if change['errors']:
+                continue
+            linger = 1.0 + ms(cfg.get('latency')) / 1000 * 4
+            steady = rtt_summary(udp_probe(lab.peer_addr, args.port, args.probes, args.probe_interval, linger=linger))
+            control = None
+            if cfg.get('rules'):
+                control = rtt_summary(udp_probe(CONTROL_ADDR, args.port, args.probes // 2,
+                                                args.probe_interval, linger=linger))
+            throughput = tcp_throughput(lab, duration=args.duration) if cfg.get('bandwidth') else None
+            entry.update({'steady': steady, 'control': control, 'throughput': throughput,
+                          'rows': evaluate(app, cfg, base, steady, control, throughput)})
+
+        with app.app.test_request_context():
+            app.remove_degradations(lab.local_if)
+
+    failures = []
+    if args.max_error is not None:
+        for entry in results:
+            if entry['change']['errors']:
+                failures.append(f"{entry['name']}: apply failed: {'; '.join(entry['change']['errors'])}")
+            failures += [f"{entry['name']}: {row['metric']} off by {row['rel_error']:.0%}"
+                         for row in entry['rows']
+                         if row['rel_error'] is not None and abs(row['rel_error']) > args.max_error]
+
+    if args.json:
+        json.dump({'baseline': base, 'results': results, 'failures': failures}, sys.stdout, indent=2)
+        print()
+    else:
+        print(f"unimpaired RTT p50 {base['p50_ms']:.3f} ms, p99 {base['p99_ms']:.3f} ms, loss {base['loss_pct']:.2f}%\n")
+        for entry in results:
+            change = entry['change']
+            print(f"== {entry['name']}: applied in {change['apply_seconds'] * 1000:.1f} ms, "
+                  f"{change['window_lost']}/{change['window_probes']} probes lost during the change")
+            for err in change['errors']:
+                print(f"   apply error: {err}")
+            for row in entry['rows']:
+                achieved = '-' if row['achieved'] is None else f"{row['achieved']:.2f}"
+                rel = '' if row['rel_error'] is None else f" ({row['rel_error']:+.1%})"
+                print(f"   {row['metric']:<24} configured {row['configured']:>9.2f} {row['unit']:<7} "
+                      f"achieved {achieved:>9} {row['unit']}{rel}")
+        for failure in failures:
+            print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
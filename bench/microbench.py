@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for HyyperWAN's collectors and parsers against synthetic
+large-host fixtures — no root, no real interfaces needed.
+
+The fixture directory holds fake ip/tc/iptables/sudo/nsenter shims (shell
+scripts that log every exec and replay canned output), a generated
+/proc/net/dev, an `ip -j addr` dump with --interfaces entries, --routes IPv4
+routes, a --filter-rules flower filter dump and a --pcap-size capture file
+(written sparse, so multi-GB pcaps are cheap to create).
+
+Each case reports median wall time per call, execs per call (counted by the
+shims) and peak Python heap per call (tracemalloc). Results are compared with
+bench/baselines.json and the run exits 1 when a case regresses past it.
+
+    python3 bench/microbench.py                      # run, compare with baselines
+    python3 bench/microbench.py --pcap-size 4G       # multi-GB pcap (baseline skipped: different params)
+    python3 bench/microbench.py --update-baselines   # record new baselines on this machine
+    python3 bench/microbench.py --only parse_routes_v4 --json
+"""
+import argparse
+import json
+import os
+import shutil
+import socketserver
+import statistics
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINES = os.path.join(BENCH_DIR, 'baselines.json')
+
+# One shim for every binary: log "<name> <args>" to $HW_SHIM_LOG, then replay
+# fixtures. sudo/nsenter re-exec their command so the wrapped exec is counted too.
+SHIM = r'''#!/bin/sh
+name=$(basename "$0")
+echo "$name $*" >> "$HW_SHIM_LOG"
+F="$HW_FIXTURES"
+case "$name" in
+  sudo) exec "$@" ;;
+  nsenter) shift 3; exec "$@" ;;
+  ip)
+    case "$*" in
+      "-j addr"*) exec cat "$F/ip-j-addr.json" ;;
+      "-j -6 route show"*) exec cat "$F/ip-6-route.json" ;;
+      "-j route show"*) exec cat "$F/ip-route.json" ;;
+    esac ;;
+  tc)
+    dev=""
+    prev=""
+    for arg in "$@"; do
+      [ "$prev" = "dev" ] && dev="$arg"
+      prev="$arg"
+    done
+    case "$*" in
+      "-batch -")
+        while read -r obj verb _ dev; do
+          [ "$obj $verb" = "class show" ] && cat "$F/tc-class.txt"
+          [ "$obj $verb" = "qdisc show" ] && cat "$F/tc-qdisc.txt"
+        done
+        exit 0 ;;
+      "-s qdisc show") exec cat "$F/tc-s-qdisc.txt" ;;
+      "qdisc show") [ -n "$HW_QDISC_ALL" ] && exec cat "$F/tc-qdisc-all.txt"; exec cat "$F/tc-qdisc.txt" ;;
+      "qdisc show"*) exec cat "$F/tc-qdisc.txt" ;;
+      "class show"*) exec cat "$F/tc-class.txt" ;;
+      "filter show"*) [ -f "$F/tc-filter.$dev.txt" ] && exec cat "$F/tc-filter.$dev.txt" ;;
+    esac ;;
+  iptables) exit 1 ;;
+esac
+exit 0
+'''
+SHIM_NAMES = ('ip', 'tc', 'iptables', 'ipset', 'sudo', 'nsenter')
+
+TC_QDISC = (
+    "qdisc htb 1: root refcnt 2 r2q 10 default 0x10 direct_packets_stat 0 direct_qlen 1000\n"
+    "qdisc netem 20: parent 1:10 limit 1938 delay 50ms  5ms loss 1%\n"
+)
+TC_CLASS = (
+    "class htb 1:10 root leaf 20: prio 0 rate 100Mbit ceil 100Mbit burst 50000b cburst 50000b \n"
+)
+# 'tcpdump -dd -y EN10MB host 10.0.0.1' and a matching Ethernet/IPv4/UDP frame, for the
+# userspace filter re-check of a capture sharing an AF_PACKET ring
+BPF_HOST = """{ 0x28, 0, 0, 0x0000000c },
+{ 0x15, 0, 4, 0x00000800 },
+{ 0x20, 0, 0, 0x0000001a },
+{ 0x15, 8, 0, 0x0a000001 },
+{ 0x20, 0, 0, 0x0000001e },
+{ 0x15, 6, 7, 0x0a000001 },
+{ 0x15, 1, 0, 0x00000806 },
+{ 0x15, 0, 5, 0x00008035 },
+{ 0x20, 0, 0, 0x0000001c },
+{ 0x15, 2, 0, 0x0a000001 },
+{ 0x20, 0, 0, 0x00000026 },
+{ 0x15, 0, 1, 0x0a000001 },
+{ 0x6, 0, 0, 0x00040000 },
+{ 0x6, 0, 0, 0x00000000 },
+"""
+BPF_FRAME = (bytes(12) + b'\x08\x00' + bytes.fromhex('4500002e00000000401100000a0000020a000001')
+             + bytes.fromhex('d4310035001a0000') + bytes(18))
+
+
+def parse_size(value):
+    """'256M' / '4G' / '1048576' -> bytes."""
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+    value = value.strip().lower().rstrip('b')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+# ---------------------------------------------------------------------------
+# Fixture generation
+# ---------------------------------------------------------------------------
+
+def write_shims(bin_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    for name in SHIM_NAMES:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(SHIM)
+        os.chmod(path, 0o755)
+
+
+def interface_names(count):
+    return [f"bench{i}" for i in range(count)]
+
+
+def write_ip_addr(path, names):
+    data = []
+    for i, name in enumerate(names):
+        data.append({
+            'ifindex': i + 2, 'ifname': name, 'flags': ['BROADCAST', 'MULTICAST', 'UP', 'LOWER_UP'],
+            'mtu': 1500, 'operstate': 'UP',
+            'addr_info': [
+                {'family': 'inet', 'local': f"10.{i // 256}.{i % 256}.1", 'prefixlen': 24},
+                {'family': 'inet6', 'local': f"fd00::{i:x}:1", 'prefixlen': 64},
+            ],
+        })
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def write_proc_net_dev(path, names):
+    with open(path, 'w') as f:
+        f.write("Inter-|   Receive                                                |  Transmit\n")
+        f.write(" face |bytes    packets errs drop fifo frame compressed multicast|"
+                "bytes    packets errs drop fifo colls carrier compressed\n")
+        for i, name in enumerate(names):
+            f.write(f"{name:>6}: {i * 1000003} {i * 811} 0 0 0 0 0 0 "
+                    f"{i * 2000003} {i * 977} 0 0 0 0 0 0\n")
+
+
+def write_routes(path_v4, path_v6, count, names):
+    """'ip -j route show' dumps, written one element at a time like iproute2 does."""
+    with open(path_v4, 'w') as f:
+        f.write('[')
+        f.write(json.dumps({'dst': 'default', 'gateway': '10.0.0.254', 'dev': names[0],
+                            'protocol': 'static', 'metric': 100, 'flags': []}))
+        for i in range(count):
+            f.write(',' + json.dumps({'dst': f"172.{16 + (i >> 16) % 16}.{(i >> 8) & 255}.{i & 255}",
+                                      'gateway': '10.0.0.254', 'dev': names[i % len(names)],
+                                      'protocol': 'static', 'metric': 100 + i % 50, 'flags': []}))
+        f.write(']\n')
+    with open(path_v6, 'w') as f:
+        f.write(json.dumps([{'dst': f"fd10:{i:x}::/64", 'gateway': 'fe80::1', 'dev': names[i % len(names)],
+                             'protocol': 'static', 'metric': 1024, 'flags': [], 'pref': 'medium'}
+                            for i in range(max(1, count // 100))]) + '\n')
+
+
+def write_tc_stats(path, names, stats=True):
+    """'tc -s qdisc show' (or without stats, 'tc qdisc show') for every interface: the TC_QDISC tree."""
+    with open(path, 'w') as f:
+        for i, name in enumerate(names):
+            for line in TC_QDISC.splitlines():
+                kind, handle, rest = line.split(' ', 3)[1:]
+                f.write(f"qdisc {kind} {handle} dev {name} {rest}\n")
+                if stats:
+                    f.write(f" Sent {i * 1000003} bytes {i * 811} pkt (dropped {i}, overlimits {i * 3} requeues 0)\n")
+                    f.write(" backlog 0b 0p requeues 0\n")
+
+
+def write_filter_dump(path, rules):
+    with open(path, 'w') as f:
+        for i in range(rules):
+            prio = 1 + i % 3
+            f.write(f"filter parent 1: protocol ip pref {prio} flower chain 0 \n")
+            f.write(f"filter parent 1: protocol ip pref {prio} flower chain 0 handle 0x{i + 1:x} "
+                    f"classid 1:{0x100 + i:x} \n")
+            f.write("  eth_type ipv4\n")
+            f.write(f"  dst_ip 10.{i // 256}.{i % 256}.0/24\n")
+            f.write("  not_in_hw\n")
+
+
+def write_pcap(path, size, snaplen=1514):
+    """Sparse pcap of roughly `size` bytes: valid record headers, zero-filled payload holes."""
+    record = 16 + snaplen
+    count = max(0, (size - 24) // record)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        header = struct.pack('<IIII', 0, 0, snaplen, snaplen)
+        for i in range(count):
+            f.write(header)
+            f.seek(snaplen, os.SEEK_CUR)
+        f.truncate()
+    return count
+
+
+def write_desired_state(path, names):
+    """Recorded impairments for every interface: alternating netem-only and HTB + netem trees."""
+    state = {}
+    for i, name in enumerate(names):
+        state[name] = {'egress': {'kind': 'simple', 'latency': '50ms', 'loss': '1%', 'jitter': '5ms',
+                                  'bandwidth': '100mbit' if i % 2 else None, 'shaping_mode': 'htb',
+                                  'slot': None, 'multiqueue': False}}
+    with open(path, 'w') as f:
+        json.dump(state, f)
+
+
+def build_fixtures(root, args):
+    names = interface_names(args.interfaces)
+    write_shims(os.path.join(root, 'bin'))
+    write_ip_addr(os.path.join(root, 'ip-j-addr.json'), names)
+    write_proc_net_dev(os.path.join(root, 'proc-net-dev'), names)
+    write_routes(os.path.join(root, 'ip-route.json'), os.path.join(root, 'ip-6-route.json'), args.routes, names)
+    write_filter_dump(os.path.join(root, f'tc-filter.{names[0]}.txt'), args.filter_rules)
+    write_tc_stats(os.path.join(root, 'tc-s-qdisc.txt'), names)
+    write_tc_stats(os.path.join(root, 'tc-qdisc-all.txt'), names, stats=False)
+    with open(os.path.join(root, 'tc-qdisc.txt'), 'w') as f:
+        f.write(TC_QDISC)
+    with open(os.path.join(root, 'tc-class.txt'), 'w') as f:
+        f.write(TC_CLASS)
+    with open(os.path.join(root, 'admin.json'), 'w') as f:
+        json.dump({'hidden_interfaces': []}, f)
+    write_desired_state(os.path.join(root, 'impairments.json'), names)
+    packets = write_pcap(os.path.join(root, 'capture.pcap'), parse_size(args.pcap_size))
+    return names, packets
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+def count_execs(log_path):
+    try:
+        with open(log_path) as f:
+            return sum(1 for _ in f)
+    except FileNotFoundError:
+        return 0
+
+
+def measure(fn, repeat, log_path):
+    """Return (median seconds, execs per call, peak heap bytes per call, last result)."""
+    result = fn()  # warm-up (imports, caches)
+    execs_before = count_execs(log_path)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    execs = (count_execs(log_path) - execs_before) / repeat
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(times), execs, peak, result
+
+
+def build_cases(app, names, fixtures, packets, args):
+    """name -> (callable, repeat, sanity check on the result)."""
+    first, last = names[0], names[-1]
+    pcap = os.path.join(fixtures, 'capture.pcap')
+    many = max(1, args.repeat)
+    few = max(1, args.repeat // 5)
+
+    def list_interfaces(with_state=True):
+        with app.app.test_request_context():
+            return app.list_interfaces(with_state)
+
+    def plan_host_state():
+        # A state document every interface already matches: all no-ops, no batch lines
+        entry, _ = app.validate_state_settings({'latency': '50ms', 'jitter': '5ms', 'loss': '1%',
+                                                'bandwidth': '100mbit', 'shaping_mode': 'htb',
+                                                'multiqueue': False}, 'egress', {})
+        os.environ['HW_QDISC_ALL'] = '1'  # host-wide 'tc qdisc show' lists every interface's tree
+        try:
+            with app.app.test_request_context():
+                return app.plan_host_state({name: {'egress': entry} for name in names})
+        finally:
+            del os.environ['HW_QDISC_ALL']
+
+    bpf_host = app.parse_bpf_dump(BPF_HOST)
+
+    # In-process privileged helper: the same command with and without sudo's exec
+    helper_socket = os.path.join(fixtures, 'helper.sock')
+    helper = socketserver.ThreadingUnixStreamServer(helper_socket, app.HelperRequestHandler)
+    helper.daemon_threads = True
+    threading.Thread(target=helper.serve_forever, name='bench-helper', daemon=True).start()
+
+    def privileged_command(socket_path):
+        app.HELPER_SOCKET = socket_path
+        try:
+            return app.run_cmd(['sudo', 'tc', 'qdisc', 'show', 'dev', first])
+        finally:
+            app.HELPER_SOCKET = ''
+
+    return {
+        'list_interfaces': (list_interfaces, few, lambda r: len(r) == len(names)),
+        'list_interfaces_shell': (lambda: list_interfaces(False), many, lambda r: len(r) == len(names)),
+        'get_qdisc_settings': (lambda: app.get_qdisc_settings(first), many,
+                               lambda r: r == ('50ms', '1%', '5ms', '100Mbit')),
+        'get_qdisc_filter': (lambda: app.get_qdisc_filter(first), many,
+                             lambda r: r == (None, '10.0.0.0/24') or args.filter_rules == 0),
+        'parse_routes_v4': (lambda: app.parse_routes(4), few, lambda r: len(r) == args.routes + 1),
+        'parse_routes_v6': (lambda: app.parse_routes(6), many, lambda r: len(r) == max(1, args.routes // 100)),
+        'query_routes_page': (lambda: app.query_routes(4, prefix='172.16.0.0/16', offset=200, limit=100), few,
+                              lambda r: len(r[0]) == 100 and r[1] == min(args.routes, 65536)),
+        'count_pcap_packets': (lambda: app.count_pcap_packets(pcap), 1, lambda r: r == packets),
+        'bpf_match_1k': (lambda: sum(app.bpf_match(bpf_host, BPF_FRAME, len(BPF_FRAME)) for _ in range(1000)),
+                         many, lambda r: r == 1000),
+        'read_proc_net_dev': (lambda: app.read_proc_net_dev(last), many, lambda r: r is not None),
+        'sample_host': (app.sample_host, few,
+                        lambda r: r['interfaces'][first]['egress']['bandwidth'] == '100Mbit'),
+        'render_metrics': (app.render_metrics, many, lambda r: f'interface="{last}"' in r),
+        'restore_desired_state': (lambda: app.restore_desired_state(existing=names), few,
+                                  lambda r: len(r['restored']) == len(names) and not r['failed']),
+        'plan_host_state': (plan_host_state, few,
+                            lambda r: all(p['actions']['egress'] == 'noop' for p in r[0].values())
+                            and not any(r[1].values())),
+        'sudo_command': (lambda: privileged_command(''), many, lambda r: r.returncode == 0),
+        'helper_command': (lambda: privileged_command(helper_socket), many,
+                           lambda r: r.returncode == 0 and 'netem' in r.stdout),
+    }
+
+
+def compare(results, baselines, params, time_tol, mem_tol):
+    """Return a list of regression messages (empty if all within baseline)."""
+    if baselines.get('params') != params:
+        print(f"note: fixture parameters differ from baselines {baselines.get('params')}; "
+              f"comparison skipped", file=sys.stderr)
+        return []
+    failures = []
+    for name, r in results.items():
+        base = baselines.get('cases', {}).get(name)
+        if not base:
+            continue
+        if r['execs'] > base['execs']:
+            failures.append(f"{name}: {r['execs']:g} execs/call > baseline {base['execs']:g}")
+        # Wall time is noisy on shared hosts: allow the fraction plus 2 ms of absolute slack
+        if r['seconds'] > base['seconds'] * (1 + time_tol) + 0.002:
+            failures.append(f"{name}: {r['seconds'] * 1e3:.2f} ms > baseline "
+                            f"{base['seconds'] * 1e3:.2f} ms (+{time_tol:.0%} allowed)")
+        if r['peak_bytes'] > base['peak_bytes'] * (1 + mem_tol) + 64 * 1024:
+            failures.append(f"{name}: peak {r['peak_bytes'] / 1e6:.2f} MB > baseline "
+                            f"{base['peak_bytes'] / 1e6:.2f} MB (+{mem_tol:.0%} allowed)")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--interfaces', type=int, default=500)
+    parser.add_argument('--routes', type=int, default=100_000)
+    parser.add_argument('--filter-rules', type=int, default=200)
+    parser.add_argument('--pcap-size', default='256M', help='capture fixture size, e.g. 256M or 4G')
+    parser.add_argument('--repeat', type=int, default=10, help='calls per fast case (slow cases use repeat/5)')
+    parser.add_argument('--only', default=None, help='comma-separated case names')
+    parser.add_argument('--fixtures', default=None, help='keep fixtures in this directory instead of a temp dir')
+    parser.add_argument('--baselines', default=DEFAULT_BASELINES)
+    parser.add_argument('--update-baselines', action='store_true')
+    parser.add_argument('--time-tolerance', type=float, default=1.0,
+                        help='allowed slowdown fraction (default 1.0, i.e. 2x); exec counts must not grow at all')
+    parser.add_argument('--mem-tolerance', type=float, default=0.25, help='allowed peak-heap growth fraction')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    fixtures = args.fixtures or tempfile.mkdtemp(prefix='hwbench-')
+    os.makedirs(fixtures, exist_ok=True)
+    names, packets = build_fixtures(fixtures, args)
+    log_path = os.path.join(fixtures, 'exec.log')
+    os.environ.update({
+        'PATH': os.path.join(fixtures, 'bin') + os.pathsep + os.environ.get('PATH', ''),
+        'HW_SHIM_LOG': log_path,
+        'HW_FIXTURES': fixtures,
+        'ADMIN_CONFIG_PATH': os.path.join(fixtures, 'admin.json'),
+    })
+    os.chdir(fixtures)  # app.log is written to the cwd
+
+    sys.path.insert(0, BENCH_DIR)
+    from netns_lab import import_app
+    app = import_app()
+    app.PROC_NET_DEV = os.path.join(fixtures, 'proc-net-dev')
+
+    cases = build_cases(app, names, fixtures, packets, args)
+    if args.only:
+        wanted = {c.strip() for c in args.only.split(',')}
+        cases = {k: v for k, v in cases.items() if k in wanted}
+
+    results = {}
+    for name, (fn, repeat, check) in cases.items():
+        seconds, execs, peak, result = measure(fn, repeat, log_path)
+        results[name] = {'seconds': seconds, 'execs': execs, 'peak_bytes': peak, 'ok': bool(check(result))}
+
+    params = {'interfaces': args.interfaces, 'routes': args.routes,
+              'filter_rules': args.filter_rules, 'pcap_size': args.pcap_size}
+    failures = [f"{name}: unexpected result" for name, r in results.items() if not r['ok']]
+
+    if args.update_baselines:
+        with open(args.baselines, 'w') as f:
+            json.dump({'params': params,
+                       'cases': {k: {'seconds': round(v['seconds'], 6), 'execs': v['execs'],
+                                     'peak_bytes': v['peak_bytes']}
+                                 for k, v in results.items()}}, f, indent=2)
+            f.write('\n')
+    elif os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            failures += compare(results, json.load(f), params, args.time_tolerance, args.mem_tolerance)
+
+    if args.json:
+        json.dump({'params': params, 'cases': results, 'failures': failures}, sys.stdout, indent=2)
+        print()
+    else:
+        print(f"{'case':<20} {'ms/call':>10} {'execs/call':>11} {'peak MB':>9}  ok")
+        for name, r in results.items():
+            print(f"{name:<20} {r['seconds'] * 1e3:>10.2f} {r['execs']:>11g} "
+                  f"{r['peak_bytes'] / 1e6:>9.2f}  {'yes' if r['ok'] else 'NO'}")
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+
+    if not args.fixtures:
+        shutil.rmtree(fixtures, ignore_errors=True)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""
+Throw-away veth / network-namespace labs for HyyperWAN benchmarks.
+
+A lab is one veth pair: the local end stays in the current namespace (so
+HyyperWAN's helpers can impair it exactly as they would a real interface) and
+the peer end lives in a private namespace that runs the traffic sinks.
+
+Requires root (or passwordless sudo) and iproute2.
+"""
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Tiny TCP sink run inside the peer namespace: accepts one connection, discards
+# everything and prints "<bytes> <seconds>" when the sender closes.
+TCP_SINK = r'''
+import socket, sys, time
+srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+srv.bind((sys.argv[1], int(sys.argv[2])))
+srv.listen(1)
+print("ready", flush=True)
+conn, _ = srv.accept()
+total, start, buf = 0, None, bytearray(1 << 20)
+while True:
+    n = conn.recv_into(buf)
+    if not n:
+        break
+    if start is None:
+        start = time.monotonic()
+    total += n
+print(total, time.monotonic() - (start or time.monotonic()), flush=True)
+'''
+
+# UDP echo server run inside the peer namespace: reflects every datagram.
+UDP_ECHO = r'''
+import socket, sys
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+sock.bind(("0.0.0.0", int(sys.argv[1])))
+print("ready", flush=True)
+while True:
+    data, addr = sock.recvfrom(2048)
+    sock.sendto(data, addr)
+'''
+
+
+def import_app():
+    """
+    Import app.py from the repository root and return the module. Unless the
+    caller already chose an admin config, it and the recorded impairments go to
+    a temporary directory, so lab interfaces are never written into the host's
+    impairments.json.
+    """
+    if 'ADMIN_CONFIG_PATH' not in os.environ:
+        state_dir = tempfile.mkdtemp(prefix='hwlab-state-')
+        os.environ['ADMIN_CONFIG_PATH'] = os.path.join(state_dir, 'admin.json')
+        os.environ.setdefault('IMPAIRMENT_STATE_PATH', os.path.join(state_dir, 'impairments.json'))
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
+    import app
+    return app
+
+
+def run(cmd, check=True):
+    """Run a command, returning CompletedProcess; raise with stderr on failure."""
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if check and result.returncode != 0:
+        raise RuntimeError(f"{' '.join(cmd)} failed: {result.stderr.strip()}")
+    return result
+
+
+class VethLab:
+    """Context manager creating <name>0 (local) <-> <name>1 (in netns <name>-ns)."""
+
+    def __init__(self, name='hwlab', local_addr='10.254.0.1', peer_addr='10.254.0.2',
+                 prefix=30, txqueues=1):
+        self.netns = f'{name}-ns'
+        self.local_if = f'{name}0'
+        self.peer_if = f'{name}1'
+        self.local_addr = local_addr
+        self.peer_addr = peer_addr
+        self.prefix = prefix
+        self.txqueues = txqueues
+
+    def __enter__(self):
+        self.teardown()
+        run(['ip', 'netns', 'add', self.netns])
+        run(['ip', 'link', 'add', self.local_if,
+             'numtxqueues', str(self.txqueues), 'numrxqueues', str(self.txqueues),
+             'type', 'veth', 'peer', 'name', self.peer_if,
+             'numtxqueues', str(self.txqueues), 'numrxqueues', str(self.txqueues),
+             'netns', self.netns])
+        run(['ip', 'addr', 'add', f'{self.local_addr}/{self.prefix}', 'dev', self.local_if])
+        run(['ip', 'link', 'set', self.local_if, 'up'])
+        self.in_netns(['ip', 'addr', 'add', f'{self.peer_addr}/{self.prefix}', 'dev', self.peer_if])
+        self.in_netns(['ip', 'link', 'set', self.peer_if, 'up'])
+        self.in_netns(['ip', 'link', 'set', 'lo', 'up'])
+        return self
+
+    def __exit__(self, *exc):
+        self.teardown()
+        return False
+
+    def teardown(self):
+        run(['ip', 'link', 'del', self.local_if], check=False)
+        run(['ip', 'netns', 'del', self.netns], check=False)
+
+    def add_peer_address(self, address):
+        """Give the peer an extra /32 (routed via the peer) to act as a second destination."""
+        self.in_netns(['ip', 'addr', 'add', f'{address}/32', 'dev', self.peer_if])
+        run(['ip', 'route', 'replace', f'{address}/32', 'via', self.peer_addr, 'dev', self.local_if])
+
+    def in_netns(self, cmd, check=True):
+        return run(['ip', 'netns', 'exec', self.netns] + cmd, check=check)
+
+    def spawn_in_netns(self, cmd):
+        return subprocess.Popen(['ip', 'netns', 'exec', self.netns] + cmd,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+def read_cpu_busy():
+    """Return busy CPU seconds (all CPUs, everything except idle/iowait) from /proc/stat."""
+    with open('/proc/stat') as f:
+        fields = [int(v) for v in f.readline().split()[1:]]
+    ticks = os.sysconf('SC_CLK_TCK')
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    return (sum(fields[:8]) - idle) / ticks
+
+
+def tcp_throughput(lab, duration=10.0, port=5201, chunk=256 * 1024):
+    """
+    Push TCP data from the local end to a sink in the peer namespace for
+    `duration` seconds. Returns dict with bits_per_sec and cpu_seconds
+    (host-wide busy CPU time consumed while the transfer ran).
+    """
+    sink = lab.spawn_in_netns([sys.executable, '-c', TCP_SINK, lab.peer_addr, str(port)])
+    try:
+        if sink.stdout.readline().strip() != 'ready':
+            raise RuntimeError(f"TCP sink failed to start: {sink.stderr.read().strip()}")
+        payload = b'\0' * chunk
+        cpu_start = read_cpu_busy()
+        with socket.create_connection((lab.peer_addr, port), timeout=5) as conn:
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                conn.sendall(payload)
+        out, _ = sink.communicate(timeout=duration + 30)
+        cpu_used = read_cpu_busy() - cpu_start
+        total, elapsed = out.split()[-2:]
+        elapsed = float(elapsed) or duration
+        return {'bits_per_sec': int(total) * 8 / elapsed, 'cpu_seconds': cpu_used,
+                'seconds': elapsed}
+    finally:
+        if sink.poll() is None:
+            sink.kill()
+
+
+class UdpEcho:
+    """Context manager running UDP_ECHO in the lab's peer namespace."""
+
+    def __init__(self, lab, port=5300):
+        self.lab = lab
+        self.port = port
+        self.proc = None
+
+    def __enter__(self):
+        self.proc = self.lab.spawn_in_netns([sys.executable, '-c', UDP_ECHO, str(self.port)])
+        if self.proc.stdout.readline().strip() != 'ready':
+            raise RuntimeError(f"UDP echo failed to start: {self.proc.stderr.read().strip()}")
+        return self
+
+    def __exit__(self, *exc):
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        return False
+
+
+def udp_probe(dst, port, count, interval, linger=2.0, payload=64):
+    """
+    Send `count` sequenced UDP probes to dst:port every `interval` seconds and
+    collect the echoes. Returns a list of (send_time, rtt_seconds or None) in
+    send order; send_time is time.monotonic(). Probes still missing `linger`
+    seconds after the last send count as lost.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+    sock.settimeout(0.1)
+    sent = [0.0] * count
+    received = {}
+    stop = threading.Event()
+
+    def receive():
+        while not stop.is_set():
+            try:
+                data = sock.recv(2048)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            now = time.monotonic()
+            seq = struct.unpack_from('!I', data)[0]
+            if seq < count and seq not in received:
+                received[seq] = now
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+    padding = b'\0' * max(0, payload - 4)
+    start = time.monotonic()
+    for seq in range(count):
+        # Deadline-based pacing so a slow send does not stretch the whole run
+        delay = start + seq * interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        sent[seq] = time.monotonic()
+        try:
+            sock.sendto(struct.pack('!I', seq) + padding, (dst, port))
+        except OSError:
+            pass  # e.g. ENOBUFS while the qdisc is being replaced: counts as lost
+    time.sleep(linger)
+    stop.set()
+    receiver.join()
+    sock.close()
+    return [(sent[seq], received[seq] - sent[seq] if seq in received else None) for seq in range(count)]
+
+
+def format_rate(bits_per_sec):
+    """Human readable bit rate."""
+    for unit, div in (('Gbit/s', 1e9), ('Mbit/s', 1e6), ('Kbit/s', 1e3)):
+        if bits_per_sec >= div:
+            return f"{bits_per_sec / div:.2f} {unit}"
+    return f"{bits_per_sec:.0f} bit/s"
@@ -0,0 +1,33 @@
+"""
+Import app.py once for the whole suite (the import starts no background work)
+with every file it writes (app.log, admin config, recorded impairments,
+aliases) kept in a temporary directory. Nothing here needs root: tests that
+would run commands stub run_cmd.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_tmp = tempfile.mkdtemp(prefix='hyyperwan-tests-')
+
+os.environ['ADMIN_CONFIG_PATH'] = os.path.join(_tmp, 'admin.json')
+os.chdir(_tmp)  # app.log is opened relative to the working directory
+sys.path.insert(0, ROOT)
+
+import app as hyyperwan  # noqa: E402
+
+hyyperwan.ALIASES_FILE = os.path.join(_tmp, 'interface_aliases.json')
+
+
+@pytest.fixture
+def app_module():
+    return hyyperwan
+
+
+@pytest.fixture
+def client():
+    hyyperwan.app.config['TESTING'] = True
+    return hyyperwan.app.test_client()
@@ -0,0 +1,55 @@
+"""Malformed JSON bodies are answered with 400 and a message, never a 500."""
+import pytest
+
+
+@pytest.fixture
+def no_commands(app_module, monkeypatch):
+    """Fail the test if a request gets far enough to run a command."""
+    monkeypatch.setattr(app_module, 'run_cmd', lambda *a, **k: pytest.fail(f'command run: {a}'))
+
+
+@pytest.mark.parametrize('body, message', [
+    ([1, 2], 'JSON object'),
+    ({'rules': [1]}, 'Rule 1: must be an object'),
+    ({'rules': {'dst': '10.0.0.0/8'}}, 'rules must be a list'),
+    ({'rules': [{'dst': '10.0.0.0/8', 'delay': '50ms'}], 'bandwidth': 5}, 'bandwidth must be a string'),
+])
+def test_filter_rules_rejects_malformed_json(client, no_commands, body, message):
+    response = client.post('/interface/eth0/filter_rules', json=body)
+    assert response.status_code == 400
+    assert any(message in error for error in response.get_json()['errors'])
+
+
+@pytest.mark.parametrize('path, body', [
+    ('/interfaces/bulk', [1]),
+    ('/interfaces/bulk', {'addresses': 'eth0 10.0.0.1/24'}),
+    ('/routes/bulk', [1]),
+    ('/routes/bulk', {'routes': {'destination': '10.0.0.0/8'}}),
+])
+def test_bulk_rejects_malformed_body(client, no_commands, path, body):
+    response = client.post(path, json=body)
+    assert response.status_code == 400
+    assert response.get_json()['error']
+
+
+def test_bulk_routes_reports_bad_items_per_item(client, no_commands):
+    body = {'routes': [{'destination': '10.0.0.0/8', 'interface': 'eth0', 'ip_version': 'x'}, 5]}
+    response = client.post('/routes/bulk?wait=1', json=body)
+    assert response.status_code == 207
+    results = response.get_json()['results']
+    assert [r['status'] for r in results] == ['invalid', 'invalid']
+    assert 'ip_version' in results[0]['error']
+    assert 'must be an object' in results[1]['error']
+
+
+@pytest.mark.parametrize('body, message', [
+    ([1], 'JSON object'),
+    ({'items': {'agent': 'a', 'interface': 'eth0'}}, 'must be a list'),
+    ({'items': [1]}, 'Item 1: must be an object'),
+    ({'items': [{'agent': 'a', 'interface': 'eth0'}, {'agent': 5, 'interface': 'eth0'}]}, "Item 2: 'agent'"),
+    ({'items': [{'agent': 'a'}]}, "Item 1: 'interface'"),
+])
+def test_fleet_apply_rejects_malformed_json(client, body, message):
+    response = client.post('/fleet/apply', json=body)
+    assert response.status_code == 400
+    assert message in response.get_json()['error']
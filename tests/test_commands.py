@@ -0,0 +1,16 @@
+"""stream_cmd must never hang on its child: a full stderr pipe or a stuck command."""
+import sys
+import time
+
+
+def test_stream_survives_a_full_stderr_pipe(app_module):
+    script = "import sys; sys.stderr.write('e' * (1 << 20)); sys.stderr.flush(); print('done')"
+    assert ''.join(app_module.stream_cmd([sys.executable, '-c', script])) == 'done\n'
+
+
+def test_stream_is_killed_after_stream_timeout(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'STREAM_TIMEOUT', 0.2)
+    start = time.monotonic()
+    assert ''.join(app_module.stream_cmd(['sleep', '30'])) == ''
+    assert time.monotonic() - start < 5
+    assert app_module._cmd_stats['sleep 30']['timeouts'] >= 1
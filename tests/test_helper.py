@@ -0,0 +1,58 @@
+"""Allowlist of the privileged helper: nothing that could run a program as root gets through."""
+import pytest
+
+
+@pytest.mark.parametrize('argv', [
+    ['ip', '--batch', '/tmp/x'],
+    ['ip', '-bat', '/tmp/x'],
+    ['ip', '-b', '/tmp/x'],
+    ['ip', '-batch'],
+    ['ip', 'netns', 'exe', 'ns1', '/bin/sh'],
+    ['ip', 'netns', 'exec', 'ns1', '/bin/sh'],
+    ['ip', 'netns', 'exec', 'ns1', 'ip', 'netns', 'e', 'ns2', '/bin/sh'],
+    ['tc', 'ex', 'bpf'],
+    ['tc', 'exec', 'bpf', 'run', '/bin/sh'],
+    ['iptables', '-M', '/tmp/x', '-L'],
+    ['iptables', '-nvM/tmp/x', '-L'],
+    ['iptables', '--modp=/tmp/x', '-L'],
+    ['iptables', '--mod', '/tmp/x', '-L'],
+    ['ip6tables', '--modprobe=/tmp/x', '-L'],
+    ['iptables-restore', '-M', '/tmp/x'],
+    ['iptables-restore', '--modpr=/tmp/x'],
+    ['iptables-restore', '/tmp/rules'],
+    ['nsenter', '--target', '1', '--net', 'ip', '-ba', '/tmp/x'],
+    ['sh', '-c', 'id'],
+])
+def test_refuses_program_execution(app_module, argv):
+    assert app_module.validate_helper_argv(argv) is not None
+
+
+@pytest.mark.parametrize('argv, stdin', [
+    (['ip', '-force', '-batch', '-'], 'netns exe ns1 /bin/sh\n'),
+    (['ip', '-force', '-batch', '-'], 'link set dev eth0 up\nnetns exec ns1 /bin/sh\n'),
+    (['tc', '-force', '-batch', '-'], 'ex bpf\n'),
+    (['ip', '-force', '-batch', '-'], '-batch /tmp/x\n'),
+    (['iptables-restore', '--noflush'], '*nat\n-A POSTROUTING -o eth0 -j MASQUERADE -M /tmp/x\nCOMMIT\n'),
+    (['iptables-restore', '--noflush'], '*nat\n-A POSTROUTING --modprobe=/tmp/x\nCOMMIT\n'),
+])
+def test_refuses_program_execution_on_stdin(app_module, argv, stdin):
+    assert app_module.validate_helper_argv(argv, stdin) is not None
+
+
+@pytest.mark.parametrize('argv, stdin', [
+    (['tc', '-force', '-batch', '-'], 'qdisc replace dev eth0 root handle 1: netem delay 50ms\n'),
+    (['ip', '-force', '-batch', '-'], 'route add 10.0.0.0/24 via 192.0.2.1 dev eth0\n'),
+    (['ip', '-j', '-d', 'link', 'show', 'dev', 'eth0'], None),
+    (['tc', '-s', 'qdisc', 'show', 'dev', 'eth0'], None),
+    (['ip', 'netns', 'exec', 'ns1', 'iptables', '-t', 'nat', '-S', 'POSTROUTING'], None),
+    (['iptables-restore', '--noflush'], '*nat\n-A POSTROUTING -o eth0 -j MASQUERADE\nCOMMIT\n'),
+    (['nsenter', '--target', '1', '--net', 'ipset', 'restore'], 'create m hash:net\n'),
+])
+def test_allows_the_commands_hyyperwan_runs(app_module, argv, stdin):
+    assert app_module.validate_helper_argv(argv, stdin) is None
+
+
+def test_refused_request_is_not_run(app_module, monkeypatch):
+    monkeypatch.setattr(app_module.subprocess, 'run', lambda *a, **k: pytest.fail('refused argv was run'))
+    reply = app_module.handle_helper_request({'op': 'run', 'argv': ['ip', '--batch', '/tmp/x']})
+    assert reply['returncode'] == 126
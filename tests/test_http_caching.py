@@ -0,0 +1,31 @@
+"""State views answer a matching If-None-Match with 304 before gathering any state."""
+import pytest
+
+
+@pytest.fixture
+def monitored(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'list_netns', lambda: [])
+    app_module._monitor_active.set()
+    yield
+    app_module._monitor_active.clear()
+
+
+@pytest.mark.parametrize('path', ['/api/v1/state', '/routes/data?dev=eth0', '/routes'])
+def test_unchanged_state_is_not_gathered_again(app_module, client, monitored, monkeypatch, path):
+    etag = client.get(path).headers['ETag']
+
+    def no_commands(*args, **kwargs):
+        raise AssertionError('state was gathered for a 304')
+
+    monkeypatch.setattr(app_module, 'run_cmd', no_commands)
+    monkeypatch.setattr(app_module, 'stream_cmd', no_commands)
+    response = client.get(path, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def test_state_change_and_arguments_change_the_etag(app_module, client, monitored):
+    etag = client.get('/routes/data?dev=eth0').headers['ETag']
+    assert client.get('/routes/data?dev=eth1').headers['ETag'] != etag
+    app_module.bump_state_generation()
+    response = client.get('/routes/data?dev=eth0', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
@@ -0,0 +1,32 @@
+"""Commands for a named namespace must run inside it, never against the host."""
+import subprocess
+
+NETFILTER = ('iptables', 'ip6tables', 'iptables-restore', 'ip6tables-restore', 'ipset')
+
+
+def test_netfilter_commands_enter_the_namespace(app_module):
+    for tool in NETFILTER:
+        cmd = app_module.netns_command(['sudo', tool, '--noflush'], 'ns1')
+        assert cmd[:5] == ['sudo', 'ip', 'netns', 'exec', 'ns1'], cmd
+    assert app_module.netns_command(app_module.nat_restore_command(), 'ns1')[1:5] == ['ip', 'netns', 'exec', 'ns1']
+
+
+def test_netns_reconcile_never_touches_host_iptables(app_module, monkeypatch):
+    calls = []
+
+    def fake_run(cmd, **kwargs):
+        calls.append(list(cmd))
+        return subprocess.CompletedProcess(cmd, 0, '', '')
+
+    monkeypatch.setattr(app_module.subprocess, 'run', fake_run)
+    monkeypatch.setattr(app_module, 'is_iptables_available', lambda: True)
+    with app_module.in_netns('ns1'):
+        plans, batches = app_module.plan_host_state({'veth0': {'nat': True}})
+        assert batches['nat'] == [('veth0', '-A POSTROUTING -o veth0 -j MASQUERADE')]
+        assert app_module.apply_host_plan(plans, batches) == {}
+
+    netfilter = [cmd for cmd in calls if any(arg in NETFILTER for arg in cmd)]
+    assert any('iptables-restore' in cmd for cmd in netfilter)
+    for cmd in netfilter:
+        tool = next(i for i, arg in enumerate(cmd) if arg in NETFILTER)
+        assert cmd[tool - 4:tool] == ['ip', 'netns', 'exec', 'ns1'], cmd
@@ -0,0 +1,34 @@
+"""The bandwidth cap must shape the interface as a whole, never per flow."""
+import pytest
+
+
+@pytest.mark.parametrize('queues', [1, 4])
+@pytest.mark.parametrize('latency', ['', '20ms'])
+def test_cake_caps_the_aggregate(app_module, queues, latency):
+    commands = app_module.build_qdisc_commands('eth0', latency, '', '', '10gbit', shaping_mode='cake',
+                                               queues=queues, sizing=app_module.queue_sizing())
+    shapers = [cmd for cmd in commands if 'cake' in cmd]
+    assert len(shapers) == queues
+    assert sum(app_module.rate_to_bits(cmd[cmd.index('bandwidth') + 1]) for cmd in shapers) == 10_000_000_000
+    assert not any('fq' in cmd or 'maxrate' in cmd for cmd in commands)
+
+
+def test_fq_is_not_a_shaping_mode(app_module):
+    assert 'fq' not in app_module.SHAPING_MODES
+    assert 'fq' not in app_module.FAST_SHAPING_MODES
+    assert app_module.fast_shaping_mode_for('25gbit', {'fast_shaping_mode': 'fq',
+                                                       'fast_shaping_threshold': '10gbit'}) is None
+
+
+@pytest.mark.parametrize('bandwidth, queues', [('1gbit', 3), ('10gbit', 7), ('100mbit', 6), ('1500kbit', 4)])
+def test_mq_children_add_up_to_the_cap(app_module, bandwidth, queues):
+    commands = app_module.build_qdisc_commands('eth0', '', '', '', bandwidth, queues=queues,
+                                               sizing=app_module.queue_sizing())
+    rates = [cmd[cmd.index('rate') + 1] for cmd in commands if 'tbf' in cmd]
+    assert len(rates) == queues
+    assert sum(app_module.rate_to_bits(r) for r in rates) == app_module.rate_to_bits(bandwidth)
+    # tc prints each child rate back in kbit; the reported cap is the one that was set
+    shown = 'qdisc mq 1: root\n' + ''.join(
+        f'qdisc tbf {101 + i:x}: parent 1:{i + 1:x} rate {app_module.rate_to_bits(r) // 1000}Kbit burst 4Kb lat 100ms\n'
+        for i, r in enumerate(rates))
+    assert app_module.parse_qdisc_state(shown)['bandwidth'] == bandwidth
@@ -0,0 +1,25 @@
+"""Importing app must not touch the host: only the server entrypoint starts background work."""
+import threading
+
+BACKGROUND = {'startup-restore', 'metrics-sampler', 'netlink-monitor'}
+
+
+def test_import_starts_no_background_threads(app_module):
+    assert not BACKGROUND & {t.name for t in threading.enumerate()}
+
+
+def test_start_background_work_starts_them(app_module, monkeypatch):
+    started = []
+
+    class FakeThread:
+        def __init__(self, target, name, daemon):
+            self.name = name
+
+        def start(self):
+            started.append(self.name)
+
+    monkeypatch.setattr(app_module.threading, 'Thread', FakeThread)
+    monkeypatch.setattr(app_module, 'METRICS_INTERVAL', 10)
+    monkeypatch.setattr(app_module, 'NETLINK_MONITOR', True)
+    app_module.start_background_work()
+    assert set(started) == BACKGROUND